@@ -97,6 +97,7 @@ setup(
         "cargo": ["pytoml"],
         "bazel": ["requests"],
         "deb": ["arpy"],
+        "oci": ["zstandard"],
     },
     zip_safe=False,
 )
@@ -45,6 +45,73 @@ according to "Docker Image Specification v1.2.0"[2]_.
 
 Optional. Only for OCI.
 
+::
+
+  compression: gzip
+
+Compression of the layers. Valid values are ``none``, ``gzip``,
+``zstd`` and ``estargz``. Defaults to ``gzip`` for OCI and ``none``
+for Docker. ``zstd`` requires the ``zstandard`` python package, and
+images using it can only be loaded by tools supporting zstd layers.
+
+``estargz`` is only valid for OCI. New layers are written as eStargz,
+which are gzip layers where each file can be fetched on its own,
+allowing runtimes supporting lazy pulling to start containers before
+layers are fully downloaded. The digest of the table of content is
+annotated in the manifest. Parent layers compressed with gzip are
+kept as is. ``gzip-level`` applies.
+
+The older ``gzip: true`` and ``gzip: false`` are still accepted in
+place of ``compression``.
+
+::
+
+  gzip-level: 9
+
+Compression level of gzip layers, from 0 to 9. Default value is 9.
+
+::
+
+  zstd-level: 3
+
+Compression level of zstd layers, from 1 to 22. Default value is 3.
+
+::
+
+  compression-threads: 1
+
+Number of threads used to compress layers. With a value other than 1,
+gzip layers are compressed in independent blocks, like ``pigz`` does,
+and zstd layers use multi-threaded compression. ``0`` uses as many
+threads as there are processors. The compressed layers do not depend
+on the number of threads, only on whether parallel compression is
+configured, so ``0`` produces the same layers on every host, even
+with a single processor. Default value is 1.
+
+::
+
+  parent-rootfs-cache: false
+  parent-rootfs-cache-size: 10737418240
+
+When adding a layer on top of a parent whose layer elements are not
+build dependencies, the parent layers have to be unpacked to compute
+the difference. With ``parent-rootfs-cache`` enabled, the unpacked
+layers are kept in ``oci-rootfs`` in the BuildStream cache directory
+and reused by other elements with the same parent layer blobs. Entries
+which cannot be read are discarded and the layers unpacked again. The
+least recently used entries are removed once the cache grows beyond
+``parent-rootfs-cache-size`` bytes, which must be positive. Default is
+disabled.
+
+::
+
+  image-threads: 1
+
+Number of images built concurrently. Images are independent until
+the index is written, so with a value other than 1 the layers of all
+images are unpacked, diffed and compressed in parallel. ``0`` uses as
+many threads as there are processors. Default value is 1.
+
 ::
 
   images:
@@ -80,6 +147,19 @@ on ``compose`` element to run those. `layer` is optional. If not
 provided, parent layers will be just used and new configuration will
 be set on an empty layer.
 
+::
+
+  layer-split:
+    paths: ["/usr/lib/debug"]
+    max-size: 536870912
+
+Optional. Splits the new content into several layers, each with its
+own history entry. Content under each of ``paths`` goes to a separate
+layer, placed after the layer with the rest of the content. Layers
+are then split further so that the files of a layer do not exceed
+``max-size`` bytes, unless a single file is larger. Smaller layers
+can be pulled in parallel and shared between more images.
+
 ::
 
   architecture: amd64
@@ -197,10 +277,11 @@ layer should be provided complete with all the files of the result.
 There is no creation dates added to the images to avoid problems with
 reproducibility.
 
-Each ``oci`` element can only add one layer. So if you need to build
-multiple layers, you must provide an ``oci`` element for each. Remember
-that only ``os`` and ``architecture`` are required, so you can make
-relatively concise elements.
+Each ``oci`` element adds the content of ``layer`` at once, split in
+several layers only with ``layer-split``. So if you need to build
+layers from different elements, you must provide an ``oci`` element
+for each. Remember that only ``os`` and ``architecture`` are required,
+so you can make relatively concise elements.
 
 You can layer OCI on top of Docker images or Docker images on top of
 OCI.  So no need to create both versions for images you use for
@@ -210,26 +291,869 @@ creating intermediate layers that do not need to be exported.
 
 import stat
 import os
-import tempfile
+import io
+import re
+import errno
+import fcntl
 import tarfile
 import hashlib
+import itertools
 import gzip
 import json
-import codecs
+import tempfile
 import shutil
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager, ExitStack
 
-from buildstream import Element, ElementError
+from buildstream import Element, ElementError, UtilError
+from buildstream.storage import CasBasedDirectory
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+_LAYER_MEDIA_TYPES = {
+    "none": "application/vnd.oci.image.layer.v1.tar",
+    "gzip": "application/vnd.oci.image.layer.v1.tar+gzip",
+    "zstd": "application/vnd.oci.image.layer.v1.tar+zstd",
+    # eStargz layers are valid gzip layers
+    "estargz": "application/vnd.oci.image.layer.v1.tar+gzip",
+}
+
+# Entries of eStargz layers which are not part of the file system
+_ESTARGZ_METADATA = {
+    "stargz.index.json",
+    ".no.prefetch.landmark",
+    ".prefetch.landmark",
+}
+
+
+def _layer_compression(media_type):
+    if media_type.endswith(("+gzip", ".gzip")):
+        return "gzip"
+    if media_type.endswith(("+zstd", ".zstd")):
+        return "zstd"
+    return "none"
+
+
+# Docker archives do not record the media type of layers, so look at
+# the magic number instead.
+def _sniff_compression(fileobj):
+    magic = fileobj.read(4)
+    if magic[:2] == b"\x1f\x8b":
+        return "gzip"
+    if magic == b"\x28\xb5\x2f\xfd":
+        return "zstd"
+    return "none"
+
+
+def _open_decompressor(fileobj, compression):
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+    if compression == "zstd":
+        if zstandard is None:
+            raise ElementError(
+                "The zstandard python package is required to read zstd layers"
+            )
+        return zstandard.ZstdDecompressor().stream_reader(
+            fileobj, closefd=False
+        )
+    return fileobj
+
+
+class _HashingWriter:
+    # Write-only file wrapper computing the sha256 and size of
+    # everything written through it, so that blobs do not need to be
+    # read back once written.
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
 
+    def flush(self):
+        self.fileobj.flush()
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def _deflate_block(data, zdict, level, last):
+    if zdict:
+        compressor = zlib.compressobj(
+            level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict
+        )
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    out = compressor.compress(data)
+    out += compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return out
+
+
+class _ParallelGzipWriter:
+    # Write-only gzip stream compressing fixed size blocks in a thread
+    # pool, the same way pigz does. Each block is an independent raw
+    # deflate stream primed with the last 32 KiB of the previous block
+    # and ending on a byte boundary, so concatenated blocks make a
+    # single valid gzip member.
+    #
+    # The output only depends on the data and the compression level,
+    # not on the number of threads.
+    BLOCK_SIZE = 128 * 1024
+    WINDOW_SIZE = 32 * 1024
+
+    def __init__(self, fileobj, level, threads, mtime=1320937200):
+        self.fileobj = fileobj
+        self.level = level
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.pending = deque()
+        self.max_pending = 2 * threads
+        self.buf = bytearray()
+        self.zdict = None
+        self.crc = 0
+        self.size = 0
+        self.closed = False
+
+        if level == 9:
+            xfl = b"\x02"
+        elif level == 1:
+            xfl = b"\x04"
+        else:
+            xfl = b"\x00"
+        self.fileobj.write(
+            b"\x1f\x8b\x08\x00" + struct.pack("<I", mtime) + xfl + b"\xff"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.closed = True
+            self.executor.shutdown(wait=True)
+
+    def _submit(self, data, last):
+        self.pending.append(
+            self.executor.submit(
+                _deflate_block, data, self.zdict, self.level, last
+            )
+        )
+        self.zdict = data[-self.WINDOW_SIZE :]
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.buf += data
+        while len(self.buf) >= self.BLOCK_SIZE:
+            block = bytes(self.buf[: self.BLOCK_SIZE])
+            del self.buf[: self.BLOCK_SIZE]
+            self._submit(block, False)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._submit(bytes(self.buf), True)
+            self.buf = bytearray()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+            self.fileobj.write(
+                struct.pack("<II", self.crc, self.size & 0xFFFFFFFF)
+            )
+        finally:
+            self.executor.shutdown(wait=True)
+
+
+class _LayerStream:
+    # Write-only stream receiving the layer tar. Data is teed through
+    # the uncompressed sha256 (the diff_id) and the compressor into
+    # the blob file, so a layer is produced in a single pass.
+    def __init__(self, fileobj, compressor=None):
+        self.diff_id_hash = hashlib.sha256()
+        self.compressor = compressor
+        if compressor is not None:
+            self.fileobj = compressor
+        else:
+            self.fileobj = fileobj
+
+        self.size = 0
+
+    def write(self, data):
+        self.diff_id_hash.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+    def tell(self):
+        return self.size
+
+    def close(self):
+        if self.compressor is not None:
+            self.compressor.close()
+
+    def diff_id(self):
+        return "sha256:{}".format(self.diff_id_hash.hexdigest())
+
+
+_ESTARGZ_CHUNK_SIZE = 4 * 1024 * 1024
+
+_ESTARGZ_TYPES = {
+    tarfile.REGTYPE: "reg",
+    tarfile.AREGTYPE: "reg",
+    tarfile.DIRTYPE: "dir",
+    tarfile.SYMTYPE: "symlink",
+    tarfile.LNKTYPE: "hardlink",
+    tarfile.CHRTYPE: "char",
+    tarfile.BLKTYPE: "block",
+    tarfile.FIFOTYPE: "fifo",
+}
+
+
+# The last gzip member of an eStargz layer. It is empty and records
+# the offset of the table of content in an extra field.
+def _estargz_footer(toc_offset):
+    subfield = "{:016x}STARGZ".format(toc_offset).encode("ascii")
+    extra = b"SG" + struct.pack("<H", len(subfield)) + subfield
+    return (
+        b"\x1f\x8b\x08\x04"
+        + struct.pack("<I", 0)
+        + b"\x00\xff"
+        + struct.pack("<H", len(extra))
+        + extra
+        # Empty final stored block
+        + b"\x01\x00\x00\xff\xff"
+        + struct.pack("<II", 0, 0)
+    )
+
+
+class _EstargzWriter:
+    # Compressor of eStargz layers. The content of each regular file
+    # starts a new gzip member, and is split in members of
+    # _ESTARGZ_CHUNK_SIZE, so that it can be fetched and decompressed
+    # on its own. _EstargzTarFile announces each entry before writing
+    # it, which tells where the header ends and the content starts.
+    # The table of content lists the entries with the offsets of
+    # their members.
+    def __init__(self, fileobj, level):
+        self.fileobj = fileobj
+        self.level = level
+        self.offset = 0
+        self.uncompressed_size = 0
+        self.member = None
+        self.entries = []
+        self.entry = None
+        self.chunk = None
+        self.header_left = 0
+        self.content_size = 0
+        self.content_left = 0
+        self.chunk_left = 0
+        self.payload_hash = None
+        self.chunk_hash = None
+        self.toc_offset = None
+        self.toc_digest = None
+
+    def _write_compressed(self, data):
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    def _compress(self, data):
+        if self.member is None:
+            self.member = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        self._write_compressed(self.member.compress(data))
+
+    def _close_member(self):
+        if self.member is not None:
+            self._write_compressed(self.member.flush())
+            self.member = None
+
+    def add_entry(self, tarinfo, header_size):
+        entry = {
+            "name": os.path.normpath(tarinfo.name).lstrip("/"),
+            "type": _ESTARGZ_TYPES[tarinfo.type],
+        }
+        if tarinfo.isreg():
+            entry["size"] = tarinfo.size
+        entry["modtime"] = time.strftime(
+            "%Y-%m-%dT%H:%M:%SZ", time.gmtime(tarinfo.mtime)
+        )
+        if tarinfo.issym() or tarinfo.islnk():
+            entry["linkName"] = tarinfo.linkname
+        entry["mode"] = tarinfo.mode
+        if tarinfo.uid:
+            entry["uid"] = tarinfo.uid
+        if tarinfo.gid:
+            entry["gid"] = tarinfo.gid
+        if tarinfo.uname:
+            entry["userName"] = tarinfo.uname
+        if tarinfo.gname:
+            entry["groupName"] = tarinfo.gname
+        if tarinfo.ischr() or tarinfo.isblk():
+            entry["devMajor"] = tarinfo.devmajor
+            entry["devMinor"] = tarinfo.devminor
+        self.entries.append(entry)
+
+        self.entry = entry
+        self.header_left = header_size
+        if tarinfo.isreg():
+            self.content_size = self.content_left = tarinfo.size
+            self.payload_hash = hashlib.sha256()
+        else:
+            self.content_size = self.content_left = 0
+
+    def _start_chunk(self):
+        self._close_member()
+        chunk_offset = self.content_size - self.content_left
+        if chunk_offset == 0:
+            self.chunk = self.entry
+        else:
+            self.chunk = {"name": self.entry["name"], "type": "chunk"}
+            self.entries.append(self.chunk)
+        self.chunk["offset"] = self.offset
+        if chunk_offset:
+            self.chunk["chunkOffset"] = chunk_offset
+        if self.content_left >= _ESTARGZ_CHUNK_SIZE:
+            self.chunk["chunkSize"] = _ESTARGZ_CHUNK_SIZE
+        self.chunk_left = min(self.content_left, _ESTARGZ_CHUNK_SIZE)
+        self.chunk_hash = hashlib.sha256()
+
+    def _end_chunk(self):
+        self.chunk["chunkDigest"] = "sha256:{}".format(
+            self.chunk_hash.hexdigest()
+        )
+        if not self.content_left:
+            self.entry["digest"] = "sha256:{}".format(
+                self.payload_hash.hexdigest()
+            )
+
+    def write(self, data):
+        self.uncompressed_size += len(data)
+        data = memoryview(data)
+        while data:
+            if self.header_left:
+                n = min(len(data), self.header_left)
+                self._compress(data[:n])
+                self.header_left -= n
+            elif self.content_left:
+                if not self.chunk_left:
+                    self._start_chunk()
+                n = min(len(data), self.chunk_left)
+                self.payload_hash.update(data[:n])
+                self.chunk_hash.update(data[:n])
+                self._compress(data[:n])
+                self.chunk_left -= n
+                self.content_left -= n
+                if not self.chunk_left:
+                    self._end_chunk()
+            else:
+                # Padding and headers of entries without content
+                n = len(data)
+                self._compress(data)
+            data = data[n:]
+        return self.uncompressed_size
+
+    # Start the member containing the table of content, which is
+    # written through write() as the last tar entry.
+    #
+    # Returns:
+    #    (bytes): The table of content
+    #
+    def begin_toc(self):
+        self._close_member()
+        self.header_left = self.content_left = 0
+        self.toc_offset = self.offset
+        toc = json.dumps(
+            {"version": 1, "entries": self.entries}, indent="\t"
+        ).encode("utf-8")
+        self.toc_digest = "sha256:{}".format(hashlib.sha256(toc).hexdigest())
+        return toc
+
+    def close(self):
+        self._close_member()
+        self._write_compressed(_estargz_footer(self.toc_offset))
+
+    def annotations(self):
+        return {
+            "containerd.io/snapshot/stargz/toc.digest": self.toc_digest,
+            "io.containers.estargz.uncompressed-size": str(
+                self.uncompressed_size
+            ),
+        }
 
-class blob:
-    def __init__(
-        self, root, media_type=None, text=False, mode="oci", legacy_config=None
-    ):
+
+class _EstargzTarFile(tarfile.TarFile):
+    # Tar file laid out for _EstargzWriter. It starts with the landmark
+    # telling there are no files to prefetch, and ends with the table
+    # of content followed by the end of archive marker.
+    def __init__(self, estargz, **kwargs):
+        self.estargz = estargz
+        super().__init__(**kwargs)
+        landmark = tarfile.TarInfo(".no.prefetch.landmark")
+        landmark.size = 1
+        self.addfile(landmark, io.BytesIO(b"\x0f"))
+
+    def addfile(self, tarinfo, fileobj=None):
+        buf = tarinfo.tobuf(self.format, self.encoding, self.errors)
+        self.estargz.add_entry(tarinfo, len(buf))
+        super().addfile(tarinfo, fileobj)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        toc = self.estargz.begin_toc()
+        tarinfo = tarfile.TarInfo("stargz.index.json")
+        tarinfo.size = len(toc)
+        self.fileobj.write(
+            tarinfo.tobuf(self.format, self.encoding, self.errors)
+        )
+        self.fileobj.write(toc)
+        remainder = len(toc) % tarfile.BLOCKSIZE
+        if remainder:
+            self.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        self.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+
+
+# Index a tree in a single traversal.
+#
+# Returns:
+#    (dict): Path tuples mapped to (mode, mtime, size)
+#
+def _index_tree(directory):
+    index = {}
+
+    def walk(d, prefix):
+        for name in d:
+            st = d.stat(name)
+            path = prefix + (name,)
+            index[path] = (st.st_mode, int(st.st_mtime), st.st_size)
+            if stat.S_ISDIR(st.st_mode):
+                walk(d.descend(name), path)
+
+    walk(directory, ())
+    return index
+
+
+# Compute the difference between a parent tree and a new layer from
+# their indexes with a merge of the sorted paths. Sorted path tuples
+# list each directory before its content.
+#
+# Returns:
+#    (list): Top-most paths of the parent missing in the layer
+#    (list): Paths of the layer identical in the parent
+#
+def _diff_trees(parent_index, layer_index, parentdir, layerdir):
+    whiteouts = []
+    duplicates = []
+
+    def both_dirs(path):
+        if not path:
+            return True
+        parent_entry = parent_index.get(path)
+        layer_entry = layer_index.get(path)
+        return (
+            parent_entry is not None
+            and layer_entry is not None
+            and stat.S_ISDIR(parent_entry[0])
+            and stat.S_ISDIR(layer_entry[0])
+        )
+
+    parent_paths = sorted(parent_index)
+    layer_paths = sorted(layer_index)
+    i = j = 0
+    while i < len(parent_paths):
+        path = parent_paths[i]
+        while j < len(layer_paths) and layer_paths[j] < path:
+            j += 1
+        if j == len(layer_paths) or layer_paths[j] != path:
+            if both_dirs(path[:-1]):
+                whiteouts.append(path)
+            i += 1
+            continue
+
+        i += 1
+        j += 1
+        old = parent_index[path]
+        new = layer_index[path]
+        if stat.S_ISDIR(old[0]) and stat.S_ISDIR(new[0]):
+            continue
+        if old != new:
+            continue
+        # Only read link targets and digests once the metadata
+        # matches. For CAS they are already known.
+        if stat.S_ISLNK(old[0]):
+            same = parentdir.readlink(*path) == layerdir.readlink(*path)
+        else:
+            same = parentdir.file_digest(*path) == layerdir.file_digest(*path)
+        if same:
+            duplicates.append(path)
+
+    return whiteouts, duplicates
+
+
+# Used in place of timed_activity() in worker threads, which must not
+# send messages. Activities are recorded with their duration for the
+# main thread to report them.
+class _ActivityLog:
+    def __init__(self):
+        self.activities = []
+
+    @contextmanager
+    def __call__(self, activity_name):
+        start = time.monotonic()
+        yield
+        self.activities.append((activity_name, time.monotonic() - start))
+
+
+# Iterate over the members of a tar stream opened in "r|" mode. Unlike
+# iterating over the TarFile, members are not recorded, so memory does
+# not grow with the number of entries.
+#
+# TarFile has no documented way to do that, so this reads the headers
+# the way TarFile.next() does, through the undocumented TarFile.offset,
+# TarInfo.fromtarfile() and header errors. They are the same on all
+# supported Python versions, which tests/elements/oci.py checks.
+def _tar_members(t):
+    # The first member is read when opening the stream
+    info = t.next()
+    while info is not None:
+        yield info
+        t.fileobj.seek(t.offset)
+        try:
+            info = tarfile.TarInfo.fromtarfile(t)
+        except (tarfile.EOFHeaderError, tarfile.EmptyHeaderError):
+            info = None
+        except tarfile.HeaderError as e:
+            raise tarfile.ReadError(str(e)) from e
+
+
+# Split a path from a tar entry.
+#
+# Returns:
+#    (list): The path components, None for paths outside of the root
+#
+def _tar_path(name):
+    if name.startswith("/"):
+        return None
+    parts = [p for p in name.split("/") if p not in ("", ".")]
+    if ".." in parts:
+        return None
+    return parts
+
+
+# Create the directories of a path in the temporary directory of a
+# layer being unpacked. Lower content which is not a directory is
+# hidden by new directories.
+#
+# Returns:
+#    (str): The directory, None if a component is not a directory
+#
+def _make_parents(tmpdir, dirname, parent_checkout):
+    path = tmpdir
+    for i, name in enumerate(dirname):
+        path = os.path.join(path, name)
+        if os.path.islink(path) or (
+            os.path.lexists(path) and not os.path.isdir(path)
+        ):
+            return None
+        if not os.path.exists(path):
+            lower = dirname[: i + 1]
+            if parent_checkout.exists(*lower) and not parent_checkout.isdir(
+                *lower
+            ):
+                parent_checkout.remove(*lower)
+            os.mkdir(path)
+    return path
+
+
+# Find the file a hard link of a layer being unpacked points to in its
+# temporary directory. Like for entries, symbolic links are not
+# followed, so that the link cannot reach outside of the directory.
+#
+# Returns:
+#    (str): The path of the file, None if it is not a regular file of
+#           the temporary directory
+#
+def _link_source(tmpdir, link):
+    path = tmpdir
+    for name in link:
+        path = os.path.join(path, name)
+        if os.path.islink(path):
+            return None
+    if not os.path.isfile(path):
+        return None
+    return path
+
+
+# Partition the content of a layer for layer-split. Content under
+# each of the given paths goes to layers of its own, after the rest of
+# the content, and layers are split further when their files exceed
+# max_size bytes.
+#
+# Args:
+#    index (dict): The index of the layer from _index_tree()
+#    paths (list): Paths with content going to separate layers
+#    max_size (int): The maximum size of a layer, 0 for no maximum
+#
+# Returns:
+#    (list): Sets of relative paths, one per layer
+#
+def _split_layer(index, paths, max_size):
+    rules = [tuple(p for p in path.split("/") if p) for path in paths]
+    has_children = {path[:-1] for path in index}
+
+    groups = [[] for _ in range(len(rules) + 1)]
+    for path in sorted(index):
+        mode, _, size = index[path]
+        if stat.S_ISDIR(mode) and path in has_children:
+            # Created along with its content
+            continue
+        group = 0
+        for i, rule in enumerate(rules):
+            if path[: len(rule)] == rule:
+                group = i + 1
+                break
+        if not stat.S_ISREG(mode):
+            size = 0
+        groups[group].append((path, size))
+
+    parts = []
+    for group in groups:
+        part = set()
+        part_size = 0
+        for path, size in group:
+            if part and max_size and part_size + size > max_size:
+                parts.append(part)
+                part = set()
+                part_size = 0
+            part.add("/".join(path))
+            part_size += size
+        if part:
+            parts.append(part)
+
+    if not parts:
+        # An empty layer is still a layer
+        parts.append(set())
+    return parts
+
+
+# Digest of a tree on disk, covering the names, types, modes and
+# content of its entries and the modification time of files.
+#
+# Returns:
+#    (str): The sha256 of the tree
+#    (int): The size of its entries
+#
+def _tree_digest(path):
+    h = hashlib.sha256()
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            fullpath = os.path.join(dirpath, name)
+            st = os.lstat(fullpath)
+            size += st.st_size
+            h.update(
+                os.fsencode(os.path.relpath(fullpath, path))
+                + "\0{:o}\0".format(st.st_mode).encode("ascii")
+            )
+            if stat.S_ISLNK(st.st_mode):
+                h.update(os.fsencode(os.readlink(fullpath)))
+            elif stat.S_ISREG(st.st_mode):
+                h.update(str(int(st.st_mtime)).encode("ascii") + b"\0")
+                with open(fullpath, "rb") as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        h.update(chunk)
+            h.update(b"\0")
+    return h.hexdigest(), size
+
+
+# Persistent cache of unpacked parent layers in the cache directory of
+# BuildStream, shared between elements and builds. Entries are keyed
+# by the chain of digests of the layer blobs they contain, so a chain
+# can be resumed from its longest cached prefix.
+#
+# Each entry is a directory containing the "rootfs" tree, a "size"
+# file, and a "digest" file with the digest of the tree. Entries are
+# moved in place once complete, so they are trusted without hashing
+# the tree again. Entries with a malformed digest or size, or which
+# cannot be imported, are discarded. The modification time of the
+# entry records its last use for eviction.
+# Readers hold a shared lock on the cache while importing an entry,
+# eviction only happens when an exclusive lock can be taken.
+#
+class _RootfsCache:
+    def __init__(self, directory, quota):
+        self.directory = directory
+        self.quota = quota
+
+    @staticmethod
+    def _keys(digests):
+        keys = []
+        h = hashlib.sha256()
+        for digest in digests:
+            h.update(digest.encode("ascii"))
+            h.update(b"\n")
+            keys.append(h.copy().hexdigest())
+        return keys
+
+    @staticmethod
+    def _is_valid(entry):
+        try:
+            with open(os.path.join(entry, "digest")) as f:
+                digest = f.read()
+            with open(os.path.join(entry, "size")) as f:
+                int(f.read())
+        except (OSError, ValueError):
+            return False
+        return bool(re.match(r"^[0-9a-f]{64}$", digest)) and os.path.isdir(
+            os.path.join(entry, "rootfs")
+        )
+
+    def _discard(self, entry):
+        tmpdir = tempfile.mkdtemp(prefix=".tmp-", dir=self.directory)
+        try:
+            os.rename(entry, os.path.join(tmpdir, "entry"))
+        except FileNotFoundError:
+            # Discarded concurrently
+            pass
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @contextmanager
+    def _lock(self, operation):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".lock"), "a") as f:
+            fcntl.flock(f.fileno(), operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    # Import the longest valid cached prefix of the chain into directory.
+    #
+    # Args:
+    #    digests (list): The digests of the layer blobs of the chain
+    #    directory (Directory): Where to import the cached layers
+    #
+    # Returns:
+    #    (int): The number of layers imported, 0 if nothing was cached
+    #
+    def load(self, digests, directory):
+        keys = self._keys(digests)
+        with self._lock(fcntl.LOCK_SH):
+            for i in range(len(keys), 0, -1):
+                entry = os.path.join(self.directory, keys[i - 1])
+                if not os.path.isdir(entry):
+                    continue
+                if not self._is_valid(entry):
+                    self._discard(entry)
+                    continue
+                try:
+                    directory.import_files(
+                        os.path.join(entry, "rootfs"), properties=["mtime"]
+                    )
+                except (OSError, UtilError):
+                    # Start again from an empty tree
+                    self._discard(entry)
+                    for name in list(directory):
+                        directory.remove(name, recursive=True)
+                    continue
+                os.utime(entry)
+                return i
+        return 0
+
+    def store(self, digests, directory):
+        key = self._keys(digests)[-1]
+        entry = os.path.join(self.directory, key)
+        if os.path.isdir(entry):
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        tmpdir = tempfile.mkdtemp(prefix=".tmp-", dir=self.directory)
+        try:
+            rootfs = os.path.join(tmpdir, "rootfs")
+            os.mkdir(rootfs)
+            directory.export_files(rootfs)
+            digest, size = _tree_digest(rootfs)
+            with open(os.path.join(tmpdir, "size"), "w") as f:
+                f.write(str(size))
+            with open(os.path.join(tmpdir, "digest"), "w") as f:
+                f.write(digest)
+            try:
+                os.rename(tmpdir, entry)
+            except OSError as e:
+                # Stored concurrently by another build
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+        finally:
+            if os.path.exists(tmpdir):
+                shutil.rmtree(tmpdir)
+
+        self._evict(keep=key)
+
+    def _evict(self, keep):
+        try:
+            with self._lock(fcntl.LOCK_EX | fcntl.LOCK_NB):
+                self._evict_locked(keep)
+        except BlockingIOError:
+            # Entries are in use, eviction will happen on next store
+            pass
+
+    def _evict_locked(self, keep):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.startswith("."):
+                continue
+            entry = os.path.join(self.directory, name)
+            try:
+                with open(os.path.join(entry, "size")) as f:
+                    size = int(f.read())
+                mtime = os.stat(entry).st_mtime
+            except (OSError, ValueError):
+                continue
+            entries.append((mtime, name, size))
+            total += size
+
+        for _, name, size in sorted(entries):
+            if total <= self.quota:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(os.path.join(self.directory, name))
+            total -= size
+
+
+_blob_counter = itertools.count()
+
+
+# Writes content addressed blobs into an image directory. Content is
+# hashed while it is written, and blobs already present in the
+# directory are not written again.
+#
+class BlobWriter:
+    def __init__(self, root, media_type=None, mode="oci", legacy_config=None):
         self.root = root
         self.descriptor = None
         self.media_type = media_type
-        self.text = text
         self.mode = mode
         self.path = None
         self.legacy_config = {}
@@ -237,74 +1161,110 @@ class blob:
             self.legacy_config.update(legacy_config)
         self.legacy_id = None
 
+    def _set_location(self, hexdigest, size):
+        self.descriptor = {}
+        if self.media_type:
+            self.descriptor["mediaType"] = self.media_type
+        self.descriptor["size"] = size
+        if self.mode == "oci":
+            self.descriptor["digest"] = "sha256:{}".format(hexdigest)
+            self.path = ["blobs", "sha256", hexdigest]
+        else:
+            assert self.mode == "docker"
+            if self.media_type.endswith("+json"):
+                self.path = ["{}.json".format(hexdigest)]
+                self.descriptor = "{}.json".format(hexdigest)
+            elif self.media_type.startswith(
+                "application/vnd.oci.image.layer.v1.tar"
+            ):
+                blobdir = self.root.descend(hexdigest, create=True)
+                self.path = [hexdigest, "layer.tar"]
+                with blobdir.open_file("VERSION", mode="w") as f:
+                    f.write("1.0")
+                self.legacy_config["id"] = hexdigest
+                self.legacy_id = hexdigest
+                with blobdir.open_file(
+                    "json",
+                    mode="w",
+                ) as f:
+                    json.dump(self.legacy_config, f)
+                self.descriptor = os.path.join(hexdigest, "layer.tar")
+            else:
+                assert False
+
     @contextmanager
     def create(self):
-        while True:
-            # This is in a private sandbox without concurrent access.
-            tempname = os.urandom(8).hex()
-            if not self.root.exists(tempname):
-                break
+        tempname = ".tmp-blob-{}".format(next(_blob_counter))
         try:
             with self.root.open_file(tempname, mode="x+b") as f:
-                if self.text:
-                    yield codecs.getwriter("utf-8")(f)
-                else:
-                    yield f
-                self.descriptor = {}
-                if self.media_type:
-                    self.descriptor["mediaType"] = self.media_type
-                f.seek(0, 2)
-                self.descriptor["size"] = f.tell()
-                f.seek(0)
-                h = hashlib.sha256()
-                while True:
-                    data = f.read(16 * 1204)
-                    if not data:
-                        break
-                    h.update(data)
-                if self.mode == "oci":
-                    self.descriptor["digest"] = "sha256:{}".format(
-                        h.hexdigest()
-                    )
-                    self.path = ["blobs", "sha256", h.hexdigest()]
-                else:
-                    assert self.mode == "docker"
-                    if self.media_type.endswith("+json"):
-                        self.path = ["{}.json".format(h.hexdigest())]
-                        self.descriptor = "{}.json".format(h.hexdigest())
-                    elif self.media_type.startswith(
-                        "application/vnd.oci.image.layer.v1.tar"
-                    ):
-                        blobdir = self.root.descend(h.hexdigest(), create=True)
-                        self.path = [h.hexdigest(), "layer.tar"]
-                        with blobdir.open_file("VERSION", mode="w") as f:
-                            f.write("1.0")
-                        self.legacy_config["id"] = h.hexdigest()
-                        self.legacy_id = h.hexdigest()
-                        with blobdir.open_file(
-                            "json",
-                            mode="w",
-                        ) as f:
-                            json.dump(self.legacy_config, f)
-                        self.descriptor = os.path.join(
-                            h.hexdigest(), "layer.tar"
-                        )
-                    else:
-                        assert False
-            self.root.descend(*self.path[:-1], create=True)
-            self.root.rename([tempname], self.path)
+                h = _HashingWriter(f)
+                yield h
+            self._set_location(h.hexdigest(), h.size)
+            if self.root.exists(*self.path):
+                self.root.remove(tempname)
+            else:
+                self.root.descend(*self.path[:-1], create=True)
+                self.root.rename([tempname], self.path)
         except Exception:
             if self.root.exists(tempname):
                 self.root.remove(tempname)
             raise
 
+    def write_bytes(self, data):
+        self._set_location(hashlib.sha256(data).hexdigest(), len(data))
+        if self.root.exists(*self.path):
+            return
+        destdir = self.root.descend(*self.path[:-1], create=True)
+        with destdir.open_file(self.path[-1], mode="wb") as f:
+            f.write(data)
+
+    # Import an existing blob by reference, without reading it.
+    #
+    # Args:
+    #    directory (Directory): The directory containing the blob
+    #    path (list): The path components of the blob in directory
+    #    hexdigest (str): The sha256 hex digest of the blob
+    #    size (int): The size of the blob
+    #    descriptor (dict): The original descriptor to keep, if any
+    #
+    def import_file(self, directory, path, hexdigest, size, descriptor=None):
+        self._set_location(hexdigest, size)
+        if descriptor is not None and self.mode == "oci":
+            self.descriptor = dict(descriptor)
+
+        if self.root.exists(*self.path):
+            return
+
+        name = path[-1]
+        destdir = self.root.descend(*self.path[:-1], create=True)
+        destdir.import_files(
+            directory.descend(*path[:-1]),
+            filter_callback=lambda relpath: relpath == name,
+        )
+        if name != self.path[-1]:
+            destdir.rename([name], [self.path[-1]])
+
 
 class OciElement(Element):
     BST_MIN_VERSION = "2.0"
     BST_VIRTUAL_DIRECTORY = True
 
     def configure(self, node):
-        node.validate_keys(["mode", "gzip", "images", "annotations"])
+        node.validate_keys(
+            [
+                "mode",
+                "gzip",
+                "compression",
+                "gzip-level",
+                "zstd-level",
+                "compression-threads",
+                "parent-rootfs-cache",
+                "parent-rootfs-cache-size",
+                "image-threads",
+                "images",
+                "annotations",
+            ]
+        )
 
         self.mode = node.get_str("mode", "oci")
         # FIXME: use a enum with node.get_enum here
@@ -315,7 +1275,102 @@ class OciElement(Element):
                 )
             )
 
-        self.gzip = node.get_bool("gzip", self.mode == "oci")
+        if "compression" in node:
+            if "gzip" in node:
+                raise ElementError(
+                    '{}: "gzip" cannot be used together with "compression"'.format(
+                        node.get_scalar("compression").get_provenance()
+                    )
+                )
+            self.compression = node.get_str("compression")
+            # FIXME: use a enum with node.get_enum here
+            if self.compression not in _LAYER_MEDIA_TYPES:
+                raise ElementError(
+                    '{}: Compression must be "none", "gzip", "zstd" or "estargz"'.format(
+                        node.get_scalar("compression").get_provenance()
+                    )
+                )
+        elif node.get_bool("gzip", self.mode == "oci"):
+            self.compression = "gzip"
+        else:
+            self.compression = "none"
+
+        if self.compression == "estargz" and self.mode != "oci":
+            raise ElementError(
+                "{}: estargz compression is only supported for OCI".format(
+                    node.get_scalar("compression").get_provenance()
+                )
+            )
+        # Parent layers are kept as plain gzip for eStargz
+        self.blob_compression = _layer_compression(
+            _LAYER_MEDIA_TYPES[self.compression]
+        )
+
+        if self.compression == "zstd" and zstandard is None:
+            raise ElementError(
+                "{}: zstd compression requires the zstandard python package".format(
+                    node.get_scalar("compression").get_provenance()
+                )
+            )
+
+        self.gzip_level = node.get_int("gzip-level", 9)
+        if not 0 <= self.gzip_level <= 9:
+            raise ElementError(
+                "{}: gzip-level must be between 0 and 9".format(
+                    node.get_scalar("gzip-level").get_provenance()
+                )
+            )
+
+        self.zstd_level = node.get_int("zstd-level", 3)
+        if not 1 <= self.zstd_level <= 22:
+            raise ElementError(
+                "{}: zstd-level must be between 1 and 22".format(
+                    node.get_scalar("zstd-level").get_provenance()
+                )
+            )
+
+        self.compression_threads = node.get_int("compression-threads", 1)
+        if self.compression_threads < 0:
+            raise ElementError(
+                "{}: compression-threads must not be negative".format(
+                    node.get_scalar("compression-threads").get_provenance()
+                )
+            )
+        # The output only depends on whether parallel compression is
+        # configured, the processor count only sizes the thread pool
+        self.parallel_compression = self.compression_threads != 1
+        if self.compression_threads == 0:
+            self.compression_threads = os.cpu_count() or 1
+
+        self.image_threads = node.get_int("image-threads", 1)
+        if self.image_threads < 0:
+            raise ElementError(
+                "{}: image-threads must not be negative".format(
+                    node.get_scalar("image-threads").get_provenance()
+                )
+            )
+        if self.image_threads == 0:
+            self.image_threads = os.cpu_count() or 1
+
+        self.rootfs_cache = None
+        if node.get_bool("parent-rootfs-cache", False):
+            cache_size = node.get_int(
+                "parent-rootfs-cache-size", 10 * 1024 * 1024 * 1024
+            )
+            if cache_size <= 0:
+                raise ElementError(
+                    "{}: parent-rootfs-cache-size must be positive".format(
+                        node.get_scalar(
+                            "parent-rootfs-cache-size"
+                        ).get_provenance()
+                    )
+                )
+            self.rootfs_cache = _RootfsCache(
+                os.path.join(
+                    self._context_directory("cachedir"), "oci-rootfs"
+                ),
+                cache_size,
+            )
 
         if "annotations" not in node:
             self.annotations = None
@@ -341,6 +1396,7 @@ class OciElement(Element):
                     "comment",
                     "config",
                     "annotations",
+                    "layer-split",
                 ]
                 + (["tags"] if self.mode == "docker" else [])
             )
@@ -360,6 +1416,23 @@ class OciElement(Element):
                     image.get_sequence("layer")
                 )
 
+            layer_split = image.get_mapping("layer-split", None)
+            if layer_split:
+                layer_split.validate_keys(["paths", "max-size"])
+                max_size = layer_split.get_int("max-size", 0)
+                if max_size < 0:
+                    raise ElementError(
+                        "{}: max-size must not be negative".format(
+                            layer_split.get_scalar("max-size").get_provenance()
+                        )
+                    )
+                image_value["layer-split"] = {
+                    "paths": self.node_subst_sequence_vars(
+                        layer_split.get_sequence("paths", [])
+                    ),
+                    "max-size": max_size,
+                }
+
             image_value["architecture"] = self.node_subst_vars(
                 image.get_scalar("architecture")
             )
@@ -484,11 +1557,27 @@ class OciElement(Element):
         pass
 
     def get_unique_key(self):
-        return {
+        key = {
             "annotations": self.annotations,
             "images": self.images,
-            "gzip": self.gzip,
+            "gzip": self.compression == "gzip",
+            # Bump whenever the blobs written for the same configuration
+            # change. Version 2 writes gzip headers without file name and
+            # the legacy Docker configuration of every layer.
+            "format-version": 2,
         }
+        if self.compression in ("gzip", "estargz") and self.gzip_level != 9:
+            key["gzip-level"] = self.gzip_level
+        if self.compression == "zstd":
+            key["compression"] = self.compression
+            key["zstd-level"] = self.zstd_level
+        if self.compression == "estargz":
+            key["compression"] = self.compression
+        if self.compression != "none" and self.parallel_compression:
+            # Parallel compression output does not depend on the
+            # number of threads, only on whether it is used.
+            key["parallel-compression"] = True
+        return key
 
     def configure_sandbox(self, sandbox):
         pass
@@ -496,11 +1585,166 @@ class OciElement(Element):
     def stage(self, sandbox):
         pass
 
-    def _build_image(self, sandbox, image, root, output):
+    # Returns a directory of BuildStream, such as "tmpdir" or "cachedir".
+    # There is no public API for them, so this is the only use of the
+    # private context of the element.
+    def _context_directory(self, name):
+        return getattr(self._get_context(), name)
+
+    def _open_compressor(self, fileobj):
+        if self.compression == "zstd":
+            if self.parallel_compression:
+                threads = self.compression_threads
+            else:
+                threads = 0
+            compressor = zstandard.ZstdCompressor(
+                level=self.zstd_level, threads=threads
+            )
+            return compressor.stream_writer(fileobj, closefd=False)
+        if not self.parallel_compression:
+            return gzip.GzipFile(
+                filename="",
+                fileobj=fileobj,
+                mode="wb",
+                compresslevel=self.gzip_level,
+                mtime=1320937200,
+            )
+        return _ParallelGzipWriter(
+            fileobj, self.gzip_level, self.compression_threads
+        )
+
+    # Unpack a layer on top of parent_checkout, in a single pass over
+    # the tar stream. Whiteouts only apply to lower layers, so they
+    # are applied to parent_checkout right away while the entries of
+    # the layer are written to a temporary directory, imported at the
+    # end.
+    #
+    def _extract_layer(self, output, layer, parent_checkout):
+        with ExitStack() as e:
+            f = e.enter_context(output.open_file(*layer, mode="rb"))
+            if self.blob_compression != "none":
+                f = e.enter_context(
+                    _open_decompressor(f, self.blob_compression)
+                )
+            tmpdir = e.enter_context(
+                tempfile.TemporaryDirectory(
+                    dir=self._context_directory("tmpdir"),
+                    prefix="oci-layer-",
+                )
+            )
+            t = e.enter_context(tarfile.open(fileobj=f, mode="r|"))
+            for info in _tar_members(t):
+                parts = _tar_path(info.name)
+                if (
+                    not parts
+                    or os.path.normpath(info.name) in _ESTARGZ_METADATA
+                ):
+                    continue
+
+                dirname, basename = parts[:-1], parts[-1]
+                if basename == ".wh..wh..opq":
+                    # Replace with empty directory
+                    if dirname and parent_checkout.isdir(*dirname):
+                        parent_checkout.remove(*dirname, recursive=True)
+                        parent_checkout.descend(*dirname, create=True)
+                    elif not dirname:
+                        for name in list(parent_checkout):
+                            parent_checkout.remove(name, recursive=True)
+                    continue
+                if basename.startswith(".wh."):
+                    whiteout = dirname + [basename[4:]]
+                    if parent_checkout.exists(*whiteout):
+                        parent_checkout.remove(*whiteout, recursive=True)
+                    continue
+
+                target = _make_parents(tmpdir, dirname, parent_checkout)
+                if target is None:
+                    continue
+                target = os.path.join(target, basename)
+
+                # An entry replaces lower content, except directories
+                # which are merged.
+                if parent_checkout.exists(*parts) and (
+                    info.isdir() != parent_checkout.isdir(*parts)
+                ):
+                    parent_checkout.remove(*parts, recursive=True)
+                if os.path.lexists(target) and not (
+                    info.isdir() and os.path.isdir(target)
+                ):
+                    if os.path.isdir(target) and not os.path.islink(target):
+                        shutil.rmtree(target)
+                    else:
+                        os.unlink(target)
+
+                if info.isdir():
+                    os.makedirs(target, exist_ok=True)
+                elif info.issym():
+                    os.symlink(info.linkname, target)
+                elif info.islnk():
+                    link = _tar_path(info.linkname)
+                    if not link:
+                        continue
+                    source = _link_source(tmpdir, link)
+                    if source is not None:
+                        try:
+                            os.link(source, target)
+                        except OSError:
+                            shutil.copy2(source, target)
+                    elif parent_checkout.isfile(*link):
+                        with parent_checkout.open_file(
+                            *link, mode="rb"
+                        ) as src, open(target, "wb") as dst:
+                            shutil.copyfileobj(src, dst)
+                        os.chmod(target, info.mode | stat.S_IRUSR)
+                        os.utime(target, (info.mtime, info.mtime))
+                elif info.isreg():
+                    with open(target, "wb") as dst:
+                        shutil.copyfileobj(t.extractfile(info), dst)
+                    os.chmod(target, info.mode | stat.S_IRUSR)
+                    os.utime(target, (info.mtime, info.mtime))
+                # Devices and fifos cannot be stored
+
+            parent_checkout.import_files(tmpdir, properties=["mtime"])
+
+    def _layer_blob(self, output, legacy_config=None):
+        return BlobWriter(
+            output,
+            media_type=_LAYER_MEDIA_TYPES[self.compression],
+            mode=self.mode,
+            legacy_config=legacy_config,
+        )
+
+    # Copy a layer blob, converting it from the given compression to
+    # the compression of this element if they differ.
+    def _copy_layer(self, inp, outp, compression):
+        with ExitStack() as e:
+            if compression != self.blob_compression:
+                if compression != "none":
+                    inp = e.enter_context(_open_decompressor(inp, compression))
+                if self.blob_compression != "none":
+                    outp = e.enter_context(self._open_compressor(outp))
+            shutil.copyfileobj(inp, outp)
+
+    # Stage everything an image needs and import the parent layers.
+    # This uses the sandbox and messaging, so it must run in the main
+    # thread.
+    #
+    # Args:
+    #    sandbox (Sandbox): The build sandbox
+    #    image (dict): The image configuration
+    #    workpath (str): Path of the working directory of the image
+    #    output (Directory): Where to write the blobs of the image
+    #
+    # Returns:
+    #    (dict): The state of the image for the next steps
+    #
+    def _prepare_image(self, sandbox, image, workpath, output):
+        root = sandbox.get_virtual_directory()
+        workdir = root.descend(workpath, create=True)
+
+        parent_checkout = None
         if "layer" in image:
-            if root.exists("parent_checkout"):
-                root.remove("parent_checkout", recursive=True)
-            parent_checkout = root.descend("parent_checkout", create=True)
+            parent_checkout = workdir.descend("parent_checkout", create=True)
 
         layer_descs = []
         layer_files = []
@@ -524,9 +1768,7 @@ class OciElement(Element):
                     config["config"][k] = v
 
         if "parent" in image:
-            if root.exists("parent"):
-                root.remove("parent", recursive=True)
-            parent = root.descend("parent", create=True)
+            parent = workdir.descend("parent", create=True)
             parent_dep = self.search(image["parent"]["element"])
             if not parent_dep:
                 raise ElementError(
@@ -535,7 +1777,12 @@ class OciElement(Element):
                     )
                 )
 
-            parent_dep.stage_dependency_artifacts(sandbox, path="parent")
+            parent_dep.stage_dependency_artifacts(
+                sandbox, path=os.path.join(workpath, "parent")
+            )
+
+            # List of (path, compression, descriptor) of parent layers
+            parent_layers = []
             if not parent.exists("index.json"):
                 with parent.open_file(
                     "manifest.json",
@@ -543,53 +1790,17 @@ class OciElement(Element):
                 ) as f:
                     parent_index = json.load(f)
                 parent_image = parent_index[image["parent"]["image"]]
-                layers = parent_image["Layers"]
 
                 with parent.open_file(
                     *parent_image["Config"].split("/"), mode="r"
                 ) as f:
                     image_config = json.load(f)
-                diff_ids = image_config["rootfs"]["diff_ids"]
-
-                if "history" in image_config:
-                    history = image_config["history"]
-
-                for i, layer in enumerate(layers):
-                    _, diff_id = diff_ids[i].split(":", 1)
-                    with parent.open_file(
-                        *layer.split("/"), mode="rb"
-                    ) as origblob:
-                        if self.gzip:
-                            targz_blob = blob(
-                                output,
-                                media_type="application/vnd.oci.image.layer.v1.tar+gzip",
-                                mode=self.mode,
-                            )
-                            with targz_blob.create() as gzipfile:
-                                with gzip.GzipFile(
-                                    filename=diff_id,
-                                    fileobj=gzipfile,
-                                    mode="wb",
-                                    mtime=1320937200,
-                                ) as gz:
-                                    shutil.copyfileobj(origblob, gz)
-                            layer_descs.append(targz_blob.descriptor)
-                            layer_files.append(targz_blob.path)
-                            legacy_parent = tar_blob.legacy_id
-                        else:
-                            legacy_config = {"os": image["os"]}
-                            if legacy_parent:
-                                legacy_config["parent"] = legacy_parent
-                            tar_blob = blob(
-                                output,
-                                media_type="application/vnd.oci.image.layer.v1.tar",
-                                mode=self.mode,
-                            )
-                            with tar_blob.create() as newfile:
-                                shutil.copyfileobj(origblob, newfile)
-                            layer_descs.append(tar_blob.descriptor)
-                            layer_files.append(tar_blob.path)
-                            legacy_parent = tar_blob.legacy_id
+
+                for layer in parent_image["Layers"]:
+                    path = layer.split("/")
+                    with parent.open_file(*path, mode="rb") as f:
+                        compression = _sniff_compression(f)
+                    parent_layers.append((path, compression, None))
             else:
                 with parent.open_file("index.json", mode="r") as f:
                     parent_index = json.load(f)
@@ -606,71 +1817,64 @@ class OciElement(Element):
                     "blobs", *algo.split("/"), *h.split("/"), mode="r"
                 ) as f:
                     image_config = json.load(f)
-                diff_ids = image_config["rootfs"]["diff_ids"]
-                if "history" in image_config:
-                    history = image_config["history"]
-                for i, layer in enumerate(image_manifest["layers"]):
-                    _, diff_id = diff_ids[i].split(":", 1)
+
+                for layer in image_manifest["layers"]:
                     algo, h = layer["digest"].split(":", 1)
-                    origfile = ["blobs", *algo.split("/"), *h.split("/")]
+                    parent_layers.append(
+                        (
+                            ["blobs", *algo.split("/"), *h.split("/")],
+                            _layer_compression(layer["mediaType"]),
+                            layer,
+                        )
+                    )
+
+            diff_ids = image_config["rootfs"]["diff_ids"]
+            if "history" in image_config:
+                history = image_config["history"]
+
+            for i, (path, compression, descriptor) in enumerate(parent_layers):
+                if "layer" not in image and i + 1 == len(parent_layers):
+                    # The case were we do not add a layer, the last imported layer has to be fully reconfigured
+                    legacy_config = {}
+                    legacy_config.update(config)
+                else:
+                    legacy_config = {"os": image["os"]}
+                if legacy_parent:
+                    legacy_config["parent"] = legacy_parent
+
+                output_blob = self._layer_blob(output, legacy_config)
+                if compression == self.blob_compression:
+                    # The blob can be used as is. Take its digest from
+                    # the parent descriptor, or from the virtual
+                    # directory which already knows it for CAS.
+                    if (
+                        descriptor is not None
+                        and descriptor["digest"].startswith("sha256:")
+                        and descriptor["mediaType"] == output_blob.media_type
+                    ):
+                        _, hexdigest = descriptor["digest"].split(":", 1)
+                        size = descriptor["size"]
+                    else:
+                        descriptor = None
+                        hexdigest = parent.file_digest(*path)
+                        size = parent.stat(*path).st_size
+                    output_blob.import_file(
+                        parent, path, hexdigest, size, descriptor=descriptor
+                    )
+                else:
                     with ExitStack() as e:
-                        if "layer" not in image and i + 1 == len(
-                            image_manifest["layers"]
-                        ):
-                            # The case were we do not add a layer, the last imported layer has to be fully reconfigured
-                            legacy_config = {}
-                            legacy_config.update(config)
-                            if legacy_parent:
-                                legacy_config["parent"] = legacy_parent
-                        else:
-                            legacy_config = {"os": image["os"]}
-                        if legacy_parent:
-                            legacy_config["parent"] = legacy_parent
-                        if self.gzip:
-                            output_blob = blob(
-                                output,
-                                media_type="application/vnd.oci.image.layer.v1.tar+gzip",
-                                mode=self.mode,
-                            )
-                        else:
-                            output_blob = blob(
-                                output,
-                                media_type="application/vnd.oci.image.layer.v1.tar",
-                                mode=self.mode,
-                                legacy_config=legacy_config,
-                            )
                         outp = e.enter_context(output_blob.create())
                         inp = e.enter_context(
-                            parent.open_file(*origfile, mode="rb")
+                            parent.open_file(*path, mode="rb")
                         )
-                        if layer["mediaType"].endswith("+gzip"):
-                            if self.gzip:
-                                shutil.copyfileobj(inp, outp)
-                            else:
-                                gz = e.enter_context(
-                                    gzip.open(filename=inp, mode="rb")
-                                )
-                                shutil.copyfileobj(gz, outp)
-                        else:
-                            if self.gzip:
-                                gz = e.enter_context(
-                                    gzip.GzipFile(
-                                        filename=diff_id,
-                                        fileobj=outp,
-                                        mode="wb",
-                                        mtime=1320937200,
-                                    )
-                                )
-                                shutil.copyfileobj(inp, gz)
-                            else:
-                                shutil.copyfileobj(inp, outp)
+                        self._copy_layer(inp, outp, compression)
 
-                    layer_descs.append(output_blob.descriptor)
-                    layer_files.append(output_blob.path)
-                    legacy_parent = output_blob.legacy_id
+                layer_descs.append(output_blob.descriptor)
+                layer_files.append(output_blob.path)
+                legacy_parent = output_blob.legacy_id
 
+        unpacked = False
         if "parent" in image and "layer" in image:
-            unpacked = False
             if isinstance(parent_dep, OciElement):
                 # Here we read the parent configuration to checkout
                 # the artifact which is much faster than unpacking the tar
@@ -706,172 +1910,211 @@ class OciElement(Element):
                     ):
                         for layer_dep in layers:
                             layer_dep.stage_dependency_artifacts(
-                                sandbox, path="parent_checkout"
+                                sandbox,
+                                path=os.path.join(workpath, "parent_checkout"),
                             )
                         unpacked = True
 
-            if not unpacked:
-                for layer in layer_files:
-                    if self.gzip:
-                        mode = "r:gz"
-                    else:
-                        mode = "r:"
-                    with self.timed_activity(
-                        "Decompressing layer {}".format(layer)
-                    ):
-                        with output.open_file(
-                            layer, mode="rb"
-                        ) as f, tarfile.open(fileobj=f, mode=mode) as t:
-                            members = []
-                            for info in t.getmembers():
-                                if "/../" in info.name:
-                                    continue
-                                if info.name.startswith("../"):
-                                    continue
-
-                                dirname, basename = os.path.split(info.name)
-                                if basename == ".wh..wh..opq":
-                                    # Replace with empty directory
-                                    parent_checkout.remove(
-                                        *dirname.split("/"), recursive=True
-                                    )
-                                    parent_checkout.descend(
-                                        *dirname.split("/"), create=True
-                                    )
-                                elif basename.startswith(".wh."):
-                                    parent_checkout.remove(
-                                        *dirname.split("/"),
-                                        basename[4:],
-                                        recursive=True,
-                                    )
-                                else:
-                                    members.append(info)
-
-                            t.extractall(path=parent_checkout, members=members)
-
-        legacy_config = {}
-        legacy_config.update(config)
-        if legacy_parent:
-            legacy_config["parent"] = legacy_parent
-
+        layer = None
         if "layer" in image:
             for name in image["layer"]:
                 dep = self.search(name)
-                dep.stage_dependency_artifacts(sandbox, path="layer")
-
-            layer = root.descend("layer")
-            with self.timed_activity("Transforming into layer"):
-
-                def create_whiteouts(parentdir, layerdir):
-                    for f in parentdir:
-                        if not layerdir.exists(f):
-                            with layerdir.open_file(".wh." + f, mode="w"):
-                                pass
-                        elif parentdir.isdir(f) and layerdir.isdir(f):
-                            # Recurse into subdirectory
-                            create_whiteouts(
-                                parentdir.descend(f), layerdir.descend(f)
-                            )
+                dep.stage_dependency_artifacts(
+                    sandbox, path=os.path.join(workpath, "layer")
+                )
+            layer = workdir.descend("layer")
 
-                create_whiteouts(parent_checkout, layer)
+        return {
+            "image": image,
+            "output": output,
+            "parent_blobs": output,
+            "config": config,
+            "layer_descs": layer_descs,
+            "layer_files": layer_files,
+            "diff_ids": diff_ids,
+            "history": history,
+            "legacy_parent": legacy_parent,
+            "parent_checkout": parent_checkout,
+            "unpacked": unpacked,
+            "layer": layer,
+            "workdir": workdir,
+            "new_layers": 0,
+        }
 
-                if "parent" in image:
+    # Give an image trees of its own, so its layer can be produced in a
+    # worker thread. The trees are imported by digest and only share the
+    # CAS with the sandbox, which is safe to use from several threads.
+    # Blobs are written to an empty output, imported back once the layer
+    # is produced.
+    #
+    # Args:
+    #    state (dict): The state returned by _prepare_image()
+    #
+    def _detach_image(self, state):
+        cas_cache = state["workdir"].cas_cache
+        for key in ["parent_blobs", "layer", "parent_checkout"]:
+            if state[key] is not None:
+                tree = CasBasedDirectory(cas_cache)
+                tree.import_files(state[key])
+                state[key] = tree
+        state["output"] = CasBasedDirectory(cas_cache)
+        state["workdir"] = CasBasedDirectory(cas_cache)
+
+    # Compute and write the new layer of an image, if any. This does
+    # not use the sandbox, and only reports progress through activity
+    # so it can run in a worker thread.
+    #
+    # Args:
+    #    state (dict): The state returned by _prepare_image()
+    #    activity (callable): Context manager taking an activity name
+    #
+    def _produce_layer(self, state, activity):
+        layer = state["layer"]
+        if layer is None:
+            return
+
+        parent_blobs = state["parent_blobs"]
+        layer_files = state["layer_files"]
+        parent_checkout = state["parent_checkout"]
+        if not state["unpacked"] and layer_files:
+            cached = 0
+            if self.rootfs_cache:
+                with activity("Staging cached parent layers"):
+                    layer_digests = [
+                        parent_blobs.file_digest(*layer_file)
+                        for layer_file in layer_files
+                    ]
+                    cached = self.rootfs_cache.load(
+                        layer_digests, parent_checkout
+                    )
+            for layer_file in layer_files[cached:]:
+                with activity("Decompressing layer {}".format(layer_file)):
+                    self._extract_layer(
+                        parent_blobs, layer_file, parent_checkout
+                    )
+            if self.rootfs_cache and cached < len(layer_files):
+                with activity("Caching parent layers"):
+                    self.rootfs_cache.store(layer_digests, parent_checkout)
 
-                    def remove_duplicates(parentdir, layerdir):
-                        for f in list(layerdir):
-                            if not parentdir.exists(f):
-                                pass
-                            elif parentdir.isdir(f) and layerdir.isdir(f):
-                                # Recurse into subdirectory
-                                remove_duplicates(
-                                    parentdir.descend(f), layerdir.descend(f)
-                                )
-                            else:
-                                old_st = parentdir.stat(f)
-                                new_st = layerdir.stat(f)
-                                if old_st.st_mode != new_st.st_mode:
-                                    continue
-                                if int(old_st.st_mtime) != int(
-                                    new_st.st_mtime
-                                ):
-                                    continue
-                                if stat.S_ISLNK(old_st.st_mode):
-                                    if parentdir.readlink(
-                                        f
-                                    ) == layerdir.readlink(f):
-                                        layerdir.remove(f)
-                                else:
-                                    if parentdir.file_digest(
-                                        f
-                                    ) == layerdir.file_digest(f):
-                                        layerdir.remove(f)
-
-                    remove_duplicates(parent_checkout, layer)
-
-            with tempfile.TemporaryFile(mode="w+b") as tfile:
-                with tarfile.open(fileobj=tfile, mode="w:") as t:
-                    with self.timed_activity("Building layer tar"):
-                        layer.export_to_tar(t, "")
-                tfile.seek(0)
-                tar_hash = hashlib.sha256()
-                with self.timed_activity("Hashing layer"):
-                    while True:
-                        data = tfile.read(16 * 1024)
-                        if not data:
-                            break
-                        tar_hash.update(data)
-                tfile.seek(0)
-                if self.gzip:
-                    targz_blob = blob(
-                        output,
-                        media_type="application/vnd.oci.image.layer.v1.tar+gzip",
-                        mode=self.mode,
+        legacy_config = {}
+        legacy_config.update(state["config"])
+        if state["legacy_parent"]:
+            legacy_config["parent"] = state["legacy_parent"]
+
+        with activity("Transforming into layer"):
+            whiteouts, duplicates = _diff_trees(
+                _index_tree(parent_checkout),
+                _index_tree(layer),
+                parent_checkout,
+                layer,
+            )
+            for path in whiteouts:
+                with layer.open_file(*path[:-1], ".wh." + path[-1], mode="w"):
+                    pass
+            for path in duplicates:
+                layer.remove(*path)
+
+        if "layer-split" in state["image"]:
+            with activity("Splitting layer"):
+                parts = _split_layer(
+                    _index_tree(layer),
+                    state["image"]["layer-split"]["paths"],
+                    state["image"]["layer-split"]["max-size"],
+                )
+                layers = []
+                for i, part in enumerate(parts):
+                    part_dir = state["workdir"].descend(
+                        "layer-{}".format(i), create=True
                     )
-                    with self.timed_activity("Compressing layer"):
-                        with targz_blob.create() as gzipfile:
-                            with gzip.GzipFile(
-                                filename=tar_hash.hexdigest(),
-                                fileobj=gzipfile,
-                                mode="wb",
-                                mtime=1320937200,
-                            ) as gz:
-                                shutil.copyfileobj(tfile, gz)
-                    layer_descs.append(targz_blob.descriptor)
-                else:
-                    copied_blob = blob(
-                        output,
-                        media_type="application/vnd.oci.image.layer.v1.tar",
-                        mode=self.mode,
-                        legacy_config=legacy_config,
+                    part_dir.import_files(
+                        layer, filter_callback=lambda path, p=part: path in p
                     )
-                    with copied_blob.create() as copiedfile:
-                        shutil.copyfileobj(tfile, copiedfile)
-                    layer_descs.append(copied_blob.descriptor)
-                    legacy_parent = copied_blob.legacy_id
+                    layers.append(part_dir)
+        else:
+            layers = [layer]
 
-            diff_ids.append("sha256:{}".format(tar_hash.hexdigest()))
+        for i, part_dir in enumerate(layers):
+            if i + 1 == len(layers):
+                layer_config = legacy_config
+            else:
+                # Only the top layer carries the configuration
+                layer_config = {"os": state["image"]["os"]}
+                if state["legacy_parent"]:
+                    layer_config["parent"] = state["legacy_parent"]
+            if len(layers) == 1:
+                activity_name = "Building layer"
+            else:
+                activity_name = "Building layer {}/{}".format(
+                    i + 1, len(layers)
+                )
+            with activity(activity_name):
+                self._build_layer(state, part_dir, layer_config)
+            if i + 1 < len(layers):
+                legacy_config["parent"] = state["legacy_parent"]
+
+    def _build_layer(self, state, layer, legacy_config):
+        layer_blob = self._layer_blob(state["output"], legacy_config)
+        with layer_blob.create() as blobfile:
+            if self.compression == "estargz":
+                estargz = _EstargzWriter(blobfile, self.gzip_level)
+                stream = _LayerStream(blobfile, estargz)
+                t = _EstargzTarFile(estargz, fileobj=stream, mode="w")
+            elif self.compression != "none":
+                stream = _LayerStream(
+                    blobfile, self._open_compressor(blobfile)
+                )
+                t = tarfile.open(fileobj=stream, mode="w|")
+            else:
+                stream = _LayerStream(blobfile)
+                t = tarfile.open(fileobj=stream, mode="w|")
+            with t:
+                layer.export_to_tar(t, "")
+            stream.close()
+        if self.compression == "estargz":
+            layer_blob.descriptor["annotations"] = estargz.annotations()
+        state["layer_descs"].append(layer_blob.descriptor)
+        state["legacy_parent"] = layer_blob.legacy_id
+        state["diff_ids"].append(stream.diff_id())
+        state["new_layers"] += 1
+
+    # Write the configuration and manifest of an image.
+    #
+    # Args:
+    #    state (dict): The state of the image once its layer is produced
+    #    output (Directory): Where to write the blobs
+    #
+    # Returns:
+    #    (dict|str): The manifest for the index
+    #    (dict): The legacy repositories for Docker
+    #
+    def _finish_image(self, state, output):
+        image = state["image"]
+        config = state["config"]
+        layer_descs = state["layer_descs"]
+        diff_ids = state["diff_ids"]
+        history = state["history"]
+        legacy_parent = state["legacy_parent"]
 
         if not history:
             history = []
-        hist_entry = {}
-        if "layer" not in image:
-            hist_entry["empty_layer"] = True
-        if "author" in image:
-            hist_entry["author"] = image["author"]
-        if "comment" in image:
-            hist_entry["comment"] = image["comment"]
-        history.append(hist_entry)
+        for i in range(max(state["new_layers"], 1)):
+            hist_entry = {}
+            if "layer" not in image:
+                hist_entry["empty_layer"] = True
+            if "author" in image:
+                hist_entry["author"] = image["author"]
+            if "comment" in image:
+                hist_entry["comment"] = image["comment"]
+            history.append(hist_entry)
 
         config["rootfs"] = {"type": "layers", "diff_ids": diff_ids}
         config["history"] = history
-        config_blob = blob(
+        config_blob = BlobWriter(
             output,
             media_type="application/vnd.oci.image.config.v1+json",
-            text=True,
             mode=self.mode,
         )
-        with config_blob.create() as configfile:
-            json.dump(config, configfile)
+        config_blob.write_bytes(json.dumps(config).encode("utf-8"))
 
         if self.mode == "docker":
             manifest = {
@@ -894,13 +2137,11 @@ class OciElement(Element):
             manifest["config"] = config_blob.descriptor
             if "annotations" in image:
                 manifest["annotations"] = image["annotations"]
-            manifest_blob = blob(
+            manifest_blob = BlobWriter(
                 output,
                 media_type="application/vnd.oci.image.manifest.v1+json",
-                text=True,
             )
-            with manifest_blob.create() as manifestfile:
-                json.dump(manifest, manifestfile)
+            manifest_blob.write_bytes(json.dumps(manifest).encode("utf-8"))
             platform = {
                 "os": image["os"],
                 "architecture": image["architecture"],
@@ -921,18 +2162,82 @@ class OciElement(Element):
         manifests = []
         legacy_repositories = {}
 
-        image_counter = 1
-        for image in self.images:
+        if self.image_threads == 1 or len(self.images) < 2:
+            image_counter = 1
+            for image in self.images:
+                with self.timed_activity(
+                    "Creating image {}".format(image_counter)
+                ):
+                    state = self._prepare_image(
+                        sandbox,
+                        image,
+                        "image-{}".format(image_counter),
+                        output,
+                    )
+                    self._produce_layer(state, self.timed_activity)
+                    manifest, legacy_repositories_part = self._finish_image(
+                        state, output
+                    )
+                    manifests.append(manifest)
+                    legacy_repositories.update(legacy_repositories_part)
+
+                image_counter += 1
+        else:
+            # Virtual directories are not thread-safe, and the sandbox
+            # directories share their parents. Only the main thread uses
+            # them, workers get trees of their own.
+            states = []
+            image_counter = 1
+            for image in self.images:
+                workpath = "image-{}".format(image_counter)
+                with self.timed_activity(
+                    "Preparing image {}".format(image_counter)
+                ):
+                    image_output = root.descend(
+                        workpath, "output", create=True
+                    )
+                    state = self._prepare_image(
+                        sandbox, image, workpath, image_output
+                    )
+                    output.import_files(image_output)
+                    self._detach_image(state)
+                    states.append(state)
+                image_counter += 1
+
             with self.timed_activity(
-                "Creating image {}".format(image_counter)
-            ):
-                manifest, legacy_repositories_part = self._build_image(
-                    sandbox, image, root, output
-                )
-                manifests.append(manifest)
-                legacy_repositories.update(legacy_repositories_part)
+                "Building layers of {} images".format(len(states))
+            ), ThreadPoolExecutor(max_workers=self.image_threads) as executor:
+                futures = []
+                for state in states:
+                    log = _ActivityLog()
+                    futures.append(
+                        (executor.submit(self._produce_layer, state, log), log)
+                    )
+                image_counter = 1
+                for future, log in futures:
+                    future.result()
+                    for activity_name, duration in log.activities:
+                        self.status(
+                            "Image {}: {}".format(
+                                image_counter, activity_name
+                            ),
+                            detail="Took {:.3f} seconds".format(duration),
+                        )
+                    image_counter += 1
+
+            image_counter = 1
+            for state in states:
+                with self.timed_activity(
+                    "Creating image {}".format(image_counter)
+                ):
+                    output.import_files(state["output"])
+                    manifest, legacy_repositories_part = self._finish_image(
+                        state, output
+                    )
+                    manifests.append(manifest)
+                    legacy_repositories.update(legacy_repositories_part)
 
-            image_counter += 1
+                image_counter += 1
 
         if self.mode == "docker":
             with output.open_file("manifest.json", mode="w") as f:
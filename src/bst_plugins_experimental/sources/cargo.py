@@ -51,6 +51,9 @@ obtain the crates automatically into %{vendordir}.
 
    # Optionally specify the name of the lock file to use (defaults to Cargo.lock)
    cargo-lock: Cargo.lock
+
+   # Number of crates downloaded concurrently when tracking (defaults to 8)
+   track-threads: 8
 """
 
 import contextlib
@@ -60,6 +63,7 @@ import shutil
 import tarfile
 import urllib.error
 import urllib.request
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 
 import pytoml
 from buildstream import Source, SourceFetcher, SourceError
@@ -350,10 +354,17 @@ class CargoSource(Source):
             self.ref = self.ref.strip_node_info()
         self.cargo_lock = node.get_str("cargo-lock", "Cargo.lock")
         self.vendor_dir = node.get_str("vendor-dir", "crates")
+        self.track_threads = node.get_int("track-threads", 8)
+        if self.track_threads < 1:
+            raise SourceError(
+                "{}: track-threads must be at least 1".format(
+                    node.get_scalar("track-threads").get_provenance()
+                )
+            )
 
         node.validate_keys(
             Source.COMMON_CONFIG_KEYS
-            + ["url", "ref", "cargo-lock", "vendor-dir"]
+            + ["url", "ref", "cargo-lock", "vendor-dir", "track-threads"]
         )
 
         self.crates = self._parse_crates(self.ref)
@@ -411,25 +422,65 @@ class CargoSource(Source):
         # FIXME: Better validation would be good here, so we can raise more
         #        useful error messages in the case of a malformed Cargo.lock file.
         #
+        # Version 1 lock files keep the checksums in the metadata table
+        metadata = lock.get("metadata", {})
         for package in lock["package"]:
             if "source" not in package:
                 continue
-            new_ref += [
-                {"name": package["name"], "version": str(package["version"])}
-            ]
+            crate_obj = {
+                "name": package["name"],
+                "version": str(package["version"]),
+            }
+            checksum = package.get("checksum")
+            if checksum is None:
+                checksum = metadata.get(
+                    "checksum {} {} ({})".format(
+                        package["name"], package["version"], package["source"]
+                    )
+                )
+            if checksum and checksum != "<none>":
+                crate_obj["sha"] = checksum
+            new_ref += [crate_obj]
 
         # Make sure the order we set it at track time is deterministic
         new_ref = sorted(new_ref, key=lambda c: (c["name"], c["version"]))
 
-        # Download the crates and get their shas
-        for crate_obj in new_ref:
-            crate = Crate(self, crate_obj["name"], crate_obj["version"])
+        # The checksums of the lock file are verified when fetching, only
+        # download the crates without one to get their shas, concurrently
+        missing = [
+            crate_obj for crate_obj in new_ref if "sha" not in crate_obj
+        ]
+        if not missing:
+            return new_ref
 
-            crate_url = crate._get_url()
-            with self.timed_activity(
-                "Downloading: {}".format(crate_url), silent_nested=True
-            ):
-                crate_obj["sha"] = crate._download(crate_url)
+        crates = [
+            Crate(self, crate_obj["name"], crate_obj["version"])
+            for crate_obj in missing
+        ]
+
+        with self.timed_activity(
+            "Downloading {} crates from {}".format(
+                len(crates), self.translate_url(self.url)
+            ),
+            silent_nested=True,
+        ):
+            with ThreadPoolExecutor(self.track_threads) as executor:
+                futures = [
+                    executor.submit(crate._download, crate._get_url())
+                    for crate in crates
+                ]
+                done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+
+                # Do not start the pending downloads once one failed
+                for future in pending:
+                    future.cancel()
+                for future in done:
+                    future.result()
+
+                shas = [future.result() for future in futures]
+
+        for crate_obj, sha in zip(missing, shas):
+            crate_obj["sha"] = sha
 
         return new_ref
 
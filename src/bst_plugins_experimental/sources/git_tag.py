@@ -120,6 +120,72 @@ git-tag - extension of BuildStream git plugin to track latest tag
    # Fetch a full clone instead of a shallow clone.
    full-clone: False
 
+   # Time in seconds during which the refs advertised by a remote are
+   # reused when checking whether a tag can be shallow fetched. The
+   # list of refs is shared between sources, and kept on disk with the
+   # mirrors. Tags moved upstream are only noticed once it expires. 0,
+   # the default, disables the cache.
+   ls-remote-cache-ttl: 0
+
+   # Share git objects between the mirrors of the same upstream, so that
+   # new mirrors and shallow fetches only download the objects missing
+   # from the shared store. Full mirrors copy their objects to the store
+   # and borrow them with git alternates, and drop their own copies when
+   # they are repacked, so they are only kept once on disk. Borrowed
+   # objects are copied into the staged repository. Cannot be used with
+   # 'clone-filter', as a partial clone lacks the objects of the store.
+   object-store: False
+
+   # Name identifying the upstream of the repository in the object store.
+   # Forks of the same upstream can use the same name to share objects.
+   # Defaults to the url before alias substitution, so that all mirrors
+   # of an alias share their objects.
+   object-store-name: upstream:project.git
+
+   # What to stage of the git repository along with the checkout. 'full'
+   # stages a clone of the whole mirror. 'shallow' stages a repository
+   # with the checked out commit and its history back to the nearest
+   # tags, enough for 'git describe'. 'none' only exports the tree,
+   # without any '.git', and cannot be used with 'use-lfs'.
+   stage-git-dir: full
+
+   # Object filter of a partial clone, used when a full clone of the
+   # repository is needed, for instance for tracking. With 'blob:none',
+   # only commits and trees are downloaded, and the files are fetched
+   # for the ref being fetched only. Cannot be used with 'object-store'.
+   clone-filter: blob:none
+
+   # Start shallow fetches of a new ref from the objects of the previous
+   # shallow fetch of the repository, so that bumping a tag only downloads
+   # what changed since the previous tag. The objects of the previous
+   # fetch are borrowed with git alternates rather than copied.
+   incremental-shallow: False
+
+   # Directory of git bundles, with a single file per repository and ref,
+   # to move mirrors between machines. Fetching imports the bundle of the
+   # ref if there is one, and otherwise exports it once fetched. Bundles
+   # only contain the history since the previous bundle exported for the
+   # repository, so the bundles they build on have to be moved with them.
+   bundle-dir: /srv/bundles
+
+   # Number of submodules fetched and staged concurrently.
+   submodule-threads: 4
+
+   # Maximum number of submodules fetched concurrently from the same host.
+   max-host-connections: 4
+
+   # Repack full mirrors and the object store after fetching once they
+   # have more packs or loose objects than these, and write their commit
+   # graph and multi-pack index, so that lookups stay fast in mirrors
+   # tracked for a long time. Mirrors using the object store also drop
+   # their copies of the objects of the store then. 0 disables the limit.
+   maintenance-max-packs: 20
+   maintenance-max-loose-objects: 1000
+
+Besides the usual git urls, aliases can point to git bundle files with
+the ``bundle://`` scheme, for instance ``bundle:///srv/bundles/`` to use
+``/srv/bundles/project.git`` as the remote of ``upstream:project.git``.
+
 **Configurable Warnings:**
 
 This plugin provides the following `configurable warnings
@@ -130,9 +196,22 @@ This plugin provides the following `configurable warnings
 """
 
 import os
+import atexit
+import copy
 import errno
+import json
 import re
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from io import StringIO
+from urllib.parse import urlsplit
 
 from configparser import RawConfigParser
 
@@ -145,6 +224,271 @@ GIT_ATTRIBUTES = ".gitattributes"
 # Warnings
 WARN_UNUSED_GITLFS = "unused-lfs"
 
+# Refs advertised by remotes, shared by all sources of the process.
+# Resolved urls are mapped to the time of the query and the refs
+# indexed by commit.
+_ls_remote_cache = {}
+_ls_remote_lock = threading.Lock()
+
+# Submodule tables by mirror and commit, shared by all sources of the
+# process. They are also kept on disk with the mirrors.
+_submodule_tables = {}
+_submodule_tables_lock = threading.Lock()
+
+# Refs found with all their objects in partial clone mirrors, by mirror
+# and object id, shared by all sources of the process. Objects are never
+# removed from the mirrors, so the tree of a ref is only walked until it
+# is complete.
+_complete_refs = set()
+_complete_refs_lock = threading.Lock()
+
+
+# 'git cat-file --batch' processes by repository, shared by all sources
+# of the process. Only the most recently used ones are kept running, and
+# they are closed when the process exits.
+_cat_file_batches = OrderedDict()
+_cat_file_batches_lock = threading.Lock()
+_CAT_FILE_BATCHES_MAX = 16
+
+
+# A long lived 'git cat-file --batch' process answering object queries
+# on a repository over a pipe, instead of spawning git for each query.
+#
+class _CatFileBatch:
+    def __init__(self, git, repo):
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._process = subprocess.Popen(
+            [git, "cat-file", "--batch"],
+            cwd=repo,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    # Returns the object id, type and contents of the object with the
+    # given name, or None if there is no such object
+    def read(self, name):
+        with self._lock:
+            self._process.stdin.write(name.encode() + b"\n")
+            self._process.stdin.flush()
+            header = self._process.stdout.readline()
+            if not header:
+                raise BrokenPipeError("git cat-file exited")
+            if header.endswith((b" missing\n", b" ambiguous\n")):
+                return None
+
+            oid, obj_type, size = header.split()
+            # The contents are followed by a newline
+            contents = self._process.stdout.read(int(size) + 1)[:-1]
+            return oid.decode(), obj_type.decode(), contents
+
+    # Stops the process and waits for it. Processes inherited from the
+    # parent process are left to it.
+    def close(self):
+        if self.pid != os.getpid():
+            return
+
+        with self._lock:
+            for pipe in (self._process.stdin, self._process.stdout):
+                try:
+                    pipe.close()
+                except OSError:
+                    pass
+            self._process.wait()
+
+
+# Closes the 'git cat-file --batch' process of a repository, if any, for
+# instance before repacking it
+def _close_cat_file_batch(repo):
+    with _cat_file_batches_lock:
+        batch = _cat_file_batches.pop(repo, None)
+    if batch is not None:
+        batch.close()
+
+
+@atexit.register
+def _close_cat_file_batches():
+    with _cat_file_batches_lock:
+        batches = list(_cat_file_batches.values())
+        _cat_file_batches.clear()
+    for batch in batches:
+        batch.close()
+
+
+# The git processes of the worker threads
+#
+# They are started in their own sessions, like those of Source.call(),
+# so that the calling thread can stop, continue and kill their process
+# groups along with the job. Once cancelled, no more processes are
+# started.
+#
+class _WorkerProcesses:
+    def __init__(self):
+        # Reentrant, as the signal handlers run in the calling thread
+        self._lock = threading.RLock()
+        self._processes = set()
+        self._cancelled = False
+
+    @contextmanager
+    def start(self, source, args, **kwargs):
+        with self._lock:
+            if self._cancelled:
+                raise SourceError(
+                    "{}: Cancelled running '{}'".format(source, " ".join(args))
+                )
+            process = subprocess.Popen(args, start_new_session=True, **kwargs)
+            self._processes.add(process)
+        try:
+            yield process
+        finally:
+            with self._lock:
+                self._processes.discard(process)
+
+    def send_signal(self, sig):
+        with self._lock:
+            for process in self._processes:
+                try:
+                    os.killpg(process.pid, sig)
+                except ProcessLookupError:
+                    pass
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            self.send_signal(signal.SIGKILL)
+
+    # Stops, continues and kills the processes when the calling process
+    # is suspended, resumed and terminated, before calling the previous
+    # handlers. Signal handlers can only be set from the main thread.
+    @contextmanager
+    def handle_signals(self):
+        if threading.current_thread() is not threading.main_thread():
+            yield
+            return
+
+        def suspend(signum, frame):
+            self.send_signal(signal.SIGSTOP)
+            if callable(original_suspend):
+                original_suspend(signum, frame)
+            elif original_suspend == signal.SIG_DFL:
+                os.kill(os.getpid(), signal.SIGSTOP)
+            self.send_signal(signal.SIGCONT)
+
+        def terminate(signum, frame):
+            self.cancel()
+            if callable(original_terminate):
+                original_terminate(signum, frame)
+            elif original_terminate == signal.SIG_DFL:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                os.kill(os.getpid(), signal.SIGTERM)
+
+        original_suspend = signal.signal(signal.SIGTSTP, suspend)
+        original_terminate = signal.signal(signal.SIGTERM, terminate)
+        try:
+            yield
+        except BaseException:
+            self.cancel()
+            raise
+        finally:
+            signal.signal(signal.SIGTSTP, original_suspend)
+            signal.signal(signal.SIGTERM, original_terminate)
+
+
+# Stands in for the source of the mirrors run in worker threads.
+#
+# BuildStream only handles the messages, logs and signals of the
+# threads it runs jobs in. So git is run directly, with _WorkerProcesses,
+# in temporary directories created by the calling thread, and the
+# messages are collected for the calling thread to send.
+#
+class _WorkerSource:
+    def __init__(self, source, tmpdir, processes):
+        self._source = source
+        self._tmpdir = tmpdir
+        self._processes = processes
+        self.messages = []
+
+    def __getattr__(self, name):
+        return getattr(self._source, name)
+
+    def __str__(self):
+        return str(self._source)
+
+    def status(self, message, **kwargs):
+        self.messages.append((self._source.status, message, kwargs))
+
+    def info(self, message, **kwargs):
+        self.messages.append((self._source.info, message, kwargs))
+
+    def warn(self, message, **kwargs):
+        self.messages.append((self._source.warn, message, kwargs))
+
+    # Sends the collected messages, from the calling thread
+    def send_messages(self):
+        messages, self.messages = self.messages, []
+        for send, message, kwargs in messages:
+            send(message, **kwargs)
+
+    def call(self, args, *, fail=None, fail_temporarily=False, **kwargs):
+        kwargs.setdefault("stdout", subprocess.PIPE)
+        kwargs.setdefault("stderr", subprocess.STDOUT)
+        return self._run(args, fail, fail_temporarily, kwargs)[0]
+
+    def check_output(
+        self, args, *, fail=None, fail_temporarily=False, **kwargs
+    ):
+        kwargs["stdout"] = subprocess.PIPE
+        kwargs.setdefault("stderr", subprocess.PIPE)
+        return self._run(args, fail, fail_temporarily, kwargs)
+
+    def _run(self, args, fail, fail_temporarily, kwargs):
+        collect_stdout = kwargs["stderr"] != subprocess.STDOUT
+        with self._processes.start(
+            self._source, args, universal_newlines=True, **kwargs
+        ) as process:
+            output, log = process.communicate()
+        if not collect_stdout:
+            output, log = None, output
+
+        if fail and process.returncode:
+            raise SourceError(
+                "{}: {}".format(self._source, fail),
+                detail="Running '{}' failed:\n{}".format(
+                    " ".join(args), log or ""
+                ),
+                temporary=fail_temporarily,
+            )
+        return process.returncode, output
+
+    @contextmanager
+    def tempdir(self):
+        tmpdir = tempfile.mkdtemp(dir=self._tmpdir)
+        try:
+            yield tmpdir
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+# Returns the host of a git url, including scp-like ssh urls
+def _url_host(url):
+    host = urlsplit(url).hostname
+    if host is None and "://" not in url:
+        m = re.match(r"(?:[^@/]+@)?(?P<host>[^:/]+):", url)
+        if m:
+            host = m.group("host")
+    return host
+
+
+# Returns the object directories a repository borrows from
+def _read_alternates(repo):
+    try:
+        with open(os.path.join(repo, "objects", "info", "alternates")) as f:
+            return f.read().splitlines()
+    except FileNotFoundError:
+        return []
+
+
 # Because of handling of submodules, we maintain a GitMirror
 # for the primary git source and also for each submodule it
 # might have at a given time
@@ -179,6 +523,59 @@ class GitTagMirror(SourceFetcher):
                 self.source.get_mirror_directory(), ref_dirname
             )
 
+    # Returns a copy of the mirror using the given stand-in for the source
+    def with_source(self, source):
+        mirror = copy.copy(self)
+        mirror.source = source
+        return mirror
+
+    # Reads an object of the mirror, or returns None if it does not exist
+    #
+    # The queries go through a 'git cat-file --batch' process per mirror,
+    # restarted if it exits, and per process since pipes cannot be shared
+    # with the forked jobs.
+    #
+    def cat_file(self, name, mirror=None):
+        if mirror is None:
+            mirror = self.mirror_path()
+
+        for _ in range(2):
+            evicted = []
+            with _cat_file_batches_lock:
+                batch = _cat_file_batches.get(mirror)
+                if batch is None or batch.pid != os.getpid():
+                    batch = _CatFileBatch(self.source.host_git, mirror)
+                    _cat_file_batches[mirror] = batch
+                _cat_file_batches.move_to_end(mirror)
+                while len(_cat_file_batches) > _CAT_FILE_BATCHES_MAX:
+                    evicted.append(_cat_file_batches.popitem(last=False)[1])
+            for old_batch in evicted:
+                old_batch.close()
+
+            try:
+                return batch.read(name)
+            except (OSError, ValueError):
+                with _cat_file_batches_lock:
+                    if _cat_file_batches.get(mirror) is batch:
+                        del _cat_file_batches[mirror]
+                batch.close()
+
+        raise SourceError(
+            "{}: Failed to read {} from git repository {}".format(
+                self.source, name, mirror
+            )
+        )
+
+    # Translates the url for git, replacing bundle:// urls by the path of
+    # the bundle file
+    def git_url(self, alias_override=None):
+        url = self.source.translate_url(
+            self.url, alias_override=alias_override, primary=self.primary
+        )
+        if url.startswith("bundle://"):
+            url = url[len("bundle://") :]
+        return url
+
     def mirror_path(self):
         if os.path.exists(self.mirror):
             return self.mirror
@@ -194,6 +591,11 @@ class GitTagMirror(SourceFetcher):
         if os.path.exists(self.fetch_mirror):
             return
 
+        bundle = self.bundle_path()
+        if bundle and os.path.exists(bundle):
+            self.import_bundle(bundle)
+            return
+
         if self.full_clone:
             self.source.status("{}: Full clone requested".format(self.source))
             self.ensure_trackable(alias_override=alias_override)
@@ -212,6 +614,40 @@ class GitTagMirror(SourceFetcher):
         tag = m.group("tag")
         commit = m.group("commit")
 
+        url = self.git_url(alias_override)
+
+        # Bundles have no shallow history to fetch
+        if os.path.isfile(url):
+            self.ensure_trackable(alias_override=alias_override)
+            return
+
+        tag_refs = {
+            "refs/tags/{tag}^{{}}".format(tag=tag),
+            "refs/tags/{tag}".format(tag=tag),
+        }
+        advertised = any(
+            ad_ref in tag_refs
+            for ad_ref in self.advertised_refs(url).get(commit, [])
+        )
+        if not advertised and self.source.ls_remote_cache_ttl:
+            # The cached refs may predate the tag
+            advertised = any(
+                ad_ref in tag_refs
+                for ad_ref in self.advertised_refs(url, refresh=True).get(
+                    commit, []
+                )
+            )
+
+        if not advertised:
+            self.source.status(
+                "{}: {} is not advertised on {}, so a full clone is required".format(
+                    self.source, self.ref, url
+                )
+            )
+
+            self.ensure_trackable(alias_override=alias_override)
+            return
+
         with self.source.tempdir() as tmpdir:
             self.source.call(
                 [self.source.host_git, "init", "--bare", tmpdir],
@@ -219,10 +655,6 @@ class GitTagMirror(SourceFetcher):
                 fail_temporarily=True,
             )
 
-            url = self.source.translate_url(
-                self.url, alias_override=alias_override, primary=self.primary
-            )
-
             self.source.call(
                 [
                     self.source.host_git,
@@ -237,37 +669,56 @@ class GitTagMirror(SourceFetcher):
                 fail_temporarily=True,
             )
 
-            _, refs = self.source.check_output(
-                [self.source.host_git, "ls-remote", "origin"],
-                cwd=tmpdir,
-                fail="Failed to list advertised remote refs from git repository {}".format(
-                    url
-                ),
-                fail_temporarily=True,
-            )
-
-            advertised = False
+            # Only borrow, a shallow repository cannot populate the store
+            alternates = []
+            store = self.ensure_object_store()
+            if store:
+                alternates.append(os.path.join(store, "objects"))
+
+            previous = self.previous_fetch_mirror()
+            if previous:
+                # The objects of the previous fetch are borrowed, along
+                # with those it borrows itself as git only follows a few
+                # levels of alternates. Its commit is then negotiated as
+                # common with the remote, which only sends the objects
+                # missing from it.
+                exit_code, previous_commit = self.source.check_output(
+                    [self.source.host_git, "rev-parse", "HEAD"],
+                    cwd=previous,
+                )
+                if exit_code == 0:
+                    alternates.append(os.path.join(previous, "objects"))
+                    alternates.extend(_read_alternates(previous))
+                    if os.path.exists(os.path.join(previous, "shallow")):
+                        shutil.copyfile(
+                            os.path.join(previous, "shallow"),
+                            os.path.join(tmpdir, "shallow"),
+                        )
 
-            for ref_line in refs.splitlines():
-                ad_commit, ad_ref = ref_line.split("\t", 1)
-                if ad_commit == commit:
-                    if ad_ref in [
-                        "refs/tags/{tag}^{{}}".format(tag=tag),
-                        "refs/tags/{tag}".format(tag=tag),
-                    ]:
-                        advertised = True
-                        break
+            if alternates:
+                with open(
+                    os.path.join(tmpdir, "objects", "info", "alternates"), "w"
+                ) as f:
+                    for alternate in dict.fromkeys(alternates):
+                        f.write(alternate + "\n")
 
-            if not advertised:
-                self.source.status(
-                    "{}: {} is not advertised on {}, so a full clone is required".format(
-                        self.source, self.ref, url
+            if previous and exit_code == 0:
+                exit_code = self.source.call(
+                    [
+                        self.source.host_git,
+                        "update-ref",
+                        "refs/previous",
+                        previous_commit.strip(),
+                    ],
+                    cwd=tmpdir,
+                )
+            if previous and exit_code != 0:
+                self.source.warn(
+                    "{}: Failed to start from the previous fetch {}, fetching all objects".format(
+                        self.source, previous
                     )
                 )
 
-                self.ensure_trackable(alias_override=alias_override)
-                return
-
             exit_code = self.source.call(
                 [self.source.host_git, "fetch", "--depth=1", "origin", tag],
                 cwd=tmpdir,
@@ -295,6 +746,17 @@ class GitTagMirror(SourceFetcher):
                 fail_temporarily=True,
             )
 
+            if previous:
+                self.source.call(
+                    [
+                        self.source.host_git,
+                        "update-ref",
+                        "-d",
+                        "refs/previous",
+                    ],
+                    cwd=tmpdir,
+                )
+
             try:
                 os.rename(tmpdir, self.fetch_mirror)
             except OSError as e:
@@ -311,6 +773,93 @@ class GitTagMirror(SourceFetcher):
                         )
                     ) from e
 
+        if self.source.incremental_shallow:
+            latest_file = self._latest_fetch_mirror_file()
+            os.makedirs(os.path.dirname(latest_file), exist_ok=True)
+            with utils.save_file_atomic(latest_file, "w") as f:
+                f.write(os.path.basename(self.fetch_mirror))
+
+    # The file recording the name of the last fetch mirror of the url
+    def _latest_fetch_mirror_file(self):
+        return os.path.join(
+            self.source.get_mirror_directory(),
+            "latest-fetch-mirrors",
+            utils.url_directory_name(self.url),
+        )
+
+    # Returns the path of the last fetch mirror of the url to start an
+    # incremental shallow fetch from, or None
+    def previous_fetch_mirror(self):
+        if not self.source.incremental_shallow:
+            return None
+
+        try:
+            with open(self._latest_fetch_mirror_file(), "r") as f:
+                previous = os.path.join(
+                    self.source.get_mirror_directory(), f.read().strip()
+                )
+        except OSError:
+            return None
+
+        if previous == self.fetch_mirror or not os.path.isdir(previous):
+            return None
+        return previous
+
+    # Lists the refs advertised by a remote, indexed by commit.
+    #
+    # Results are reused for ls-remote-cache-ttl seconds, from memory or
+    # from the copy kept in the mirror directory, unless refresh is set.
+    #
+    def advertised_refs(self, url, *, refresh=False):
+        ttl = self.source.ls_remote_cache_ttl
+        cache_file = os.path.join(
+            self.source.get_mirror_directory(),
+            "ls-remote-cache",
+            "{}.json".format(utils.url_directory_name(url)),
+        )
+
+        if ttl and not refresh:
+            now = time.time()
+            with _ls_remote_lock:
+                cached = _ls_remote_cache.get(url)
+            if cached is not None and now - cached[0] < ttl:
+                return cached[1]
+            try:
+                with open(cache_file, "r") as f:
+                    cached = json.load(f)
+                if now - cached["time"] < ttl:
+                    with _ls_remote_lock:
+                        _ls_remote_cache[url] = (
+                            cached["time"],
+                            cached["refs"],
+                        )
+                    return cached["refs"]
+            except (OSError, ValueError, KeyError):
+                pass
+
+        query_time = time.time()
+        _, output = self.source.check_output(
+            [self.source.host_git, "ls-remote", url],
+            fail="Failed to list advertised remote refs from git repository {}".format(
+                url
+            ),
+            fail_temporarily=True,
+        )
+
+        refs = {}
+        for ref_line in output.splitlines():
+            ad_commit, ad_ref = ref_line.split("\t", 1)
+            refs.setdefault(ad_commit, []).append(ad_ref)
+
+        if ttl:
+            with _ls_remote_lock:
+                _ls_remote_cache[url] = (query_time, refs)
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with utils.save_file_atomic(cache_file, "w") as f:
+                json.dump({"time": query_time, "refs": refs}, f)
+
+        return refs
+
     # Ensures that the mirror exists
     def ensure_trackable(self, alias_override=None):
 
@@ -325,17 +874,28 @@ class GitTagMirror(SourceFetcher):
             # system configured tmpdir is not on the same partition.
             #
             with self.source.tempdir() as tmpdir:
-                url = self.source.translate_url(
-                    self.url,
-                    alias_override=alias_override,
-                    primary=self.primary,
-                )
+                url = self.git_url(alias_override)
+                store = self.ensure_object_store()
+                if store:
+                    reference = ["--reference", store]
+                else:
+                    reference = []
+                if self.source.clone_filter:
+                    clone_filter = [
+                        "--filter={}".format(self.source.clone_filter)
+                    ]
+                else:
+                    clone_filter = []
                 self.source.call(
                     [
                         self.source.host_git,
                         "clone",
                         "--mirror",
                         "-n",
+                    ]
+                    + reference
+                    + clone_filter
+                    + [
                         url,
                         tmpdir,
                     ],
@@ -365,11 +925,188 @@ class GitTagMirror(SourceFetcher):
                             )
                         ) from e
 
-    def _fetch(self, alias_override=None):
-        url = self.source.translate_url(
-            self.url, alias_override=alias_override, primary=self.primary
+            if store:
+                self.update_object_store(store)
+
+    # Returns the path of the object store shared with the mirrors of the
+    # same upstream, creating it if needed, or None if not enabled.
+    #
+    def ensure_object_store(self):
+        if not self.source.object_store:
+            return None
+
+        if self.primary and self.source.object_store_name:
+            name = self.source.object_store_name
+        else:
+            name = self.url
+
+        store = os.path.join(
+            self.source.get_mirror_directory(),
+            "object-stores",
+            utils.url_directory_name(name),
         )
+        if os.path.exists(store):
+            return store
 
+        os.makedirs(os.path.dirname(store), exist_ok=True)
+        with self.source.tempdir() as tmpdir:
+            self.source.call(
+                [self.source.host_git, "init", "--bare", tmpdir],
+                fail="Failed to init git object store",
+                fail_temporarily=True,
+            )
+
+            # Mirrors and fetch mirrors borrow objects from the store
+            # without it knowing, so nothing may ever be pruned.
+            self.source.call(
+                [self.source.host_git, "config", "gc.pruneExpire", "never"],
+                cwd=tmpdir,
+                fail="Failed to configure git object store",
+                fail_temporarily=True,
+            )
+
+            try:
+                os.rename(tmpdir, store)
+            except OSError as e:
+                if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                    raise SourceError(
+                        "{}: Failed to move git object store from '{}' to '{}': {}".format(
+                            self.source, tmpdir, store, e
+                        )
+                    ) from e
+
+        return store
+
+    # Copies the objects of the mirror to the shared object store: they
+    # are fetched in the store, under refs named after the mirror so
+    # that they stay reachable, and the mirror then borrows them through
+    # its alternates. Its own copies are dropped by maintain().
+    #
+    def update_object_store(self, store):
+        # Keep the fetched objects packed
+        self.source.call(
+            [
+                self.source.host_git,
+                "-c",
+                "fetch.unpackLimit=1",
+                "fetch",
+                "--no-tags",
+                self.mirror,
+                "+refs/*:refs/mirrors/{}/*".format(
+                    os.path.basename(self.mirror)
+                ),
+            ],
+            fail="Failed to update git object store {}".format(store),
+            fail_temporarily=True,
+            cwd=store,
+        )
+
+        # Mirrors cloned before the store existed do not borrow from it yet
+        store_objects = os.path.join(store, "objects")
+        alternates = os.path.join(self.mirror, "objects", "info", "alternates")
+        if store_objects not in _read_alternates(self.mirror):
+            os.makedirs(os.path.dirname(alternates), exist_ok=True)
+            with open(alternates, "a") as f:
+                f.write(store_objects + "\n")
+
+    # Returns the object counts of a repository, as reported by
+    # 'git count-objects -v', with sizes in KiB
+    #
+    def object_counts(self, repo):
+        output = self.source.check_output(
+            [self.source.host_git, "count-objects", "-v"],
+            fail="Failed to count objects of {}".format(repo),
+            cwd=repo,
+        )[1]
+        counts = {}
+        for line in output.splitlines():
+            key, _, value = line.partition(":")
+            try:
+                counts[key.strip()] = int(value)
+            except ValueError:
+                pass
+        return counts
+
+    # Keeps lookups fast in long lived repositories, which gain a pack at
+    # every fetch: once there are more packs or loose objects than the
+    # configured maximum, packs are merged geometrically, so that only
+    # the small ones get rewritten, and the commit graph and multi-pack
+    # index are written.
+    #
+    def maintain(self, repo):
+        counts = self.object_counts(repo)
+        packs = counts.get("packs", 0)
+        loose = counts.get("count", 0)
+        self.source.status(
+            "{}: {} has {} packs ({} KiB) and {} loose objects ({} KiB)".format(
+                self.source,
+                repo,
+                packs,
+                counts.get("size-pack", 0),
+                loose,
+                counts.get("size", 0),
+            )
+        )
+
+        max_packs = self.source.maintenance_max_packs
+        max_loose = self.source.maintenance_max_loose_objects
+        if not (
+            (max_packs and packs > max_packs)
+            or (max_loose and loose > max_loose)
+        ):
+            return
+
+        self.source.status("{}: Repacking {}".format(self.source, repo))
+
+        # A running 'git cat-file' would keep the replaced packs open
+        _close_cat_file_batch(repo)
+
+        if os.path.exists(os.path.join(repo, "objects", "info", "alternates")):
+            # Only a full repack drops the local copies of the objects
+            # borrowed from the object store
+            self.source.call(
+                [self.source.host_git, "repack", "-a", "-d", "-l"],
+                fail="Failed to repack {}".format(repo),
+                cwd=repo,
+            )
+        else:
+            # Geometric repacks need git 2.33, older versions only pack
+            # the loose objects. Nothing is pruned.
+            exit_code = self.source.call(
+                [
+                    self.source.host_git,
+                    "repack",
+                    "-d",
+                    "-l",
+                    "--geometric=2",
+                ],
+                cwd=repo,
+            )
+            if exit_code != 0:
+                self.source.call(
+                    [self.source.host_git, "repack", "-d", "-l"],
+                    fail="Failed to repack {}".format(repo),
+                    cwd=repo,
+                )
+
+        self.source.call(
+            [self.source.host_git, "commit-graph", "write", "--reachable"],
+            fail="Failed to write the commit graph of {}".format(repo),
+            cwd=repo,
+        )
+        # A mirror borrowing all its objects has no pack left to index
+        packdir = os.path.join(repo, "objects", "pack")
+        if any(name.endswith(".pack") for name in os.listdir(packdir)):
+            self.source.call(
+                [self.source.host_git, "multi-pack-index", "write"],
+                fail="Failed to write the multi-pack index of {}".format(repo),
+                cwd=repo,
+            )
+
+    # Returns the name of the remote of the mirror to fetch from, adding
+    # it if an alias override is used
+    #
+    def _remote_name(self, url, alias_override=None):
         mirror = self.mirror_path()
 
         if alias_override:
@@ -390,35 +1127,402 @@ class GitTagMirror(SourceFetcher):
         else:
             remote_name = "origin"
 
-        self.source.call(
+        return remote_name
+
+    def _fetch(self, alias_override=None):
+        url = self.git_url(alias_override)
+
+        remote_name = self._remote_name(url, alias_override)
+
+        self.source.call(
+            [
+                self.source.host_git,
+                "fetch",
+                remote_name,
+                "--prune",
+                "--tags",
+                "--force",
+            ],
+            fail="Failed to fetch from remote git repository: {}".format(url),
+            fail_temporarily=True,
+            cwd=self.mirror,
+        )
+
+        store = self.ensure_object_store()
+        if store:
+            self.update_object_store(store)
+            self.maintain(store)
+        self.maintain(self.mirror)
+
+    def fetch(self, alias_override=None):
+        # Resolve the URL for the message
+        resolved_url = self.source.translate_url(
+            self.url, alias_override=alias_override, primary=self.primary
+        )
+
+        with self.source.timed_activity(
+            "Fetching from {}".format(resolved_url), silent_nested=True
+        ):
+            self.ensure_fetchable(alias_override)
+            if not self.has_ref():
+                self._fetch(alias_override)
+                self.fetch_missing_objects(alias_override)
+            self.assert_ref()
+            self.export_bundle()
+
+    # The bundle of the ref in the bundle directory, named like the fetch
+    # mirror, or None if there is no bundle directory
+    def bundle_path(self):
+        if not self.source.bundle_dir or self.ref is None:
+            return None
+        return os.path.join(
+            self.source.bundle_dir,
+            "{}.bundle".format(os.path.basename(self.fetch_mirror)),
+        )
+
+    # The file recording the name of the last bundle exported for the url
+    def _latest_bundle_file(self):
+        return os.path.join(
+            self.source.get_mirror_directory(),
+            "latest-bundles",
+            utils.url_directory_name(self.url),
+        )
+
+    # Returns the commits of the last bundle exported for the url which
+    # are ancestors of the commit, for the next bundle to leave out
+    def _previous_bundle_commits(self, mirror, commit):
+        try:
+            with open(self._latest_bundle_file(), "r") as f:
+                previous = os.path.join(
+                    self.source.bundle_dir, f.read().strip()
+                )
+            _, refs = self._read_bundle_header(previous)
+        except (OSError, SourceError):
+            return []
+
+        commits = []
+        for oid, ref in refs:
+            if not ref.startswith("refs/bundles/") or oid == commit:
+                continue
+            exit_code = self.source.call(
+                [
+                    self.source.host_git,
+                    "merge-base",
+                    "--is-ancestor",
+                    oid,
+                    commit,
+                ],
+                cwd=mirror,
+            )
+            if exit_code == 0:
+                commits.append(oid)
+        return commits
+
+    # Writes the history of the ref, as far as the mirror has it, and the
+    # tags of its commit to a bundle in the bundle directory.
+    #
+    # The history already in the previous bundle of the url is left out,
+    # so that each bundle only has what changed since the previous one.
+    #
+    def export_bundle(self):
+        bundle = self.bundle_path()
+        if not bundle or os.path.exists(bundle):
+            return
+
+        mirror = self.mirror_path()
+        commit = self.cat_file("{}^{{commit}}".format(self.ref), mirror)[0]
+        _, tags = self.source.check_output(
+            [self.source.host_git, "tag", "--points-at", commit],
+            fail="Failed to list tags of git ref {}".format(self.ref),
+            cwd=mirror,
+        )
+        previous = self._previous_bundle_commits(mirror, commit)
+
+        # Bundles only contain named refs
+        export_ref = "refs/bundles/{}".format(
+            os.path.basename(self.fetch_mirror)
+        )
+        self.source.call(
+            [self.source.host_git, "update-ref", export_ref, commit],
+            fail="Failed to create ref {}".format(export_ref),
+            cwd=mirror,
+        )
+
+        os.makedirs(self.source.bundle_dir, exist_ok=True)
+        tmpbundle = "{}.{}.tmp".format(bundle, os.getpid())
+        try:
+            self.source.call(
+                [self.source.host_git, "bundle", "create", tmpbundle]
+                + [export_ref]
+                + ["refs/tags/{}".format(tag) for tag in tags.splitlines()]
+                + ["^{}".format(oid) for oid in previous],
+                fail="Failed to create git bundle {}".format(bundle),
+                cwd=mirror,
+            )
+            os.rename(tmpbundle, bundle)
+        finally:
+            if os.path.exists(tmpbundle):
+                os.unlink(tmpbundle)
+            self.source.call(
+                [self.source.host_git, "update-ref", "-d", export_ref],
+                cwd=mirror,
+            )
+
+        latest_file = self._latest_bundle_file()
+        os.makedirs(os.path.dirname(latest_file), exist_ok=True)
+        with utils.save_file_atomic(latest_file, "w") as f:
+            f.write(os.path.basename(bundle))
+
+    # Reads the header of a bundle, leaving the file positioned at the
+    # start of its pack if one is given. Returns the prerequisite commits
+    # and the (object, ref) tuples of the bundle.
+    #
+    def _read_bundle_header(self, bundle, f=None):
+        if f is None:
+            with open(bundle, "rb") as f:
+                return self._read_bundle_header(bundle, f)
+
+        prerequisites = []
+        refs = []
+
+        header = f.readline()
+        if header not in (b"# v2 git bundle\n", b"# v3 git bundle\n"):
+            raise SourceError(
+                "{}: {} is not a git bundle".format(self.source, bundle)
+            )
+        while True:
+            line = f.readline().rstrip(b"\n").decode()
+            if not line:
+                break
+            elif line.startswith("@"):
+                # v3 capabilities
+                continue
+            elif line.startswith("-"):
+                prerequisites.append(line[1:].split(" ", 1)[0])
+            else:
+                refs.append(line.split(" ", 1))
+
+        return prerequisites, refs
+
+    # Returns the bundle of the bundle directory with a ref at the commit,
+    # or None
+    def _find_bundle(self, commit):
+        try:
+            names = sorted(os.listdir(self.source.bundle_dir))
+        except OSError:
+            return None
+
+        for name in names:
+            if not name.endswith(".bundle"):
+                continue
+            bundle = os.path.join(self.source.bundle_dir, name)
+            try:
+                _, refs = self._read_bundle_header(bundle)
+            except (OSError, SourceError):
+                continue
+            if any(oid == commit for oid, _ in refs):
+                return bundle
+        return None
+
+    # Indexes the pack of a bundle in the repository, after those of the
+    # bundles with its prerequisites, which the pack may be thin against.
+    # Returns the refs of the bundle.
+    #
+    def _index_bundle(self, bundle, repo, indexed=()):
+        with open(bundle, "rb", buffering=0) as f:
+            prerequisites, refs = self._read_bundle_header(bundle, f)
+
+            for prerequisite in prerequisites:
+                exit_code = self.source.call(
+                    [
+                        self.source.host_git,
+                        "cat-file",
+                        "-e",
+                        "{}^{{commit}}".format(prerequisite),
+                    ],
+                    cwd=repo,
+                )
+                if exit_code == 0:
+                    continue
+
+                provider = self._find_bundle(prerequisite)
+                if provider is None or provider in indexed:
+                    raise SourceError(
+                        "{}: Git bundle {} requires commit {}, which is in no other bundle of {}".format(
+                            self.source,
+                            bundle,
+                            prerequisite,
+                            self.source.bundle_dir,
+                        )
+                    )
+                self._index_bundle(provider, repo, indexed + (bundle,))
+
+            # The file is positioned at the start of the pack
+            self.source.call(
+                [self.source.host_git, "index-pack", "--stdin", "--fix-thin"],
+                stdin=f,
+                fail="Failed to import git bundle {}".format(bundle),
+                cwd=repo,
+            )
+
+        return refs
+
+    # Creates the fetch mirror from a bundle of the bundle directory.
+    #
+    # Bundles of shallow mirrors lack the parents of some commits, which
+    # git refuses to import. So the pack of the bundle is indexed
+    # directly, and the commits with missing parents are marked as
+    # shallow. The prerequisites of the bundle are imported first from
+    # the other bundles.
+    #
+    def import_bundle(self, bundle):
+        with self.source.tempdir() as tmpdir:
+            self.source.call(
+                [self.source.host_git, "init", "--bare", tmpdir],
+                fail="Failed to init git repository",
+            )
+
+            refs = self._index_bundle(bundle, tmpdir)
+
+            _, objects = self.source.check_output(
+                [
+                    self.source.host_git,
+                    "cat-file",
+                    "--batch-all-objects",
+                    "--batch-check=%(objecttype) %(objectname)",
+                ],
+                fail="Failed to list objects of git bundle {}".format(bundle),
+                cwd=tmpdir,
+            )
+            commits_file = os.path.join(tmpdir, "bundle-commits")
+            with open(commits_file, "w") as commits:
+                for line in objects.splitlines():
+                    obj_type, oid = line.split()
+                    if obj_type == "commit":
+                        commits.write(oid + "\n")
+
+            # Parents are only read from the commits, not walked
+            with open(commits_file, "r") as commits:
+                _, parents = self.source.check_output(
+                    [
+                        self.source.host_git,
+                        "log",
+                        "--no-walk",
+                        "--stdin",
+                        "--format=%H %P",
+                    ],
+                    stdin=commits,
+                    fail="Failed to list commits of git bundle {}".format(
+                        bundle
+                    ),
+                    cwd=tmpdir,
+                )
+            os.unlink(commits_file)
+
+            commit_parents = {}
+            for line in parents.splitlines():
+                oid, *oid_parents = line.split()
+                commit_parents[oid] = oid_parents
+
+            shallow = [
+                oid
+                for oid, oid_parents in commit_parents.items()
+                if any(parent not in commit_parents for parent in oid_parents)
+            ]
+            if shallow:
+                with open(
+                    os.path.join(tmpdir, "shallow"), "w"
+                ) as shallow_file:
+                    shallow_file.write("".join(oid + "\n" for oid in shallow))
+
+            for oid, ref in refs:
+                if ref.startswith("refs/bundles/"):
+                    # We need to have a ref to make it clonable
+                    ref = "HEAD"
+                self.source.call(
+                    [self.source.host_git, "update-ref", ref, oid],
+                    fail="Failed to create ref {}".format(ref),
+                    cwd=tmpdir,
+                )
+
+            try:
+                os.rename(tmpdir, self.fetch_mirror)
+            except OSError as e:
+                if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                    raise SourceError(
+                        "{}: Failed to move git repository imported from '{}' to '{}': {}".format(
+                            self.source, bundle, self.fetch_mirror, e
+                        )
+                    ) from e
+
+    # Fetches like fetch(), without timed activity nor warnings, so that
+    # it can be used from a worker thread
+    #
+    def prefetch(self):
+        self.ensure_fetchable()
+        if not self.has_ref_objects():
+            self._fetch()
+            self.fetch_missing_objects()
+
+    # Lists the objects of the tree at the ref which were filtered out
+    # of a partial clone mirror
+    #
+    def missing_objects(self, mirror):
+        if not self.source.clone_filter or mirror != self.mirror:
+            return []
+
+        _, output = self.source.check_output(
             [
                 self.source.host_git,
-                "fetch",
-                remote_name,
-                "--prune",
-                "--tags",
-                "--force",
+                "rev-list",
+                "--objects",
+                "--missing=print",
+                "--no-walk",
+                self.ref,
             ],
-            fail="Failed to fetch from remote git repository: {}".format(url),
-            fail_temporarily=True,
-            cwd=self.mirror,
+            fail="Failed to list objects of git ref {}".format(self.ref),
+            cwd=mirror,
         )
 
-    def fetch(self, alias_override=None):
-        # Resolve the URL for the message
-        resolved_url = self.source.translate_url(
-            self.url, alias_override=alias_override, primary=self.primary
-        )
+        return [
+            line[1:] for line in output.splitlines() if line.startswith("?")
+        ]
 
-        with self.source.timed_activity(
-            "Fetching from {}".format(resolved_url), silent_nested=True
-        ):
-            self.ensure_fetchable(alias_override)
-            if not self.has_ref():
-                self._fetch(alias_override)
-            self.assert_ref()
+    # Fetches the objects needed to stage the ref into a partial clone
+    # mirror. Missing trees hide what they contain, so this is repeated
+    # until nothing is missing.
+    #
+    def fetch_missing_objects(self, alias_override=None):
+        missing = self.missing_objects(self.mirror_path())
+        if not missing:
+            return
 
-    def has_ref(self):
+        url = self.git_url(alias_override)
+        remote_name = self._remote_name(url, alias_override)
+
+        while missing:
+            # Keep the command line reasonably short
+            for i in range(0, len(missing), 1000):
+                self.source.call(
+                    [
+                        self.source.host_git,
+                        "-c",
+                        "fetch.negotiationAlgorithm=noop",
+                        "fetch",
+                        "--no-tags",
+                        remote_name,
+                    ]
+                    + missing[i : i + 1000],
+                    fail="Failed to fetch objects of git ref {} from {}".format(
+                        self.ref, url
+                    ),
+                    fail_temporarily=True,
+                    cwd=self.mirror,
+                )
+            missing = self.missing_objects(self.mirror)
+
+    # Checks that the ref and all of its objects are in the mirror
+    def has_ref_objects(self):
         if not self.ref:
             return False
 
@@ -431,31 +1535,42 @@ class GitTagMirror(SourceFetcher):
         mirror = self.mirror_path()
 
         # Check if the ref is really there
-        rc = self.source.call(
-            [self.source.host_git, "cat-file", "-t", self.ref], cwd=mirror
-        )
-        if not rc == 0:
+        ref_object = self.cat_file(self.ref, mirror)
+        if ref_object is None:
+            return False
+
+        key = (mirror, ref_object[0])
+        with _complete_refs_lock:
+            if key in _complete_refs:
+                return True
+
+        if self.missing_objects(mirror):
+            return False
+
+        with _complete_refs_lock:
+            _complete_refs.add(key)
+        return True
+
+    def has_ref(self):
+        if not self.has_ref_objects():
             return False
 
+        mirror = self.mirror_path()
+
         ## This tries to test if git-lfs is used in this repo and if it is then mandates that you have set
         ## whether or not to use git-lfs with the use-lfs option.
-        showrc, attrs = self.source.check_output(
-            [
-                self.source.host_git,
-                "show",
-                "{}:{}".format(self.ref, GIT_ATTRIBUTES),
-            ],
-            cwd=mirror,
+        attrs_object = self.cat_file(
+            "{}:{}".format(self.ref, GIT_ATTRIBUTES), mirror
         )
+        if attrs_object is not None:
+            attrs = attrs_object[2].decode("utf-8", errors="replace")
+        else:
+            attrs = ""
         if (
-            showrc == 0
-            and (
-                "filter=lfs" in attrs
-                or "diff=lfs" in attrs
-                or "merge=lfs" in attrs
-            )
-            and (self.source.use_lfs is None)
-        ):
+            "filter=lfs" in attrs
+            or "diff=lfs" in attrs
+            or "merge=lfs" in attrs
+        ) and (self.source.use_lfs is None):
             self.source.warn(
                 "{}: Git LFS not configured but LFS objects exist".format(
                     self.source
@@ -465,7 +1580,7 @@ class GitTagMirror(SourceFetcher):
                 ),
                 warning_token=WARN_UNUSED_GITLFS,
             )
-        return rc == 0
+        return True
 
     def assert_ref(self):
         if not self.has_ref():
@@ -475,98 +1590,134 @@ class GitTagMirror(SourceFetcher):
                 )
             )
 
-    def latest_commit(self, tracking, *, track_tags, track_args):
+    # Finds the refs to track on each of the branches, along with the time
+    # of their commit.
+    #
+    # All branches are described by the same git processes, so the cost
+    # does not grow with a process per branch.
+    #
+    def latest_commits(self, branches, *, track_tags, track_args):
         if track_tags:
-            exit_code, output = self.source.check_output(
-                [self.source.host_git, "describe", "--tags", "--abbrev=0"]
-                + track_args
-                + [tracking],
-                cwd=self.mirror,
+            refs = []
+            tags = self.describe(
+                ["--tags", "--abbrev=0"] + track_args, branches
             )
-
-            if exit_code == 128:
-                self.source.info(
-                    "Unable to find tag for specified branch name '{}'".format(
-                        tracking
+            for tracking, tag in zip(branches, tags):
+                if tag is None:
+                    self.source.info(
+                        "Unable to find tag for specified branch name '{}'".format(
+                            tracking
+                        )
                     )
-                )
-                _, output = self.source.check_output(
-                    [self.source.host_git, "rev-parse", tracking],
-                    fail="Unable to find commit for specified branch name '{}'".format(
-                        tracking
-                    ),
-                    cwd=self.mirror,
-                )
-            tracking = output.rstrip("\n")
+                    tag = self.rev_parse(tracking)
+                refs.append(tag)
 
         else:
-            _, output = self.source.check_output(
-                [self.source.host_git, "rev-parse", tracking],
-                fail="Unable to find commit for specified branch name '{}'".format(
-                    tracking
-                ),
-                cwd=self.mirror,
-            )
-
-        ref = output.rstrip("\n")
+            refs = [self.rev_parse(tracking) for tracking in branches]
 
-        # Prefix the ref with the closest annotated tag, if available,
-        # to make the ref human readable
-        exit_code, output = self.source.check_output(
-            [
-                self.source.host_git,
-                "describe",
-                "--tags",
-                "--abbrev=40",
-                "--long",
-            ]
-            + track_args
-            + [ref],
-            cwd=self.mirror,
+        # Prefix the refs with the closest annotated tag, if available,
+        # to make the refs human readable
+        descriptions = self.describe(
+            ["--tags", "--abbrev=40", "--long"] + track_args, refs
         )
-        if exit_code == 0:
-            ref = output.rstrip("\n")
+        refs = [
+            ref if description is None else description
+            for ref, description in zip(refs, descriptions)
+        ]
 
-        # Find the time of the commit to avoid stepping onto an older tag
+        # Find the time of the commits to avoid stepping onto an older tag
         # on a different branch
-        _, time = self.source.check_output(
-            [self.source.host_git, "show", "-s", "--format=%ct", ref],
+        return [(ref, self.commit_time(ref)) for ref in refs]
+
+    # Runs 'git describe' on all names at once, returning the description
+    # of each name, or None if it could not be described
+    def describe(self, options, names):
+        exit_code, output = self.source.check_output(
+            [self.source.host_git, "describe"] + options + names,
             cwd=self.mirror,
         )
+        if exit_code == 0:
+            descriptions = output.splitlines()
+            if len(descriptions) == len(names):
+                return descriptions
 
-        return ref, time
+        # git stops at the first name which cannot be described
+        descriptions = []
+        for name in names:
+            exit_code, output = self.source.check_output(
+                [self.source.host_git, "describe"] + options + [name],
+                cwd=self.mirror,
+            )
+            if exit_code == 0:
+                descriptions.append(output.rstrip("\n"))
+            else:
+                descriptions.append(None)
+
+        return descriptions
+
+    # Returns the committer time of the commit of a ref
+    def commit_time(self, ref):
+        commit = self.cat_file("{}^{{commit}}".format(ref), self.mirror)
+        if commit is not None:
+            for line in commit[2].split(b"\n"):
+                if not line:
+                    break
+                if line.startswith(b"committer "):
+                    return line.split()[-2].decode()
+
+        return None
+
+    # Resolves the name of a branch or tag like 'git rev-parse'
+    def rev_parse(self, tracking):
+        obj = self.cat_file(tracking, self.mirror)
+        if obj is None:
+            raise SourceError(
+                "{}: Unable to find commit for specified branch name '{}'".format(
+                    self.source, tracking
+                )
+            )
+        return obj[0]
 
     def stage(self, directory):
         fullpath = os.path.join(directory, self.path)
 
         mirror = self.mirror_path()
 
-        # We need to pass '--no-hardlinks' because there's nothing to
-        # stop the build from overwriting the files in the .git directory
-        # inside the sandbox.
-        self.source.call(
-            [
-                self.source.host_git,
-                "clone",
-                "--no-checkout",
-                "--no-hardlinks",
-                mirror,
-                fullpath,
-            ],
-            fail="Failed to create git mirror {} in directory: {}".format(
-                mirror, fullpath
-            ),
-            fail_temporarily=True,
-        )
-
-        if self.source.use_lfs:
-            self.set_origin_url(directory)
-
         ## This turns git-lfs off if it is installed but we dont want to use it.
         my_env = os.environ.copy()
         if not self.source.use_lfs:
             my_env["GIT_LFS_SKIP_SMUDGE"] = "TRUE"
 
+        if self.source.stage_git_dir == "none":
+            self.export_tree(mirror, fullpath, my_env)
+            return
+
+        if self.source.stage_git_dir == "shallow":
+            self.shallow_clone(mirror, fullpath)
+        else:
+            # We need to pass '--no-hardlinks' because there's nothing to
+            # stop the build from overwriting the files in the .git directory
+            # inside the sandbox. '--dissociate' copies the objects borrowed
+            # from the object store, which is not available in the sandbox.
+            self.source.call(
+                [
+                    self.source.host_git,
+                    "clone",
+                    "--no-checkout",
+                    "--no-hardlinks",
+                    "--dissociate",
+                    mirror,
+                    fullpath,
+                ],
+                fail="Failed to create git mirror {} in directory: {}".format(
+                    mirror, fullpath
+                ),
+                fail_temporarily=True,
+            )
+
+        if self.source.use_lfs:
+            self.set_origin_url(directory)
+
         self.source.call(
             [self.source.host_git, "checkout", "--force", self.ref],
             fail="Failed to checkout git ref {}".format(self.ref),
@@ -574,6 +1725,117 @@ class GitTagMirror(SourceFetcher):
             cwd=fullpath,
         )
 
+    # Checks out the tree at the ref from the mirror, without creating
+    # a repository. The index is only used temporarily.
+    #
+    def export_tree(self, mirror, fullpath, env):
+        os.makedirs(fullpath, exist_ok=True)
+
+        with self.source.tempdir() as tmpdir:
+            env = dict(env, GIT_INDEX_FILE=os.path.join(tmpdir, "index"))
+
+            self.source.call(
+                [self.source.host_git, "read-tree", self.ref],
+                fail="Failed to read tree of git ref {}".format(self.ref),
+                env=env,
+                cwd=mirror,
+            )
+
+            self.source.call(
+                [
+                    self.source.host_git,
+                    "--git-dir",
+                    mirror,
+                    "--work-tree",
+                    fullpath,
+                    "checkout-index",
+                    "--all",
+                    "--force",
+                ],
+                fail="Failed to export git ref {} to directory: {}".format(
+                    self.ref, fullpath
+                ),
+                env=env,
+                cwd=fullpath,
+            )
+
+    # Creates a repository containing only the commit of the ref, the
+    # tags pointing at it and the history back to the nearest tags found
+    # by 'git describe' in the mirror, so that it describes the commit
+    # the same way.
+    #
+    def shallow_clone(self, mirror, fullpath):
+        _, commit = self.source.check_output(
+            [
+                self.source.host_git,
+                "rev-parse",
+                "--verify",
+                "{}^{{commit}}".format(self.ref),
+            ],
+            fail="Failed to resolve git ref {}".format(self.ref),
+            cwd=mirror,
+        )
+        commit = commit.rstrip("\n")
+        _, tags = self.source.check_output(
+            [self.source.host_git, "tag", "--points-at", commit],
+            fail="Failed to list tags of git ref {}".format(self.ref),
+            cwd=mirror,
+        )
+        tags = set(tags.splitlines())
+
+        # Describing with annotated tags only may find a farther tag
+        depth = 1
+        for options in [["--long"], ["--tags", "--long"]]:
+            exit_code, description = self.source.check_output(
+                [self.source.host_git, "describe", "--abbrev=40"]
+                + options
+                + [commit],
+                cwd=mirror,
+            )
+            m = re.match(
+                r"(?P<tag>.*)-(?P<distance>[0-9]+)-g[0-9a-f]{40}$",
+                description.rstrip("\n"),
+            )
+            if exit_code == 0 and m:
+                tags.add(m.group("tag"))
+                depth = max(depth, int(m.group("distance")) + 1)
+
+        self.source.call(
+            [self.source.host_git, "init", "--quiet", fullpath],
+            fail="Failed to init git repository in directory: {}".format(
+                fullpath
+            ),
+        )
+
+        self.source.call(
+            [self.source.host_git, "remote", "add", "origin", mirror],
+            fail='Failed to add remote origin "{}"'.format(mirror),
+            cwd=fullpath,
+        )
+
+        # Fetching a commit which is not advertised needs protocol v2
+        self.source.call(
+            [
+                self.source.host_git,
+                "-c",
+                "protocol.version=2",
+                "fetch",
+                "--depth={}".format(depth),
+                "--no-tags",
+                "file://{}".format(mirror),
+                commit,
+            ]
+            + [
+                "+refs/tags/{tag}:refs/tags/{tag}".format(tag=tag)
+                for tag in sorted(tags)
+            ],
+            fail="Failed to fetch git ref {} from mirror {}".format(
+                self.ref, mirror
+            ),
+            fail_temporarily=True,
+            cwd=fullpath,
+        )
+
     def init_workspace(self, directory):
         fullpath = os.path.join(directory, self.path)
         url = self.source.translate_url(self.url, primary=self.primary)
@@ -583,6 +1845,7 @@ class GitTagMirror(SourceFetcher):
                 self.source.host_git,
                 "clone",
                 "--no-checkout",
+                "--dissociate",
                 self.mirror,
                 fullpath,
             ],
@@ -614,20 +1877,18 @@ class GitTagMirror(SourceFetcher):
         mirror = self.mirror_path()
 
         modules = "{}:{}".format(self.ref, GIT_MODULES)
-        exit_code, output = self.source.check_output(
-            [self.source.host_git, "show", modules], cwd=mirror
-        )
+        modules_object = self.cat_file(modules, mirror)
 
-        # If git show reports error code 128 here, we take it to mean there is
-        # no .gitmodules file to display for the given revision.
-        if exit_code == 128:
+        # There is no .gitmodules file for the given revision
+        if modules_object is None:
             return
-        elif exit_code != 0:
+        elif modules_object[1] != "blob":
             raise SourceError(
                 "{plugin}: Failed to show gitmodules at ref {ref}".format(
                     plugin=self, ref=self.ref
                 )
             )
+        output = modules_object[2].decode("utf-8", errors="replace")
 
         content = "\n".join([l.strip() for l in output.splitlines()])
 
@@ -646,53 +1907,134 @@ class GitTagMirror(SourceFetcher):
     # Fetch the ref which this mirror requires its submodule to have,
     # at the given ref of this mirror.
     def submodule_ref(self, submodule, ref=None):
+        submodule_commit = self.submodule_commits([submodule], ref).get(
+            submodule
+        )
+        if submodule_commit is None:
+            self.warn_inconsistent_submodule(submodule)
+
+        return submodule_commit
+
+    # Maps the given submodule paths to the commits recorded in the tree
+    # of the ref, with a single ls-tree. Paths which are not submodules
+    # in the tree are left out.
+    def submodule_commits(self, submodules, ref=None):
         if not ref:
             ref = self.ref
 
         mirror = self.mirror_path()
 
         # list objects in the parent repo tree to find the commit
-        # object that corresponds to the submodule
+        # objects that correspond to the submodules
         _, output = self.source.check_output(
-            [self.source.host_git, "ls-tree", ref, submodule],
-            fail="ls-tree failed for commit {} and submodule: {}".format(
-                ref, submodule
+            [self.source.host_git, "ls-tree", "-z", ref, "--"] + submodules,
+            fail="ls-tree failed for commit {} and submodules: {}".format(
+                ref, ", ".join(submodules)
             ),
             cwd=mirror,
         )
 
-        # read the commit hash from the output
-        fields = output.split()
-        if len(fields) >= 2 and fields[1] == "commit":
-            submodule_commit = output.split()[2]
+        commits = {}
+        for entry in output.split("\0"):
+            if not entry:
+                continue
 
-            # fail if the commit hash is invalid
-            if len(submodule_commit) != 40:
-                raise SourceError(
-                    "{}: Error reading commit information for submodule '{}'".format(
-                        self.source, submodule
+            # read the commit hash from the output
+            fields, path = entry.split("\t", 1)
+            fields = fields.split()
+            if len(fields) >= 3 and fields[1] == "commit":
+                submodule_commit = fields[2]
+
+                # fail if the commit hash is invalid
+                if len(submodule_commit) != 40:
+                    raise SourceError(
+                        "{}: Error reading commit information for submodule '{}'".format(
+                            self.source, path
+                        )
                     )
-                )
 
-            return submodule_commit
+                commits[path] = submodule_commit
 
-        else:
-            detail = (
-                "The submodule '{}' is defined either in the BuildStream source\n".format(
-                    submodule
-                )
-                + "definition, or in a .gitmodules file. But the submodule was never added to the\n"
-                + "underlying git repository with `git submodule add`."
+        return commits
+
+    def warn_inconsistent_submodule(self, submodule):
+        detail = (
+            "The submodule '{}' is defined either in the BuildStream source\n".format(
+                submodule
             )
+            + "definition, or in a .gitmodules file. But the submodule was never added to the\n"
+            + "underlying git repository with `git submodule add`."
+        )
 
-            self.source.warn(
-                "{}: Ignoring inconsistent submodule '{}'".format(
-                    self.source, submodule
-                ),
-                detail=detail,
+        self.source.warn(
+            "{}: Ignoring inconsistent submodule '{}'".format(
+                self.source, submodule
+            ),
+            detail=detail,
+        )
+
+    # List the submodules (path, url, commit) of the ref, where commit is
+    # None for submodules missing from the tree.
+    #
+    # The table only depends on the commit, so it is computed once and
+    # kept in memory and in the mirror directory.
+    #
+    def submodule_table(self):
+        # Refs produced by tracking name the commit
+        m = re.search(r"(?:^|-g)(?P<commit>[0-9a-f]{40})$", self.ref)
+        if m:
+            commit = m.group("commit")
+        else:
+            self.ensure_fetchable()
+            _, commit = self.source.check_output(
+                [
+                    self.source.host_git,
+                    "rev-parse",
+                    "--verify",
+                    "{}^{{commit}}".format(self.ref),
+                ],
+                fail="Failed to resolve git ref {}".format(self.ref),
+                cwd=self.mirror_path(),
             )
+            commit = commit.rstrip("\n")
 
-            return None
+        key = (utils.url_directory_name(self.url), commit)
+        cache_file = os.path.join(
+            self.source.get_mirror_directory(),
+            "submodules",
+            key[0],
+            "{}.json".format(commit),
+        )
+
+        with _submodule_tables_lock:
+            table = _submodule_tables.get(key)
+        if table is not None:
+            return table
+
+        try:
+            with open(cache_file, "r") as f:
+                table = json.load(f)
+        except (OSError, ValueError):
+            self.ensure_fetchable()
+            submodules = list(self.submodule_list())
+            if submodules:
+                commits = self.submodule_commits(
+                    [path for path, _ in submodules]
+                )
+            else:
+                commits = {}
+            table = [
+                [path, url, commits.get(path)] for path, url in submodules
+            ]
+
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with utils.save_file_atomic(cache_file, "w") as f:
+                json.dump(table, f)
+
+        with _submodule_tables_lock:
+            _submodule_tables[key] = table
+
+        return table
 
     # Git-lfs can not retrieve objects from a file based directory, it needs something like github or gitlab
     # to serve them. This function can be used when gitlfs is requested to set the checkout repo to point to
@@ -732,11 +2074,81 @@ class GitTagSource(Source):
             "exclude",
             "full-clone",
             "use-lfs",
+            "ls-remote-cache-ttl",
+            "object-store",
+            "object-store-name",
+            "stage-git-dir",
+            "clone-filter",
+            "incremental-shallow",
+            "bundle-dir",
+            "submodule-threads",
+            "max-host-connections",
+            "maintenance-max-packs",
+            "maintenance-max-loose-objects",
         ]
         node.validate_keys(config_keys + Source.COMMON_CONFIG_KEYS)
 
         self.original_url = node.get_str("url")
         self.full_clone = node.get_bool("full-clone", False)
+        self.ls_remote_cache_ttl = node.get_int("ls-remote-cache-ttl", 0)
+        if self.ls_remote_cache_ttl < 0:
+            raise SourceError(
+                "{}: ls-remote-cache-ttl must not be negative".format(
+                    node.get_scalar("ls-remote-cache-ttl").get_provenance()
+                )
+            )
+        self.object_store = node.get_bool("object-store", False)
+        self.object_store_name = node.get_str("object-store-name", None)
+        self.clone_filter = node.get_str("clone-filter", None)
+        if self.object_store and self.clone_filter:
+            raise SourceError(
+                "{}: clone-filter cannot be used with object-store".format(
+                    node.get_scalar("clone-filter").get_provenance()
+                )
+            )
+        self.incremental_shallow = node.get_bool("incremental-shallow", False)
+        self.bundle_dir = node.get_str("bundle-dir", None)
+        if self.bundle_dir:
+            self.bundle_dir = os.path.expanduser(self.bundle_dir)
+        self.submodule_threads = node.get_int("submodule-threads", 4)
+        if self.submodule_threads < 1:
+            raise SourceError(
+                "{}: submodule-threads must be at least 1".format(
+                    node.get_scalar("submodule-threads").get_provenance()
+                )
+            )
+        self.max_host_connections = node.get_int("max-host-connections", 4)
+        if self.max_host_connections < 1:
+            raise SourceError(
+                "{}: max-host-connections must be at least 1".format(
+                    node.get_scalar("max-host-connections").get_provenance()
+                )
+            )
+        self.maintenance_max_packs = node.get_int("maintenance-max-packs", 20)
+        if self.maintenance_max_packs < 0:
+            raise SourceError(
+                "{}: maintenance-max-packs must not be negative".format(
+                    node.get_scalar("maintenance-max-packs").get_provenance()
+                )
+            )
+        self.maintenance_max_loose_objects = node.get_int(
+            "maintenance-max-loose-objects", 1000
+        )
+        if self.maintenance_max_loose_objects < 0:
+            raise SourceError(
+                "{}: maintenance-max-loose-objects must not be negative".format(
+                    node.get_scalar(
+                        "maintenance-max-loose-objects"
+                    ).get_provenance()
+                )
+            )
+        self.stage_git_dir = node.get_str("stage-git-dir", "full")
+        if self.stage_git_dir not in ["full", "shallow", "none"]:
+            raise SourceError(
+                '{}: stage-git-dir must be "full", "shallow" or "none"'.format(
+                    node.get_scalar("stage-git-dir").get_provenance()
+                )
+            )
         self.mirror = GitTagMirror(
             self, "", self.original_url, ref, primary=True
         )
@@ -752,6 +2164,12 @@ class GitTagSource(Source):
             self.use_lfs = node.get_bool("use-lfs", False)
         else:
             self.use_lfs = None
+        if self.use_lfs and self.stage_git_dir == "none":
+            raise SourceError(
+                "{}: use-lfs needs a git directory to fetch LFS objects, which stage-git-dir 'none' does not stage".format(
+                    node.get_scalar("use-lfs").get_provenance()
+                )
+            )
 
         # At this point we now know if the source has a ref and/or a track.
         # If it is missing both then we will be unable to track or build.
@@ -819,6 +2237,9 @@ class GitTagSource(Source):
         if self.use_lfs:
             key.append("use-lfs")
 
+        if self.stage_git_dir != "full":
+            key.append({"stage-git-dir": self.stage_git_dir})
+
         return key
 
     def is_cached(self):
@@ -859,20 +2280,12 @@ class GitTagSource(Source):
             branches = [self.tracking] + self.track_extra
 
             # Find new candidate refs from self.tracking branches
-            #
-            # As we are constructing a dict from the returned tuples of a
-            # function, so directly constructing with dict() is nicer than dict
-            # comprehension
-            # pylint: disable=consider-using-dict-comprehension
             candidates = dict(
-                [
-                    self.mirror.latest_commit(
-                        branch,
-                        track_tags=self.track_tags,
-                        track_args=track_args,
-                    )
-                    for branch in branches
-                ]
+                self.mirror.latest_commits(
+                    branches,
+                    track_tags=self.track_tags,
+                    track_args=track_args,
+                )
             )
 
             # Find latest candidate ref from all branches
@@ -890,8 +2303,9 @@ class GitTagSource(Source):
             'Setting up workspace "{}"'.format(directory), silent_nested=True
         ):
             self.mirror.init_workspace(directory)
-            for mirror in self.submodules:
-                mirror.init_workspace(directory)
+            self.map_submodules(
+                lambda mirror: mirror.init_workspace(directory)
+            )
 
     def stage(self, directory):
 
@@ -908,18 +2322,96 @@ class GitTagSource(Source):
             "Staging {}".format(self.mirror.url), silent_nested=True
         ):
             self.mirror.stage(directory)
-            for mirror in self.submodules:
-                mirror.stage(directory)
+            self.map_submodules(lambda mirror: mirror.stage(directory))
 
     def get_source_fetchers(self):
         yield self.mirror
         self.refresh_submodules()
+        self.prefetch_submodules()
         for submodule in self.submodules:
             yield submodule
 
     ###########################################################
     #                     Local Functions                     #
     ###########################################################
+
+    # Calls func for each submodule mirror, concurrently with
+    # submodule-threads
+    def map_submodules(self, func):
+        if self.submodule_threads == 1 or len(self.submodules) < 2:
+            for mirror in self.submodules:
+                func(mirror)
+            return
+
+        for future in self.run_concurrently(func, self.submodules):
+            # Raise the errors
+            future.result()
+
+    # Calls func for each of the mirrors in worker threads, and returns
+    # the futures of the calls once they are all done.
+    #
+    # The mirrors run with a _WorkerSource, whose messages are sent from
+    # the calling thread. Their git processes are suspended, resumed and
+    # killed with the job, and killed if the calling thread is
+    # interrupted, after which the calls fail to run git.
+    #
+    def run_concurrently(self, func, mirrors):
+        processes = _WorkerProcesses()
+        with self.tempdir() as tmpdir:
+            workers = [_WorkerSource(self, tmpdir, processes) for _ in mirrors]
+            try:
+                with ThreadPoolExecutor(
+                    self.submodule_threads
+                ) as executor, processes.handle_signals():
+                    futures = [
+                        executor.submit(func, mirror.with_source(worker))
+                        for mirror, worker in zip(mirrors, workers)
+                    ]
+                    # The signals received by the worker threads are only
+                    # handled once this thread wakes up
+                    while wait(futures, timeout=0.1).not_done:
+                        pass
+            finally:
+                for worker in workers:
+                    worker.send_messages()
+
+        return futures
+
+    # Fetches the submodules concurrently, with at most
+    # max-host-connections per host, before their fetchers are used.
+    # Failures are left for the fetchers to report, as they also try
+    # the mirrors of the aliases.
+    def prefetch_submodules(self):
+        if self.submodule_threads == 1:
+            return
+
+        pending = [
+            mirror
+            for mirror in self.submodules
+            if not mirror.has_ref_objects()
+        ]
+        if len(pending) < 2:
+            return
+
+        host_limits = {}
+        mirror_limits = {}
+        for mirror in pending:
+            host = _url_host(self.translate_url(mirror.url, primary=False))
+            if host not in host_limits:
+                host_limits[host] = threading.BoundedSemaphore(
+                    self.max_host_connections
+                )
+            mirror_limits[mirror.url] = host_limits[host]
+
+        def prefetch(mirror):
+            with mirror_limits[mirror.url]:
+                mirror.prefetch()
+
+        with self.timed_activity(
+            "Fetching {} submodules".format(len(pending)), silent_nested=True
+        ):
+            self.run_concurrently(prefetch, pending)
+
     def have_all_refs(self):
         if not self.mirror.has_ref():
             return False
@@ -940,14 +2432,13 @@ class GitTagSource(Source):
     # Assumes that we have our mirror and we have the ref which we point to
     #
     def refresh_submodules(self):
-        self.mirror.ensure_fetchable()
         submodules = []
 
         # XXX Here we should issue a warning if either:
         #   A.) A submodule exists but is not defined in the element configuration
         #   B.) The element configuration configures submodules which dont exist at the current ref
         #
-        for path, url in self.mirror.submodule_list():
+        for path, url, ref in self.mirror.submodule_table():
 
             # Completely ignore submodules which are disabled for checkout
             if self.ignore_submodule(path):
@@ -959,8 +2450,9 @@ class GitTagSource(Source):
             if override_url:
                 url = override_url
 
-            ref = self.mirror.submodule_ref(path)
-            if ref is not None:
+            if ref is None:
+                self.mirror.warn_inconsistent_submodule(path)
+            else:
                 mirror = GitTagMirror(self, path, url, ref)
                 submodules.append(mirror)
 
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+#
+# Benchmark of the layer operations of the oci element.
+#
+# This synthesises a parent and a child root file system, with a
+# configurable number of files and sizes, and measures the steps the
+# oci element goes through when building an image:
+#
+#   tar        Exporting the child tree to an uncompressed tar
+#   layer      Building the complete layer blob of the child tree,
+#              with the diff_id, compressed per mode
+#   whiteout   Indexing both trees and computing their difference
+#   relayer    Unpacking the parent layer blob into a new tree
+#
+# The layer and relayer steps run the methods of the element itself,
+# configured from the command line options.
+#
+# Each step runs in a forked process, which reports its time along
+# with the bytes read and written from /proc/self/io when available.
+# The peak RSS of the process is taken when it exits, so it does not
+# carry over from previous steps. The trees are generated from a seed,
+# so runs are comparable.
+#
+# Usage:
+#
+#   python3 tests/benchmarks/oci_benchmark.py --files 20000 --size 8192
+#
+# Run with --help for all options. Results can be saved with --json
+# to compare runs before upgrading the plugin.
+#
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+import traceback
+import types
+
+from buildstream.storage import FileBasedDirectory
+
+from bst_plugins_experimental.elements import oci
+
+
+# The oci element, configured from the command line options instead
+# of a project
+class _BenchmarkElement(oci.OciElement):
+    # pylint: disable=super-init-not-called
+    def __init__(self, args, mode, tmpdir):
+        self.mode = mode
+        if args.compression:
+            self.compression = args.compression
+        elif mode == "oci":
+            self.compression = "gzip"
+        else:
+            self.compression = "none"
+        self.blob_compression = oci._layer_compression(
+            oci._LAYER_MEDIA_TYPES[self.compression]
+        )
+        self.gzip_level = args.gzip_level
+        self.zstd_level = 3
+        self.parallel_compression = args.threads != 1
+        self.compression_threads = args.threads or os.cpu_count() or 1
+        self._tmpdir = tmpdir
+
+    def __del__(self):
+        pass
+
+    def _get_context(self):
+        return types.SimpleNamespace(tmpdir=self._tmpdir)
+
+
+class _NullWriter:
+    def write(self, data):
+        return len(data)
+
+    def tell(self):
+        return 0
+
+
+def _io_counters():
+    counters = {}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                counters[key] = int(value)
+    except OSError:
+        pass
+    return counters
+
+
+def _measure(results, name, mode, func):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 1
+        try:
+            before = _io_counters()
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            after = _io_counters()
+
+            result = {"step": name, "mode": mode, "seconds": round(elapsed, 4)}
+            for key in ["read_bytes", "write_bytes", "rchar", "wchar"]:
+                if key in before and key in after:
+                    result[key] = after[key] - before[key]
+            with os.fdopen(write_fd, "w") as f:
+                json.dump(result, f)
+            status = 0
+        except BaseException:  # pylint: disable=broad-except
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        data = f.read()
+    _, status, rusage = os.wait4(pid, 0)
+    if status != 0:
+        raise RuntimeError("Step {} failed for {}".format(name, mode))
+
+    result = json.loads(data)
+    # Kilobytes on Linux
+    result["max_rss_kb"] = rusage.ru_maxrss
+    results.append(result)
+
+
+def _random_bytes(rng, size):
+    if not size:
+        return b""
+    # Half random data, half repeated text, to get realistic
+    # compression ratios.
+    half = size // 2
+    data = rng.getrandbits(8 * half).to_bytes(half, "little")
+    text = b"lorem ipsum dolor sit amet "
+    return data + (text * (size // len(text) + 1))[: size - half]
+
+
+def _generate_tree(path, rng, files, size, files_per_dir):
+    names = []
+    for i in range(files):
+        dirname = os.path.join(
+            "dir{}".format(i // (files_per_dir * files_per_dir)),
+            "sub{}".format((i // files_per_dir) % files_per_dir),
+        )
+        os.makedirs(os.path.join(path, dirname), exist_ok=True)
+        name = os.path.join(dirname, "file{}".format(i))
+        # Exponential distribution around the requested mean size
+        file_size = min(int(rng.expovariate(1.0 / size)), size * 64)
+        with open(os.path.join(path, name), "wb") as f:
+            f.write(_random_bytes(rng, file_size))
+        os.utime(os.path.join(path, name), (1320937200, 1320937200))
+        names.append(name)
+    return names
+
+
+# Derive the child tree from the parent: some files are removed, some
+# are modified and some are added.
+def _derive_tree(parent, child, names, rng, size, changes):
+    shutil.copytree(parent, child, symlinks=True)
+    count = int(len(names) * changes)
+    sample = rng.sample(names, min(len(names), 2 * count))
+    for name in sample[:count]:
+        os.unlink(os.path.join(child, name))
+    for name in sample[count:]:
+        with open(os.path.join(child, name), "wb") as f:
+            f.write(_random_bytes(rng, size))
+    os.makedirs(os.path.join(child, "added"), exist_ok=True)
+    for i in range(count):
+        with open(os.path.join(child, "added", "file{}".format(i)), "wb") as f:
+            f.write(_random_bytes(rng, size))
+
+
+# Returns the path of the layer blob in output
+def _build_layer(element, directory, output):
+    state = {
+        "output": output,
+        "layer_descs": [],
+        "diff_ids": [],
+        "legacy_parent": None,
+        "new_layers": 0,
+    }
+    element._build_layer(state, directory, {"os": "linux"})
+    descriptor = state["layer_descs"][0]
+    if element.mode == "docker":
+        return descriptor.split("/")
+    return ["blobs", *descriptor["digest"].split(":", 1)]
+
+
+def _run_mode(args, mode, parent_path, child_path, workdir, results):
+    element = _BenchmarkElement(args, mode, workdir)
+
+    parent = FileBasedDirectory(parent_path)
+    child = FileBasedDirectory(child_path)
+
+    def tar():
+        with tarfile.open(fileobj=_NullWriter(), mode="w|") as t:
+            child.export_to_tar(t, "")
+
+    output_path = os.path.join(workdir, "output-{}".format(mode))
+    os.makedirs(output_path)
+    output = FileBasedDirectory(output_path)
+
+    def layer():
+        _build_layer(element, child, output)
+
+    def whiteout():
+        oci._diff_trees(
+            oci._index_tree(parent),
+            oci._index_tree(child),
+            parent,
+            child,
+        )
+
+    parent_layer = _build_layer(element, parent, output)
+    checkout_path = os.path.join(workdir, "checkout-{}".format(mode))
+    os.makedirs(checkout_path)
+
+    def relayer():
+        element._extract_layer(
+            output, parent_layer, FileBasedDirectory(checkout_path)
+        )
+
+    for _ in range(args.repeat):
+        _measure(results, "tar", mode, tar)
+        _measure(results, "layer", mode, layer)
+        _measure(results, "whiteout", mode, whiteout)
+        shutil.rmtree(checkout_path)
+        os.makedirs(checkout_path)
+        _measure(results, "relayer", mode, relayer)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark layer operations of the oci element"
+    )
+    parser.add_argument(
+        "--files", type=int, default=10000, help="Files in the parent tree"
+    )
+    parser.add_argument(
+        "--size", type=int, default=4096, help="Mean file size in bytes"
+    )
+    parser.add_argument(
+        "--files-per-dir", type=int, default=100, help="Directory fan-out"
+    )
+    parser.add_argument(
+        "--changes",
+        type=float,
+        default=0.1,
+        help="Fraction of files removed, modified and added in the child",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=["oci", "docker", "both"],
+        default="both",
+        help="Image mode",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=sorted(oci._LAYER_MEDIA_TYPES),
+        help="Layer compression, defaults to the default of the mode",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=1, help="Compression threads"
+    )
+    parser.add_argument(
+        "--gzip-level", type=int, default=9, help="gzip compression level"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Repetitions of each step"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument(
+        "--tmpdir", help="Directory for the generated trees and blobs"
+    )
+    args = parser.parse_args()
+
+    if args.mode == "both":
+        modes = ["oci", "docker"]
+    else:
+        modes = [args.mode]
+    if args.compression == "estargz" and "docker" in modes:
+        parser.error("estargz compression is only supported for oci")
+
+    results = []
+    workdir = tempfile.mkdtemp(prefix="oci-benchmark-", dir=args.tmpdir)
+    try:
+        rng = random.Random(args.seed)
+        parent_path = os.path.join(workdir, "parent")
+        child_path = os.path.join(workdir, "child")
+        start = time.perf_counter()
+        names = _generate_tree(
+            parent_path, rng, args.files, args.size, args.files_per_dir
+        )
+        _derive_tree(
+            parent_path, child_path, names, rng, args.size, args.changes
+        )
+        print(
+            "Generated trees in {:.2f}s".format(time.perf_counter() - start),
+            file=sys.stderr,
+        )
+
+        for mode in modes:
+            _run_mode(args, mode, parent_path, child_path, workdir, results)
+    finally:
+        shutil.rmtree(workdir)
+
+    columns = ["step", "mode", "seconds", "max_rss_kb", "rchar", "wchar"]
+    print("  ".join("{:>12}".format(c) for c in columns))
+    for result in results:
+        print("  ".join("{:>12}".format(result.get(c, "-")) for c in columns))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {"parameters": vars(args), "results": results}, f, indent=2
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,823 @@
+# Pylint doesn't play well with fixtures and dependency injection from pytest
+# pylint: disable=redefined-outer-name
+
+import errno
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import tarfile
+import tempfile
+import types
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from buildstream import _yaml
+from buildstream.exceptions import ErrorDomain
+from buildstream.storage import FileBasedDirectory
+from buildstream.testing import cli  # pylint: disable=unused-import
+
+from bst_plugins_experimental.elements import oci
+
+
+def generate_project(project_dir):
+    _yaml.roundtrip_dump(
+        {
+            "name": "foo",
+            "min-version": "2.0",
+            "plugins": [
+                {
+                    "origin": "pip",
+                    "package-name": "bst-plugins-experimental",
+                    "elements": ["oci"],
+                }
+            ],
+        },
+        os.path.join(project_dir, "project.conf"),
+    )
+
+
+# Writes an import element of the given files, and returns its name
+def generate_layer(project_dir, name, files):
+    create_tree(os.path.join(project_dir, name), files)
+    _yaml.roundtrip_dump(
+        {"kind": "import", "sources": [{"kind": "local", "path": name}]},
+        os.path.join(project_dir, "{}.bst".format(name)),
+    )
+    return "{}.bst".format(name)
+
+
+def generate_image(project_dir, name, layers, images, **config):
+    _yaml.roundtrip_dump(
+        {
+            "kind": "oci",
+            "build-depends": layers,
+            "config": dict(config, images=images),
+        },
+        os.path.join(project_dir, name),
+    )
+
+
+def random_bytes(size, seed=0):
+    if not size:
+        return b""
+    rng = random.Random(seed)
+    return rng.getrandbits(8 * size).to_bytes(size, "little")
+
+
+# Creates the files, symbolic links (as "->target") and directories (as
+# None) of a dict of relative paths, all with the same mtime
+def create_tree(path, entries):
+    os.makedirs(path)
+    for name, content in sorted(entries.items()):
+        fullpath = os.path.join(path, name)
+        if content is None:
+            os.makedirs(fullpath)
+        elif content.startswith("->"):
+            os.symlink(content[2:], fullpath)
+        else:
+            with open(fullpath, "w") as f:
+                f.write(content)
+        os.utime(fullpath, (1320937200, 1320937200), follow_symlinks=False)
+    return FileBasedDirectory(path)
+
+
+# Lists a tree the way create_tree() takes it
+def list_tree(path):
+    entries = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            fullpath = os.path.join(dirpath, name)
+            relpath = os.path.relpath(fullpath, path)
+            if os.path.islink(fullpath):
+                entries[relpath] = "->" + os.readlink(fullpath)
+            elif os.path.isdir(fullpath):
+                entries[relpath] = None
+            else:
+                with open(fullpath) as f:
+                    entries[relpath] = f.read()
+    return entries
+
+
+# The oci element, without a project
+class _Element(oci.OciElement):
+    # pylint: disable=super-init-not-called
+    def __init__(self, tmpdir, compression, compression_threads=1):
+        self.mode = "oci"
+        self.compression = compression
+        self.blob_compression = oci._layer_compression(
+            oci._LAYER_MEDIA_TYPES[compression]
+        )
+        self.gzip_level = 9
+        self.zstd_level = 3
+        self.compression_threads = compression_threads
+        self.parallel_compression = compression_threads != 1
+        self._tmpdir = tmpdir
+
+    def __del__(self):
+        pass
+
+    def _get_context(self):
+        return types.SimpleNamespace(tmpdir=self._tmpdir)
+
+
+# Builds a layer of a tree, and returns its descriptor, its diff_id and
+# its blob
+def build_layer(element, layer):
+    output = FileBasedDirectory(tempfile.mkdtemp(dir=element._tmpdir))
+    state = {
+        "output": output,
+        "layer_descs": [],
+        "diff_ids": [],
+        "legacy_parent": None,
+        "new_layers": 0,
+    }
+    element._build_layer(state, layer, {})
+    (descriptor,) = state["layer_descs"]
+    (diff_id,) = state["diff_ids"]
+    _, hexdigest = descriptor["digest"].split(":", 1)
+    with output.open_file("blobs", "sha256", hexdigest, mode="rb") as f:
+        blob = f.read()
+    return descriptor, diff_id, blob
+
+
+def parallel_gzip(data, level, threads, write_size=7777):
+    out = io.BytesIO()
+    with oci._ParallelGzipWriter(out, level, threads) as writer:
+        for i in range(0, len(data), write_size):
+            writer.write(data[i : i + write_size])
+    return out.getvalue()
+
+
+@pytest.mark.parametrize("level", [1, 6, 9])
+def test_parallel_gzip_reproducible(level):
+    # Blocks of random and repetitive data, with a partial last block
+    block_size = oci._ParallelGzipWriter.BLOCK_SIZE
+    data = (
+        random_bytes(2 * block_size)
+        + b"lorem ipsum " * block_size
+        + random_bytes(1000, seed=1)
+    )
+
+    blobs = [parallel_gzip(data, level, threads) for threads in [1, 2, 7]]
+    assert gzip.decompress(blobs[0]) == data
+    assert len({hashlib.sha256(blob).digest() for blob in blobs}) == 1
+
+
+def test_parallel_gzip_empty():
+    assert gzip.decompress(parallel_gzip(b"", 6, 3)) == b""
+
+
+def test_diff_trees(tmpdir):
+    parent = create_tree(
+        os.path.join(str(tmpdir), "parent"),
+        {
+            "changed": "old",
+            "dir-to-file": None,
+            "dir-to-file/file": "file",
+            "kept": None,
+            "kept/removed": "removed",
+            "kept/same": "same",
+            "link": "->same",
+            "link-changed": "->aaaa",
+            "removed": "removed",
+            "removed-dir": None,
+            "removed-dir/file": "file",
+            "same": "same",
+            "same-size": "aaaa",
+        },
+    )
+    layer = create_tree(
+        os.path.join(str(tmpdir), "layer"),
+        {
+            "added": "added",
+            "changed": "new content",
+            "dir-to-file": "file",
+            "kept": None,
+            "kept/same": "same",
+            "link": "->same",
+            "link-changed": "->bbbb",
+            "same": "same",
+            "same-size": "bbbb",
+        },
+    )
+
+    whiteouts, duplicates = oci._diff_trees(
+        oci._index_tree(parent), oci._index_tree(layer), parent, layer
+    )
+
+    # Only the top-most removed paths, and not the content of
+    # directories replaced by files
+    assert whiteouts == [("kept", "removed"), ("removed",), ("removed-dir",)]
+    assert duplicates == [("kept", "same"), ("link",), ("same",)]
+
+
+def test_estargz(monkeypatch):
+    monkeypatch.setattr(oci, "_ESTARGZ_CHUNK_SIZE", 1000)
+    files = {
+        "dir/small": b"hello",
+        "dir/big": random_bytes(2500),
+        "empty": b"",
+    }
+
+    blob = io.BytesIO()
+    estargz = oci._EstargzWriter(blob, 9)
+    stream = oci._LayerStream(blob, estargz)
+    with oci._EstargzTarFile(estargz, fileobj=stream, mode="w") as t:
+        tarinfo = tarfile.TarInfo("dir")
+        tarinfo.type = tarfile.DIRTYPE
+        t.addfile(tarinfo)
+        for name, content in files.items():
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.size = len(content)
+            t.addfile(tarinfo, io.BytesIO(content))
+        tarinfo = tarfile.TarInfo("link")
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = "empty"
+        t.addfile(tarinfo)
+    stream.close()
+    blob = blob.getvalue()
+
+    # The members make a single valid tar
+    layer = gzip.decompress(blob)
+    assert stream.diff_id() == "sha256:{}".format(
+        hashlib.sha256(layer).hexdigest()
+    )
+    with tarfile.open(fileobj=io.BytesIO(layer)) as t:
+        assert t.getnames() == [
+            ".no.prefetch.landmark",
+            "dir",
+            "dir/small",
+            "dir/big",
+            "empty",
+            "link",
+            "stargz.index.json",
+        ]
+
+    # The footer points to the member of the table of content
+    footer = blob[-51:]
+    assert gzip.decompress(footer) == b""
+    assert footer[16:32] == "{:016x}".format(estargz.toc_offset).encode()
+    toc_tar = zlib.decompressobj(31).decompress(blob[estargz.toc_offset :])
+    with tarfile.open(fileobj=io.BytesIO(toc_tar)) as t:
+        toc_data = t.extractfile("stargz.index.json").read()
+    annotations = estargz.annotations()
+    assert annotations["containerd.io/snapshot/stargz/toc.digest"] == (
+        "sha256:{}".format(hashlib.sha256(toc_data).hexdigest())
+    )
+    assert annotations["io.containers.estargz.uncompressed-size"] == str(
+        len(layer)
+    )
+
+    # Each chunk of content is a member of its own
+    entries = json.loads(toc_data.decode())["entries"]
+    files[".no.prefetch.landmark"] = b"\x0f"
+    chunks = {}
+    for entry in entries:
+        if entry["type"] not in ("reg", "chunk") or not entry.get("size", 1):
+            continue
+        content = files[entry["name"]]
+        start = entry.get("chunkOffset", 0)
+        end = start + entry.get("chunkSize", len(content) - start)
+        # Followed by the padding and next headers in the same member
+        member = zlib.decompressobj(31).decompress(blob[entry["offset"] :])
+        assert member[: end - start] == content[start:end]
+        assert entry["chunkDigest"] == "sha256:{}".format(
+            hashlib.sha256(content[start:end]).hexdigest()
+        )
+        chunks.setdefault(entry["name"], []).append(start)
+    assert chunks == {
+        ".no.prefetch.landmark": [0],
+        "dir/small": [0],
+        "dir/big": [0, 1000, 2000],
+    }
+
+    digests = {
+        entry["name"]: entry.get("digest")
+        for entry in entries
+        if entry["type"] == "reg"
+    }
+    assert digests == {
+        name: (
+            "sha256:{}".format(hashlib.sha256(content).hexdigest())
+            if content
+            else None
+        )
+        for name, content in files.items()
+    }
+
+
+def test_split_layer(tmpdir):
+    layer = create_tree(
+        os.path.join(str(tmpdir), "layer"),
+        {
+            "empty-dir": None,
+            "etc": None,
+            "etc/conf": "x" * 5,
+            "usr": None,
+            "usr/bin": None,
+            "usr/bin/tool": "x" * 10,
+            "usr/lib": "->bin",
+            "usr/share": None,
+            "usr/share/doc": None,
+            "usr/share/doc/big": "x" * 50,
+            "usr/share/doc/readme": "x" * 30,
+        },
+    )
+    index = oci._index_tree(layer)
+
+    # Directories with content are created along with it
+    assert oci._split_layer(index, [], 0) == [
+        {
+            "empty-dir",
+            "etc/conf",
+            "usr/bin/tool",
+            "usr/lib",
+            "usr/share/doc/big",
+            "usr/share/doc/readme",
+        }
+    ]
+
+    # The content of the paths comes last, and files larger than the
+    # maximum size get a layer of their own
+    assert oci._split_layer(index, ["/usr/share/"], 40) == [
+        {"empty-dir", "etc/conf", "usr/bin/tool", "usr/lib"},
+        {"usr/share/doc/big"},
+        {"usr/share/doc/readme"},
+    ]
+    assert oci._split_layer(index, [], 14) == [
+        {"empty-dir", "etc/conf"},
+        {"usr/bin/tool", "usr/lib"},
+        {"usr/share/doc/big"},
+        {"usr/share/doc/readme"},
+    ]
+
+    # An empty layer is still a layer
+    assert oci._split_layer({}, ["usr"], 10) == [set()]
+
+
+@pytest.mark.parametrize(
+    "compression,threads",
+    [
+        ("none", 1),
+        ("gzip", 1),
+        ("gzip", 4),
+        ("zstd", 1),
+        ("zstd", 4),
+        ("estargz", 1),
+    ],
+)
+def test_build_layer_digests(tmpdir, compression, threads):
+    element = _Element(str(tmpdir), compression, threads)
+    layer = create_tree(
+        os.path.join(str(tmpdir), "layer"),
+        {
+            "dir": None,
+            "dir/big": random_bytes(3 * 1024 * 1024).hex(),
+            "dir/small": "small",
+            "link": "->dir/small",
+        },
+    )
+    descriptor, diff_id, blob = build_layer(element, layer)
+
+    # The digests computed while writing are those of the written data
+    assert descriptor["mediaType"] == oci._LAYER_MEDIA_TYPES[compression]
+    assert descriptor["digest"] == "sha256:{}".format(
+        hashlib.sha256(blob).hexdigest()
+    )
+    assert descriptor["size"] == len(blob)
+    with oci._open_decompressor(
+        io.BytesIO(blob), element.blob_compression
+    ) as f:
+        layer_tar = f.read()
+    assert diff_id == "sha256:{}".format(hashlib.sha256(layer_tar).hexdigest())
+    with tarfile.open(fileobj=io.BytesIO(layer_tar)) as t:
+        names = set(t.getnames()) - oci._ESTARGZ_METADATA
+    assert names == {"dir", "dir/big", "dir/small", "link"}
+
+
+def test_tar_members():
+    layer = io.BytesIO()
+    with tarfile.open(fileobj=layer, mode="w", format=tarfile.PAX_FORMAT) as t:
+        for i in range(100):
+            # Long names need extended headers
+            name = "dir/{}/file{}".format("x" * (i % 3) * 100, i)
+            content = random_bytes(i * 100, seed=i)
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.size = len(content)
+            t.addfile(tarinfo, io.BytesIO(content))
+    layer = layer.getvalue()
+
+    with tarfile.open(fileobj=io.BytesIO(layer), mode="r") as t:
+        expected = [
+            (info.name, t.extractfile(info).read()) for info in t.getmembers()
+        ]
+        header_offset = t.getmembers()[50].offset
+
+    # Content is read while iterating, and members are not recorded
+    with tarfile.open(fileobj=io.BytesIO(layer), mode="r|") as t:
+        members = [
+            (info.name, t.extractfile(info).read())
+            for info in oci._tar_members(t)
+        ]
+        assert len(t.members) <= 1
+    assert members == expected
+
+    # A truncated header is an error, not the end of the archive
+    truncated = layer[: header_offset + 100]
+    with pytest.raises(tarfile.ReadError):
+        with tarfile.open(fileobj=io.BytesIO(truncated), mode="r|") as t:
+            for info in oci._tar_members(t):
+                t.extractfile(info).read()
+
+
+def link_exdev(src, dst):
+    raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+
+@pytest.mark.parametrize("can_link", [True, False])
+def test_extract_layer(tmpdir, monkeypatch, can_link):
+    # Hard links fall back to copies
+    if not can_link:
+        monkeypatch.setattr(os, "link", link_exdev)
+
+    parent = create_tree(
+        os.path.join(str(tmpdir), "parent"),
+        {
+            "dir-to-file": None,
+            "dir-to-file/file": "parent",
+            "file-to-dir": "parent",
+            "kept": None,
+            "kept/parent": "parent",
+            "opaque": None,
+            "opaque/parent": "parent",
+            "removed": "parent",
+            "removed-dir": None,
+            "removed-dir/file": "parent",
+            "target": "target",
+        },
+    )
+
+    def add_entry(t, name, content=None, **attrs):
+        tarinfo = tarfile.TarInfo(name)
+        for key, value in attrs.items():
+            setattr(tarinfo, key, value)
+        if content is not None:
+            tarinfo.size = len(content)
+            content = io.BytesIO(content)
+        t.addfile(tarinfo, content)
+
+    hostdir = os.path.join(str(tmpdir), "host")
+    os.makedirs(hostdir)
+    with open(os.path.join(hostdir, "secret"), "w") as f:
+        f.write("secret")
+
+    outputdir = os.path.join(str(tmpdir), "output")
+    os.makedirs(outputdir)
+    with gzip.open(os.path.join(outputdir, "layer"), "wb") as f:
+        with tarfile.open(fileobj=f, mode="w|") as t:
+            add_entry(t, ".wh.removed", b"")
+            add_entry(t, ".wh.removed-dir", b"")
+            add_entry(t, "opaque/.wh..wh..opq", b"")
+            add_entry(t, "opaque/layer", b"layer")
+            add_entry(t, "kept/layer", b"layer")
+            add_entry(t, "dir-to-file", b"layer")
+            add_entry(t, "file-to-dir", type=tarfile.DIRTYPE)
+            add_entry(t, "file-to-dir/file", b"layer")
+            add_entry(t, "new", b"new")
+            add_entry(t, "new-link", type=tarfile.LNKTYPE, linkname="new")
+            add_entry(
+                t, "parent-link", type=tarfile.LNKTYPE, linkname="target"
+            )
+            add_entry(t, "symlink", type=tarfile.SYMTYPE, linkname="target")
+            # Hard links are not resolved through symbolic links
+            add_entry(t, "host", type=tarfile.SYMTYPE, linkname=hostdir)
+            add_entry(
+                t, "host-link", type=tarfile.LNKTYPE, linkname="host/secret"
+            )
+            # Entries outside of the root and eStargz metadata are skipped
+            add_entry(t, "/absolute", b"layer")
+            add_entry(t, "../escaping", b"layer")
+            add_entry(t, "stargz.index.json", b"{}")
+
+    element = _Element(str(tmpdir), "gzip")
+    element._extract_layer(FileBasedDirectory(outputdir), ["layer"], parent)
+
+    assert list_tree(os.path.join(str(tmpdir), "parent")) == {
+        "dir-to-file": "layer",
+        "file-to-dir": None,
+        "file-to-dir/file": "layer",
+        "host": "->" + hostdir,
+        "kept": None,
+        "kept/layer": "layer",
+        "kept/parent": "parent",
+        "new": "new",
+        "new-link": "new",
+        "opaque": None,
+        "opaque/layer": "layer",
+        "parent-link": "target",
+        "symlink": "->target",
+        "target": "target",
+    }
+    assert not os.path.exists(os.path.join(str(tmpdir), "escaping"))
+
+
+def test_zstd_layer(tmpdir):
+    files = {
+        "dir": None,
+        "dir/big": random_bytes(1024 * 1024).hex(),
+        "link": "->dir/big",
+    }
+    layer = create_tree(os.path.join(str(tmpdir), "layer"), files)
+    element = _Element(str(tmpdir), "zstd")
+    descriptor, diff_id, blob = build_layer(element, layer)
+    assert oci._layer_compression(descriptor["mediaType"]) == "zstd"
+
+    # Docker archives do not record the media type of parent layers
+    assert oci._sniff_compression(io.BytesIO(blob)) == "zstd"
+
+    # The layer unpacks to the same tree
+    outputdir = os.path.join(str(tmpdir), "output")
+    os.makedirs(outputdir)
+    with open(os.path.join(outputdir, "layer"), "wb") as f:
+        f.write(blob)
+    parentdir = os.path.join(str(tmpdir), "parent")
+    os.makedirs(parentdir)
+    element._extract_layer(
+        FileBasedDirectory(outputdir), ["layer"], FileBasedDirectory(parentdir)
+    )
+    assert list_tree(parentdir) == files
+
+    # A zstd parent layer is converted for gzip images, with the same
+    # diff_id
+    gzip_blob = io.BytesIO()
+    _Element(str(tmpdir), "gzip")._copy_layer(
+        io.BytesIO(blob), gzip_blob, "zstd"
+    )
+    layer_tar = gzip.decompress(gzip_blob.getvalue())
+    assert diff_id == "sha256:{}".format(hashlib.sha256(layer_tar).hexdigest())
+
+
+def test_import_parent_blob(tmpdir):
+    parent = create_tree(
+        os.path.join(str(tmpdir), "parent"), {"layer.tar": "layer"}
+    )
+    outputdir = os.path.join(str(tmpdir), "output")
+    os.makedirs(outputdir)
+    output = FileBasedDirectory(outputdir)
+
+    # The blob is imported by reference under the given digest, with
+    # the descriptor of the parent, and is not read
+    descriptor = {
+        "mediaType": oci._LAYER_MEDIA_TYPES["gzip"],
+        "digest": "sha256:" + "0" * 64,
+        "size": 5,
+        "annotations": {"annotation": "value"},
+    }
+    for _ in range(2):
+        blob = oci.BlobWriter(output, oci._LAYER_MEDIA_TYPES["gzip"])
+        blob.import_file(
+            parent, ["layer.tar"], "0" * 64, 5, descriptor=descriptor
+        )
+        assert blob.descriptor == descriptor
+        assert blob.path == ["blobs", "sha256", "0" * 64]
+    assert list_tree(outputdir) == {
+        "blobs": None,
+        "blobs/sha256": None,
+        "blobs/sha256/" + "0" * 64: "layer",
+    }
+
+
+def test_blob_writer(tmpdir):
+    output = FileBasedDirectory(str(tmpdir))
+    media_type = oci._LAYER_MEDIA_TYPES["none"]
+
+    def create(content):
+        blob = oci.BlobWriter(output, media_type)
+        with blob.create() as f:
+            f.write(content)
+        return blob
+
+    # Identical blobs are only written once
+    blobs = [create(b"blob"), create(b"blob")]
+    blob = oci.BlobWriter(output, media_type)
+    blob.write_bytes(b"blob")
+    blobs.append(blob)
+    hexdigest = hashlib.sha256(b"blob").hexdigest()
+    for blob in blobs:
+        assert blob.descriptor == {
+            "mediaType": media_type,
+            "size": 4,
+            "digest": "sha256:" + hexdigest,
+        }
+    assert list_tree(str(tmpdir)) == {
+        "blobs": None,
+        "blobs/sha256": None,
+        "blobs/sha256/" + hexdigest: "blob",
+    }
+
+    # Concurrent and failed writes each use their own temporary name,
+    # and leave nothing behind
+    with pytest.raises(RuntimeError):
+        with oci.BlobWriter(output, media_type).create() as f:
+            f.write(b"failed")
+            raise RuntimeError()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        contents = [str(i).encode() * 100000 for i in range(32)]
+        list(executor.map(create, contents))
+    blobdir = os.path.join(str(tmpdir), "blobs", "sha256")
+    assert sorted(os.listdir(blobdir)) == sorted(
+        [hexdigest]
+        + [hashlib.sha256(content).hexdigest() for content in contents]
+    )
+    assert os.listdir(str(tmpdir)) == ["blobs"]
+
+
+# Returns the manifest of an image of a checked out oci element
+def image_manifest(checkout, image=0):
+    with open(os.path.join(checkout, "index.json")) as f:
+        index = json.load(f)
+    _, hexdigest = index["manifests"][image]["digest"].split(":", 1)
+    with open(os.path.join(checkout, "blobs", "sha256", hexdigest)) as f:
+        return json.load(f)
+
+
+def test_parent_layer_reused(cli, tmpdir):
+    project = str(tmpdir)
+    generate_project(project)
+    base = generate_layer(project, "base", {"base": "base" * 1000})
+    top = generate_layer(project, "top", {"top": "top"})
+    platform = {"architecture": "amd64", "os": "linux"}
+
+    # A recompressed parent layer would not have the same digest
+    generate_image(
+        project,
+        "parent.bst",
+        [base],
+        [dict(platform, layer=base)],
+        **{"gzip-level": 1}
+    )
+    generate_image(
+        project,
+        "child.bst",
+        ["parent.bst", top],
+        [
+            dict(
+                platform,
+                parent={"element": "parent.bst", "image": 0},
+                layer=top,
+            )
+        ],
+    )
+
+    result = cli.run(project=project, args=["build", "child.bst"])
+    result.assert_success()
+    manifests = []
+    for element in ["parent.bst", "child.bst"]:
+        checkout = os.path.join(project, "checkout-" + element)
+        result = cli.run(
+            project=project,
+            args=["artifact", "checkout", element, "--directory", checkout],
+        )
+        result.assert_success()
+        manifests.append(image_manifest(checkout))
+
+    parent_layer, _ = manifests[1]["layers"]
+    assert parent_layer == manifests[0]["layers"][0]
+
+
+def cache_entries(cache_dir):
+    return sorted(
+        name for name in os.listdir(cache_dir) if not name.startswith(".")
+    )
+
+
+def test_rootfs_cache(tmpdir):
+    cache_dir = os.path.join(str(tmpdir), "cache")
+    cache = oci._RootfsCache(cache_dir, 1024 * 1024 * 1024)
+    rootfs = create_tree(
+        os.path.join(str(tmpdir), "rootfs"),
+        {"dir": None, "dir/file": "file", "link": "->dir/file"},
+    )
+    cache.store(["sha256:a", "sha256:b"], rootfs)
+
+    def load(digests):
+        path = tempfile.mkdtemp(dir=str(tmpdir))
+        loaded = cache.load(digests, FileBasedDirectory(path))
+        return loaded, list_tree(path)
+
+    # The longest cached prefix of the chain is loaded
+    expected = list_tree(os.path.join(str(tmpdir), "rootfs"))
+    assert load(["sha256:a", "sha256:b"]) == (2, expected)
+    assert load(["sha256:a", "sha256:b", "sha256:c"]) == (2, expected)
+
+    # Nothing is loaded once a parent layer changed
+    assert load(["sha256:a", "sha256:c"]) == (0, {})
+    assert load(["sha256:c", "sha256:b"]) == (0, {})
+
+    # Entries which are not complete are discarded
+    (entry,) = cache_entries(cache_dir)
+    with open(os.path.join(cache_dir, entry, "digest"), "w") as f:
+        f.write("corrupt")
+    assert load(["sha256:a", "sha256:b"]) == (0, {})
+    assert cache_entries(cache_dir) == []
+
+
+def test_rootfs_cache_eviction(tmpdir):
+    cache_dir = os.path.join(str(tmpdir), "cache")
+    cache = oci._RootfsCache(cache_dir, 1024 * 1024 * 1024)
+    rootfs = create_tree(
+        os.path.join(str(tmpdir), "rootfs"), {"file": "x" * 1000}
+    )
+
+    keys = {}
+    for name in ["a", "b"]:
+        cache.store(["sha256:" + name], rootfs)
+        keys[name] = cache._keys(["sha256:" + name])[0]
+        entry = os.path.join(cache_dir, keys[name])
+        os.utime(entry, (len(keys), len(keys)))
+    with open(os.path.join(cache_dir, keys["a"], "size")) as f:
+        cache.quota = 2 * int(f.read())
+
+    # Loading an entry marks it as recently used
+    target = tempfile.mkdtemp(dir=str(tmpdir))
+    assert cache.load(["sha256:a"], FileBasedDirectory(target)) == 1
+
+    # The least recently used entry is evicted, never the new one
+    cache.store(["sha256:c"], rootfs)
+    keys["c"] = cache._keys(["sha256:c"])[0]
+    assert cache_entries(cache_dir) == sorted([keys["a"], keys["c"]])
+
+    cache.quota = 1
+    cache.store(["sha256:d"], rootfs)
+    assert cache_entries(cache_dir) == [cache._keys(["sha256:d"])[0]]
+
+
+@pytest.mark.parametrize("size", [0, -1])
+def test_rootfs_cache_size_invalid(cli, tmpdir, size):
+    project = str(tmpdir)
+    generate_project(project)
+    layer = generate_layer(project, "layer", {"file": "file"})
+    generate_image(
+        project,
+        "image.bst",
+        [layer],
+        [{"architecture": "amd64", "os": "linux", "layer": layer}],
+        **{"parent-rootfs-cache": True, "parent-rootfs-cache-size": size}
+    )
+
+    result = cli.run(project=project, args=["show", "image.bst"])
+    result.assert_main_error(ErrorDomain.ELEMENT, None)
+
+
+def test_image_threads_reproducible(cli, tmpdir):
+    project = str(tmpdir)
+    generate_project(project)
+    base = generate_layer(project, "base", {"bin": None, "bin/sh": "sh"})
+    top = generate_layer(project, "top", {"bin": None, "bin/ls": "ls"})
+    other = generate_layer(project, "other", {"etc": None, "etc/os": "os"})
+    platform = {"architecture": "amd64", "os": "linux"}
+    generate_image(project, "base.bst", [base], [dict(platform, layer=base)])
+    parent = {"element": "base.bst", "image": 0}
+    images = [
+        dict(platform, parent=parent, layer=top),
+        dict(platform, layer=other),
+        dict(platform, parent=parent, layer=other),
+        dict(platform, parent=parent),
+    ]
+    for threads in [1, 4]:
+        generate_image(
+            project,
+            "image-{}.bst".format(threads),
+            ["base.bst", base, top, other],
+            images,
+            **{"image-threads": threads}
+        )
+
+    checkouts = []
+    for threads in [1, 4]:
+        element = "image-{}.bst".format(threads)
+        checkout = os.path.join(project, "checkout-{}".format(threads))
+        result = cli.run(project=project, args=["build", element])
+        result.assert_success()
+        result = cli.run(
+            project=project,
+            args=["artifact", "checkout", element, "--directory", checkout],
+        )
+        result.assert_success()
+
+        # Index, manifests, configs and layers
+        files = {}
+        for dirpath, _, filenames in os.walk(checkout):
+            for name in filenames:
+                fullpath = os.path.join(dirpath, name)
+                with open(fullpath, "rb") as f:
+                    files[os.path.relpath(fullpath, checkout)] = f.read()
+        checkouts.append(files)
+
+    assert "index.json" in checkouts[0]
+    assert checkouts[0] == checkouts[1]
@@ -0,0 +1,172 @@
+# Pylint doesn't play well with fixtures and dependency injection from pytest
+# pylint: disable=redefined-outer-name
+
+import hashlib
+import os
+import pytest
+
+from buildstream import _yaml
+from buildstream.exceptions import ErrorDomain
+from buildstream.testing import cli  # pylint: disable=unused-import
+
+REGISTRY_SOURCE = "registry+https://github.com/rust-lang/crates.io-index"
+
+
+def generate_project(project_dir):
+    project_file = os.path.join(project_dir, "project.conf")
+    _yaml.roundtrip_dump(
+        {
+            "name": "foo",
+            "min-version": "2.0",
+            "plugins": [
+                {
+                    "origin": "pip",
+                    "package-name": "bst-plugins-experimental",
+                    "sources": ["cargo"],
+                }
+            ],
+        },
+        project_file,
+    )
+
+
+# Writes a Cargo.lock file with the given packages, as (name, version,
+# fields) tuples, and metadata table
+def generate_lock(project_dir, packages, metadata=None):
+    with open(os.path.join(project_dir, "Cargo.lock"), "w") as f:
+        for name, version, fields in packages:
+            f.write("[[package]]\n")
+            f.write('name = "{}"\n'.format(name))
+            f.write('version = "{}"\n'.format(version))
+            f.write('source = "{}"\n'.format(REGISTRY_SOURCE))
+            for key, value in fields.items():
+                f.write('{} = "{}"\n'.format(key, value))
+            f.write("\n")
+        if metadata:
+            f.write("[metadata]\n")
+            for key, value in metadata.items():
+                f.write('"{}" = "{}"\n'.format(key, value))
+
+
+# Adds crates to a registry directory, and returns their sha256
+def generate_crates(registry, crates):
+    shas = {}
+    for name, version in crates:
+        os.makedirs(os.path.join(registry, name), exist_ok=True)
+        content = "{} {}\n".format(name, version).encode()
+        with open(
+            os.path.join(registry, name, "{}-{}.crate".format(name, version)),
+            "wb",
+        ) as f:
+            f.write(content)
+        shas[(name, version)] = hashlib.sha256(content).hexdigest()
+    return shas
+
+
+def generate_element(project_dir, registry, **config):
+    element = {
+        "kind": "import",
+        "sources": [
+            {"kind": "local", "path": "Cargo.lock"},
+            dict(kind="cargo", url="file://{}".format(registry), **config),
+        ],
+    }
+    _yaml.roundtrip_dump(element, os.path.join(project_dir, "target.bst"))
+
+
+def tracked_ref(project_dir):
+    element = _yaml.roundtrip_load(os.path.join(project_dir, "target.bst"))
+    return element["sources"][1]["ref"]
+
+
+def test_track_concurrent_downloads(cli, tmpdir):
+    project = str(tmpdir.join("project"))
+    registry = str(tmpdir.join("registry"))
+    os.makedirs(project)
+    generate_project(project)
+
+    crates = [("crate{}".format(i), "1.0.{}".format(i)) for i in range(20)]
+    shas = generate_crates(registry, crates)
+    generate_lock(project, [(name, version, {}) for name, version in crates])
+    generate_element(project, registry, **{"track-threads": 4})
+
+    result = cli.run(project=project, args=["source", "track", "target.bst"])
+    result.assert_success()
+
+    # The ref is sorted, whatever the order the downloads finished in
+    ref = tracked_ref(project)
+    assert [(crate["name"], crate["version"]) for crate in ref] == sorted(
+        crates
+    )
+    for crate in ref:
+        assert crate["sha"] == shas[(crate["name"], crate["version"])]
+
+
+def test_track_download_error(cli, tmpdir):
+    project = str(tmpdir.join("project"))
+    registry = str(tmpdir.join("registry"))
+    os.makedirs(project)
+    generate_project(project)
+
+    crates = [("crate{}".format(i), "1.0.{}".format(i)) for i in range(20)]
+    generate_crates(registry, crates)
+    generate_lock(
+        project,
+        [(name, version, {}) for name, version in crates]
+        + [("missing", "1.0.0", {})],
+    )
+    generate_element(project, registry, **{"track-threads": 4})
+
+    result = cli.run(project=project, args=["source", "track", "target.bst"])
+    result.assert_main_error(ErrorDomain.STREAM, None)
+    result.assert_task_error(ErrorDomain.SOURCE, None)
+    assert "missing-1.0.0.crate" in result.stderr
+
+
+@pytest.mark.parametrize("threads", [0, -1])
+def test_track_threads_invalid(cli, tmpdir, threads):
+    project = str(tmpdir.join("project"))
+    registry = str(tmpdir.join("registry"))
+    os.makedirs(project)
+    generate_project(project)
+    generate_lock(project, [])
+    generate_element(project, registry, **{"track-threads": threads})
+
+    result = cli.run(project=project, args=["show", "target.bst"])
+    result.assert_main_error(ErrorDomain.SOURCE, None)
+
+
+def test_track_lock_checksums(cli, tmpdir):
+    project = str(tmpdir.join("project"))
+    registry = str(tmpdir.join("registry"))
+    os.makedirs(project)
+    generate_project(project)
+
+    # Only the crate without a checksum is in the registry, so tracking
+    # fails if any other crate is downloaded
+    shas = generate_crates(registry, [("nochecksum", "1.0.0")])
+    generate_lock(
+        project,
+        [
+            ("checksum", "1.0.0", {"checksum": "a" * 64}),
+            ("metadata", "1.0.0", {}),
+            ("nochecksum", "1.0.0", {"checksum": "<none>"}),
+        ],
+        metadata={
+            "checksum metadata 1.0.0 ({})".format(REGISTRY_SOURCE): "b" * 64
+        },
+    )
+    generate_element(project, registry)
+
+    result = cli.run(project=project, args=["source", "track", "target.bst"])
+    result.assert_success()
+
+    assert tracked_ref(project) == [
+        {"name": "checksum", "version": "1.0.0", "sha": "a" * 64},
+        {"name": "metadata", "version": "1.0.0", "sha": "b" * 64},
+        {
+            "name": "nochecksum",
+            "version": "1.0.0",
+            "sha": shas[("nochecksum", "1.0.0")],
+        },
+    ]
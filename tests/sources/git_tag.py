@@ -22,17 +22,28 @@
 #           William Salmon <will.salmon@codethink.co.uk>
 #
 
+import contextlib
+import hashlib
+import itertools
+import json
 import os
 import shutil
+import signal
+import subprocess
+import threading
+import time
+import types
 
 import pytest
 
 from buildstream.exceptions import ErrorDomain
-from buildstream import _yaml
+from buildstream import _yaml, utils
 
 from buildstream.testing import cli  # pylint: disable=unused-import
 from buildstream.testing._utils.site import HAVE_GIT
 
+from bst_plugins_experimental.sources import git_tag
+
 DATA_DIR = os.path.join(
     os.path.dirname(os.path.realpath(__file__)),
     "git_tag",
@@ -40,6 +51,55 @@ DATA_DIR = os.path.join(
 
 HAVE_GIT_LFS = shutil.which("git-lfs") is not None
 
+GIT_ENV = dict(
+    os.environ,
+    GIT_AUTHOR_NAME="tester",
+    GIT_AUTHOR_EMAIL="tester@example.com",
+    GIT_AUTHOR_DATE="2020-01-01T00:00:00+00:00",
+    GIT_COMMITTER_NAME="tester",
+    GIT_COMMITTER_EMAIL="tester@example.com",
+    GIT_COMMITTER_DATE="2020-01-01T00:00:00+00:00",
+)
+
+
+def git(*args, cwd=None, env=None):
+    return subprocess.run(
+        ["git"] + list(args),
+        cwd=cwd,
+        env=dict(GIT_ENV, **(env or {})),
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout.strip()
+
+
+# Creates a git repository with a file added by each commit, and
+# returns the commits
+def create_repo(path, commits):
+    os.makedirs(path)
+    git("init", "--quiet", path)
+    for i in range(commits):
+        with open(os.path.join(path, "file{}".format(i)), "w") as f:
+            f.write("content {}\n".format(i))
+        git("add", ".", cwd=path)
+        git("commit", "--quiet", "-m", "commit {}".format(i), cwd=path)
+    return git("rev-list", "--reverse", "HEAD", cwd=path).splitlines()
+
+
+# Returns the prerequisite commits listed in the header of a git bundle
+def bundle_prerequisites(bundle):
+    prerequisites = []
+    with open(bundle, "rb") as f:
+        for line in iter(f.readline, b"\n"):
+            if line.startswith(b"-"):
+                prerequisites.append(line[1:].split()[0].decode())
+    return prerequisites
+
+
+def generate_element(project, source, name="target.bst"):
+    element = {"kind": "import", "sources": [source]}
+    _yaml.roundtrip_dump(element, os.path.join(project, name))
+
 
 ## This test needs internet access which is not the best
 ## Something like https://github.com/git-lfs/lfs-test-server
@@ -175,3 +235,745 @@ def test_gitlfs_notset(cli, tmpdir, datafiles):
     result = cli.run(project=project, args=["source", "fetch", "target.bst"])
     result.assert_main_error(ErrorDomain.STREAM, None)
     result.assert_task_error(ErrorDomain.PLUGIN, "git_tag:unused-lfs")
+
+
+@pytest.mark.skipif(HAVE_GIT is False, reason="git is not available")
+@pytest.mark.datafiles(os.path.join(DATA_DIR, "lfs"))
+def test_stage_shallow_describe(cli, tmpdir, datafiles):
+    project = str(datafiles)
+    checkoutdir = os.path.join(str(tmpdir), "checkout")
+    repo = os.path.join(str(tmpdir), "repo")
+    commits = create_repo(repo, 12)
+    git("tag", "--annotate", "-m", "1.0", "1.0", commits[8], cwd=repo)
+    git("tag", "snapshot", commits[10], cwd=repo)
+
+    generate_element(
+        project,
+        {
+            "kind": "git_tag",
+            "url": "file://{}".format(repo),
+            "ref": "snapshot-1-g{}".format(commits[11]),
+            "stage-git-dir": "shallow",
+        },
+    )
+
+    result = cli.run(
+        project=project,
+        args=["source", "checkout", "--directory", checkoutdir, "target.bst"],
+    )
+    result.assert_success()
+
+    # The history back to the nearest tags is staged, and no further
+    staged = os.path.join(checkoutdir, "target")
+    assert git("describe", "--long", cwd=staged) == git(
+        "describe", "--long", commits[11], cwd=repo
+    )
+    assert git("describe", "--tags", cwd=staged) == git(
+        "describe", "--tags", commits[11], cwd=repo
+    )
+    assert int(git("rev-list", "--count", "HEAD", cwd=staged)) < len(commits)
+
+
+@pytest.mark.skipif(HAVE_GIT is False, reason="git is not available")
+@pytest.mark.datafiles(os.path.join(DATA_DIR, "lfs"))
+def test_stage_git_dir_none(cli, tmpdir, datafiles):
+    project = str(datafiles)
+    checkoutdir = os.path.join(str(tmpdir), "checkout")
+    repo = os.path.join(str(tmpdir), "repo")
+    commits = create_repo(repo, 2)
+    git("tag", "--annotate", "-m", "1.0", "1.0", commits[0], cwd=repo)
+
+    generate_element(
+        project,
+        {
+            "kind": "git_tag",
+            "url": "file://{}".format(repo),
+            "ref": "1.0-0-g{}".format(commits[0]),
+            "stage-git-dir": "none",
+        },
+    )
+
+    result = cli.run(
+        project=project,
+        args=["source", "checkout", "--directory", checkoutdir, "target.bst"],
+    )
+    result.assert_success()
+
+    # Only the tree of the commit is staged
+    staged = os.path.join(checkoutdir, "target")
+    assert sorted(os.listdir(staged)) == ["file0"]
+    with open(os.path.join(staged, "file0")) as f:
+        assert f.read() == "content 0\n"
+
+
+@pytest.mark.skipif(HAVE_GIT is False, reason="git is not available")
+@pytest.mark.datafiles(os.path.join(DATA_DIR, "lfs"))
+def test_stage_git_dir_none_lfs(cli, tmpdir, datafiles):
+    project = str(datafiles)
+    generate_element(
+        project,
+        {
+            "kind": "git_tag",
+            "url": "file://{}".format(os.path.join(str(tmpdir), "repo")),
+            "track": "master",
+            "stage-git-dir": "none",
+            "use-lfs": True,
+        },
+    )
+
+    result = cli.run(project=project, args=["show", "target.bst"])
+    result.assert_main_error(ErrorDomain.SOURCE, None)
+
+
+@pytest.mark.skipif(HAVE_GIT is False, reason="git is not available")
+@pytest.mark.datafiles(os.path.join(DATA_DIR, "lfs"))
+def test_clone_filter(cli, tmpdir, datafiles):
+    project = str(datafiles)
+    checkoutdir = os.path.join(str(tmpdir), "checkout")
+    repo = os.path.join(str(tmpdir), "repo")
+    commits = create_repo(repo, 3)
+    git("config", "uploadpack.allowFilter", "true", cwd=repo)
+    git("config", "uploadpack.allowAnySHA1InWant", "true", cwd=repo)
+
+    generate_element(
+        project,
+        {
+            "kind": "git_tag",
+            "url": "file://{}".format(repo),
+            "track": "master",
+            "ref": commits[1],
+            "clone-filter": "blob:none",
+        },
+    )
+
+    result = cli.run(project=project, args=["source", "fetch", "target.bst"])
+    result.assert_success()
+    assert cli.get_element_state(project, "target.bst") == "buildable"
+
+    result = cli.run(
+        project=project,
+        args=["source", "checkout", "--directory", checkoutdir, "target.bst"],
+    )
+    result.assert_success()
+    staged = os.path.join(checkoutdir, "target")
+    assert sorted(os.listdir(staged)) == [".git", "file0", "file1"]
+
+
+@pytest.mark.skipif(HAVE_GIT is False, reason="git is not available")
+@pytest.mark.datafiles(os.path.join(DATA_DIR, "lfs"))
+def test_fetch_submodules_concurrently(cli, tmpdir, datafiles):
+    project = str(datafiles)
+    checkoutdir = os.path.join(str(tmpdir), "checkout")
+    repo = os.path.join(str(tmpdir), "repo")
+    create_repo(repo, 1)
+    for i in range(4):
+        subrepo = os.path.join(str(tmpdir), "sub{}".format(i))
+        create_repo(subrepo, 2)
+        git(
+            "-c",
+            "protocol.file.allow=always",
+            "submodule",
+            "--quiet",
+            "add",
+            "file://{}".format(subrepo),
+            "sub{}".format(i),
+            cwd=repo,
+        )
+    git("commit", "--quiet", "-m", "add submodules", cwd=repo)
+
+    generate_element(
+        project,
+        {
+            "kind": "git_tag",
+            "url": "file://{}".format(repo),
+            "ref": git("rev-parse", "HEAD", cwd=repo),
+            "submodule-threads": 4,
+            "max-host-connections": 2,
+        },
+    )
+
+    result = cli.run(project=project, args=["source", "fetch", "target.bst"])
+    result.assert_success()
+    assert cli.get_element_state(project, "target.bst") == "buildable"
+
+    result = cli.run(
+        project=project,
+        args=["source", "checkout", "--directory", checkoutdir, "target.bst"],
+    )
+    result.assert_success()
+    for i in range(4):
+        staged = os.path.join(checkoutdir, "target", "sub{}".format(i))
+        assert sorted(os.listdir(staged)) == [".git", "file0", "file1"]
+
+
+@pytest.mark.skipif(HAVE_GIT is False, reason="git is not available")
+@pytest.mark.datafiles(os.path.join(DATA_DIR, "lfs"))
+def test_bundle_dir(cli, tmpdir, datafiles):
+    project = str(datafiles)
+    checkoutdir = os.path.join(str(tmpdir), "checkout")
+    bundledir = os.path.join(str(tmpdir), "bundles")
+    repo = os.path.join(str(tmpdir), "repo")
+    commits = create_repo(repo, 4)
+
+    # Each bundle only has the history since the previous one
+    for commit in commits[1::2]:
+        generate_element(
+            project,
+            {
+                "kind": "git_tag",
+                "url": "file://{}".format(repo),
+                "ref": commit,
+                "bundle-dir": bundledir,
+            },
+        )
+        result = cli.run(
+            project=project, args=["source", "fetch", "target.bst"]
+        )
+        result.assert_success()
+
+    bundles = {
+        name: bundle_prerequisites(os.path.join(bundledir, name))
+        for name in os.listdir(bundledir)
+    }
+    assert sorted(bundles.values()) == [[], [commits[1]]]
+
+    # Without the upstream repository, the bundles are imported
+    shutil.rmtree(repo)
+    cli.configure(
+        {
+            "cachedir": os.path.join(str(tmpdir), "cache2"),
+            "sourcedir": os.path.join(str(tmpdir), "sources2"),
+        }
+    )
+    result = cli.run(
+        project=project,
+        args=["source", "checkout", "--directory", checkoutdir, "target.bst"],
+    )
+    result.assert_success()
+    staged = os.path.join(checkoutdir, "target")
+    assert sorted(os.listdir(staged)) == [
+        ".git",
+        "file0",
+        "file1",
+        "file2",
+        "file3",
+    ]
+    assert git("rev-parse", "HEAD", cwd=staged) == commits[3]
+
+    # A bundle is not imported without the bundles it builds on
+    for name, prerequisites in bundles.items():
+        if not prerequisites:
+            os.unlink(os.path.join(bundledir, name))
+    cli.configure(
+        {
+            "cachedir": os.path.join(str(tmpdir), "cache3"),
+            "sourcedir": os.path.join(str(tmpdir), "sources3"),
+        }
+    )
+    result = cli.run(project=project, args=["source", "fetch", "target.bst"])
+    result.assert_main_error(ErrorDomain.STREAM, None)
+    assert "which is in no other bundle" in result.stderr
+
+
+@pytest.mark.skipif(HAVE_GIT is False, reason="git is not available")
+@pytest.mark.datafiles(os.path.join(DATA_DIR, "lfs"))
+def test_ls_remote_cache(cli, tmpdir, datafiles):
+    project = str(datafiles)
+    checkoutdir = os.path.join(str(tmpdir), "checkout")
+    sourcedir = os.path.join(str(tmpdir), "sources")
+    repo = os.path.join(str(tmpdir), "repo")
+    cli.configure({"sourcedir": sourcedir})
+    commits = create_repo(repo, 3)
+    git("tag", "--annotate", "-m", "1.0", "1.0", commits[1], cwd=repo)
+    git("tag", "--annotate", "-m", "2.0", "2.0", commits[2], cwd=repo)
+
+    generate_element(
+        project,
+        {
+            "kind": "git_tag",
+            "url": "file://{}".format(repo),
+            "ref": "1.0-0-g{}".format(commits[1]),
+            "ls-remote-cache-ttl": 600,
+        },
+    )
+    result = cli.run(project=project, args=["source", "fetch", "target.bst"])
+    result.assert_success()
+
+    cache_dir = os.path.join(sourcedir, "git_tag", "ls-remote-cache")
+    (cache_file,) = os.listdir(cache_dir)
+    with open(os.path.join(cache_dir, cache_file)) as f:
+        assert "refs/tags/2.0^{}" in f.read()
+
+    # A tag missing from the cached refs has them listed again
+    git("tag", "--annotate", "-m", "3.0", "3.0", commits[0], cwd=repo)
+    generate_element(
+        project,
+        {
+            "kind": "git_tag",
+            "url": "file://{}".format(repo),
+            "ref": "3.0-0-g{}".format(commits[0]),
+            "ls-remote-cache-ttl": 600,
+        },
+    )
+    result = cli.run(
+        project=project,
+        args=["source", "checkout", "--directory", checkoutdir, "target.bst"],
+    )
+    result.assert_success()
+    assert "so a full clone is required" not in result.stderr
+    staged = os.path.join(checkoutdir, "target")
+    assert git("rev-list", "--count", "HEAD", cwd=staged) == "1"
+    with open(os.path.join(cache_dir, cache_file)) as f:
+        assert "refs/tags/3.0^{}" in f.read()
+
+
+@pytest.mark.skipif(HAVE_GIT is False, reason="git is not available")
+@pytest.mark.datafiles(os.path.join(DATA_DIR, "lfs"))
+def test_submodule_table_cache(cli, tmpdir, datafiles):
+    project = str(datafiles)
+    checkoutdir = os.path.join(str(tmpdir), "checkout")
+    sourcedir = os.path.join(str(tmpdir), "sources")
+    repo = os.path.join(str(tmpdir), "repo")
+    subrepo = os.path.join(str(tmpdir), "sub")
+    cli.configure({"sourcedir": sourcedir})
+    create_repo(repo, 1)
+    subcommits = create_repo(subrepo, 2)
+    git(
+        "-c",
+        "protocol.file.allow=always",
+        "submodule",
+        "--quiet",
+        "add",
+        "file://{}".format(subrepo),
+        "sub",
+        cwd=repo,
+    )
+    git("commit", "--quiet", "-m", "add submodule", cwd=repo)
+    git("tag", "1.0", cwd=repo)
+    commit = git("rev-parse", "HEAD", cwd=repo)
+
+    # The table is cached by commit, whatever the ref names it
+    tables = os.path.join(sourcedir, "git_tag", "submodules")
+    for ref in ["1.0", commit]:
+        generate_element(
+            project,
+            {"kind": "git_tag", "url": "file://{}".format(repo), "ref": ref},
+        )
+        result = cli.run(
+            project=project, args=["source", "fetch", "target.bst"]
+        )
+        result.assert_success()
+
+        (table_dir,) = os.listdir(tables)
+        assert os.listdir(os.path.join(tables, table_dir)) == [
+            "{}.json".format(commit)
+        ]
+        with open(
+            os.path.join(tables, table_dir, "{}.json".format(commit))
+        ) as f:
+            table = json.load(f)
+        assert table == [["sub", "file://{}".format(subrepo), subcommits[1]]]
+
+    result = cli.run(
+        project=project,
+        args=["source", "checkout", "--directory", checkoutdir, "target.bst"],
+    )
+    result.assert_success()
+    staged = os.path.join(checkoutdir, "target", "sub")
+    assert git("rev-parse", "HEAD", cwd=staged) == subcommits[1]
+
+
+@pytest.mark.skipif(HAVE_GIT is False, reason="git is not available")
+@pytest.mark.datafiles(os.path.join(DATA_DIR, "lfs"))
+def test_track_extra(cli, tmpdir, datafiles):
+    project = str(datafiles)
+    repo = os.path.join(str(tmpdir), "repo")
+    commits = create_repo(repo, 2)
+    branch = git("rev-parse", "--abbrev-ref", "HEAD", cwd=repo)
+    git("tag", "--annotate", "-m", "1.0", "1.0", cwd=repo)
+
+    # Commit on each branch in turn, each time later than before
+    def commit_tag(tracking, tag, date):
+        git("checkout", "--quiet", tracking, cwd=repo)
+        with open(os.path.join(repo, tag), "w") as f:
+            f.write("{}\n".format(tag))
+        git("add", ".", cwd=repo)
+        git(
+            "commit",
+            "--quiet",
+            "-m",
+            tag,
+            cwd=repo,
+            env={"GIT_COMMITTER_DATE": date},
+        )
+        git("tag", "--annotate", "-m", tag, tag, cwd=repo)
+        return git("rev-parse", "HEAD", cwd=repo)
+
+    git("branch", "other", commits[0], cwd=repo)
+    generate_element(
+        project,
+        {
+            "kind": "git_tag",
+            "url": "file://{}".format(repo),
+            "track": branch,
+            "track-extra": ["other"],
+            "track-tags": True,
+        },
+    )
+
+    # The latest tag of all branches is tracked
+    for tracking, tag, date in [
+        ("other", "2.0", "2021-01-01T00:00:00+00:00"),
+        (branch, "3.0", "2022-01-01T00:00:00+00:00"),
+    ]:
+        commit = commit_tag(tracking, tag, date)
+        result = cli.run(
+            project=project, args=["source", "track", "target.bst"]
+        )
+        result.assert_success()
+        element = _yaml.roundtrip_load(os.path.join(project, "target.bst"))
+        assert element["sources"][0]["ref"] == "{}-0-g{}".format(tag, commit)
+
+
+@pytest.mark.skipif(HAVE_GIT is False, reason="git is not available")
+@pytest.mark.datafiles(os.path.join(DATA_DIR, "lfs"))
+def test_incremental_shallow(cli, tmpdir, datafiles):
+    project = str(datafiles)
+    checkoutdir = os.path.join(str(tmpdir), "checkout")
+    sourcedir = os.path.join(str(tmpdir), "sources")
+    repo = os.path.join(str(tmpdir), "repo")
+    cli.configure({"sourcedir": sourcedir})
+    commits = create_repo(repo, 4)
+    git("tag", "--annotate", "-m", "1.0", "1.0", commits[1], cwd=repo)
+    git("tag", "--annotate", "-m", "2.0", "2.0", commits[3], cwd=repo)
+
+    mirrors = []
+    for tag, commit in [("1.0", commits[1]), ("2.0", commits[3])]:
+        generate_element(
+            project,
+            {
+                "kind": "git_tag",
+                "url": "file://{}".format(repo),
+                "ref": "{}-0-g{}".format(tag, commit),
+                "incremental-shallow": True,
+            },
+        )
+        result = cli.run(
+            project=project, args=["source", "fetch", "target.bst"]
+        )
+        result.assert_success()
+
+        latest_dir = os.path.join(sourcedir, "git_tag", "latest-fetch-mirrors")
+        (latest_file,) = os.listdir(latest_dir)
+        with open(os.path.join(latest_dir, latest_file)) as f:
+            mirrors.append(os.path.join(sourcedir, "git_tag", f.read()))
+
+    # The second fetch borrows the objects of the first one
+    assert mirrors[0] != mirrors[1]
+    alternates = os.path.join(mirrors[1], "objects", "info", "alternates")
+    with open(alternates) as f:
+        assert f.read().splitlines() == [os.path.join(mirrors[0], "objects")]
+    git("cat-file", "-e", commits[1], cwd=mirrors[1])
+    assert "packs: 0" in git("count-objects", "-v", cwd=mirrors[1])
+    assert not os.path.exists(
+        os.path.join(mirrors[1], "objects", commits[1][:2], commits[1][2:])
+    )
+
+    result = cli.run(
+        project=project,
+        args=["source", "checkout", "--directory", checkoutdir, "target.bst"],
+    )
+    result.assert_success()
+    staged = os.path.join(checkoutdir, "target")
+    assert git("rev-parse", "HEAD", cwd=staged) == commits[3]
+    assert git("rev-list", "--count", "HEAD", cwd=staged) == "1"
+
+
+@pytest.mark.skipif(HAVE_GIT is False, reason="git is not available")
+@pytest.mark.datafiles(os.path.join(DATA_DIR, "lfs"))
+def test_maintenance(cli, tmpdir, datafiles):
+    project = str(datafiles)
+    sourcedir = os.path.join(str(tmpdir), "sources")
+    repo = os.path.join(str(tmpdir), "repo")
+    cli.configure({"sourcedir": sourcedir})
+    create_repo(repo, 2)
+    branch = git("rev-parse", "--abbrev-ref", "HEAD", cwd=repo)
+
+    generate_element(
+        project,
+        {
+            "kind": "git_tag",
+            "url": "file://{}".format(repo),
+            "track": branch,
+            "maintenance-max-packs": 0,
+            "maintenance-max-loose-objects": 1,
+        },
+    )
+    mirror = os.path.join(
+        sourcedir,
+        "git_tag",
+        utils.url_directory_name("file://{}".format(repo)),
+    )
+    commit_graph = os.path.join(mirror, "objects", "info", "commit-graph")
+    midx = os.path.join(mirror, "objects", "pack", "multi-pack-index")
+
+    # The clone has a single pack, and nothing to maintain
+    result = cli.run(project=project, args=["source", "track", "target.bst"])
+    result.assert_success()
+    assert not os.path.exists(commit_graph)
+    assert not os.path.exists(midx)
+
+    # The objects of the new commit are fetched loose, and repacked
+    with open(os.path.join(repo, "new"), "w") as f:
+        f.write("new\n")
+    git("add", ".", cwd=repo)
+    git("commit", "--quiet", "-m", "new", cwd=repo)
+
+    result = cli.run(project=project, args=["source", "track", "target.bst"])
+    result.assert_success()
+    assert "count: 0" in git("count-objects", "-v", cwd=mirror).splitlines()
+    assert os.path.exists(commit_graph)
+    assert os.path.exists(midx)
+
+
+@pytest.mark.skipif(HAVE_GIT is False, reason="git is not available")
+@pytest.mark.datafiles(os.path.join(DATA_DIR, "lfs"))
+def test_object_store_shared(cli, tmpdir, datafiles):
+    project = str(datafiles)
+    sourcedir = os.path.join(str(tmpdir), "sources")
+    repo = os.path.join(str(tmpdir), "repo")
+    fork = os.path.join(str(tmpdir), "fork")
+    cli.configure({"sourcedir": sourcedir})
+    create_repo(repo, 2)
+    branch = git("rev-parse", "--abbrev-ref", "HEAD", cwd=repo)
+    git("clone", "--quiet", repo, fork)
+    with open(os.path.join(fork, "forked"), "w") as f:
+        f.write("forked\n")
+    git("add", ".", cwd=fork)
+    git("commit", "--quiet", "-m", "forked", cwd=fork)
+    forked = git("rev-parse", "HEAD", cwd=fork)
+
+    mirrors = []
+    for name, url in [("upstream.bst", repo), ("fork.bst", fork)]:
+        generate_element(
+            project,
+            {
+                "kind": "git_tag",
+                "url": "file://{}".format(url),
+                "track": branch,
+                "object-store": True,
+                "object-store-name": "upstream",
+                "maintenance-max-loose-objects": 1,
+            },
+            name=name,
+        )
+        mirrors.append(
+            os.path.join(
+                sourcedir,
+                "git_tag",
+                utils.url_directory_name("file://{}".format(url)),
+            )
+        )
+
+    result = cli.run(
+        project=project, args=["source", "track", "upstream.bst", "fork.bst"]
+    )
+    result.assert_success()
+
+    # Both sources borrow from the same store, which has the objects of
+    # the fork
+    stores = os.path.join(sourcedir, "git_tag", "object-stores")
+    (store,) = os.listdir(stores)
+    store_objects = os.path.join(stores, store, "objects")
+    for mirror in mirrors:
+        alternates = os.path.join(mirror, "objects", "info", "alternates")
+        with open(alternates) as f:
+            assert f.read().splitlines() == [store_objects]
+    git("cat-file", "-e", forked, cwd=os.path.join(stores, store))
+
+    # Once maintained, the mirror drops its copies of the objects of the
+    # store
+    with open(os.path.join(repo, "new"), "w") as f:
+        f.write("new\n")
+    git("add", ".", cwd=repo)
+    git("commit", "--quiet", "-m", "new", cwd=repo)
+    new = git("rev-parse", "HEAD", cwd=repo)
+
+    result = cli.run(project=project, args=["source", "track", "upstream.bst"])
+    result.assert_success()
+    counts = git("count-objects", "-v", cwd=mirrors[0]).splitlines()
+    assert "count: 0" in counts
+    assert "in-pack: 0" in counts
+    git("cat-file", "-e", new, cwd=os.path.join(stores, store))
+
+
+@pytest.mark.skipif(HAVE_GIT is False, reason="git is not available")
+@pytest.mark.datafiles(os.path.join(DATA_DIR, "lfs"))
+def test_object_store_clone_filter(cli, tmpdir, datafiles):
+    project = str(datafiles)
+    generate_element(
+        project,
+        {
+            "kind": "git_tag",
+            "url": "file://{}".format(os.path.join(str(tmpdir), "repo")),
+            "track": "master",
+            "object-store": True,
+            "clone-filter": "blob:none",
+        },
+    )
+
+    result = cli.run(project=project, args=["show", "target.bst"])
+    result.assert_main_error(ErrorDomain.SOURCE, None)
+
+
+# Closes the 'git cat-file --batch' processes left by other tests, and
+# those of the test
+@pytest.fixture
+def cat_file_batches():
+    git_tag._close_cat_file_batches()
+    yield git_tag._cat_file_batches
+    git_tag._close_cat_file_batches()
+
+
+def cat_file_mirror(tmpdir):
+    source = types.SimpleNamespace(
+        host_git="git", get_mirror_directory=lambda: str(tmpdir)
+    )
+    return git_tag.GitTagMirror(source, "", "file:///repo", None)
+
+
+@pytest.mark.skipif(HAVE_GIT is False, reason="git is not available")
+def test_cat_file(tmpdir, cat_file_batches):
+    repo = os.path.join(str(tmpdir), "repo")
+    commits = create_repo(repo, 2)
+    mirror = cat_file_mirror(tmpdir)
+
+    # Two blobs sharing their first 4 hex digits, the shortest
+    # abbreviation git accepts
+    blobs = {}
+    for i in itertools.count():
+        content = "blob {}\n".format(i).encode()
+        header = "blob {}\0".format(len(content)).encode()
+        blob_oid = hashlib.sha1(header + content).hexdigest()
+        if blob_oid[:4] in blobs:
+            break
+        blobs[blob_oid[:4]] = content
+    for blob in [blobs[blob_oid[:4]], content]:
+        subprocess.run(
+            ["git", "hash-object", "-w", "--stdin"],
+            input=blob,
+            cwd=repo,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+
+    oid, obj_type, contents = mirror.cat_file(commits[1], mirror=repo)
+    assert (oid, obj_type) == (commits[1], "commit")
+    assert contents.startswith(b"tree ")
+    _, obj_type, contents = mirror.cat_file("HEAD:file1", mirror=repo)
+    assert (obj_type, contents) == ("blob", b"content 1\n")
+
+    # Missing and ambiguous objects
+    assert mirror.cat_file("0" * 40, mirror=repo) is None
+    assert mirror.cat_file("HEAD:missing", mirror=repo) is None
+    assert mirror.cat_file(blob_oid[:4], mirror=repo) is None
+    assert mirror.cat_file(blob_oid, mirror=repo)[2] == content
+
+    # The process is restarted once it exits
+    batch = cat_file_batches[repo]
+    batch._process.kill()
+    batch._process.wait()
+    assert mirror.cat_file(commits[0], mirror=repo)[0] == commits[0]
+    assert cat_file_batches[repo] is not batch
+
+
+@pytest.mark.skipif(HAVE_GIT is False, reason="git is not available")
+def test_cat_file_eviction(tmpdir, cat_file_batches):
+    mirror = cat_file_mirror(tmpdir)
+    repos = []
+    for i in range(git_tag._CAT_FILE_BATCHES_MAX + 1):
+        repo = os.path.join(str(tmpdir), "repo{}".format(i))
+        (commit,) = create_repo(repo, 1)
+        assert mirror.cat_file(commit, mirror=repo)[0] == commit
+        repos.append(repo)
+
+    # The least recently used process is stopped
+    assert list(cat_file_batches) == repos[1:]
+
+    # Using a process makes it the most recently used
+    mirror.cat_file("HEAD", mirror=repos[1])
+    batch = cat_file_batches[repos[2]]
+    mirror.cat_file("HEAD", mirror=repos[0])
+    assert list(cat_file_batches) == repos[3:] + [repos[1], repos[0]]
+    assert batch._process.poll() is not None
+
+
+# The git processes of the worker threads are stopped and continued
+# when the job is suspended and resumed, and killed when it is
+# terminated, before the handlers of the job run
+def test_run_concurrently_signals(tmpdir):
+    pids_file = os.path.join(str(tmpdir), "pids")
+    source = types.SimpleNamespace(
+        host_git="git",
+        get_mirror_directory=lambda: str(tmpdir),
+        submodule_threads=2,
+        tempdir=lambda: contextlib.nullcontext(str(tmpdir)),
+    )
+    mirrors = [cat_file_mirror(tmpdir) for _ in range(2)]
+
+    def sleep(mirror):
+        return mirror.source.call(
+            ["sh", "-c", "echo $$ >>{}; exec sleep 60".format(pids_file)]
+        )
+
+    def read_pids():
+        try:
+            with open(pids_file) as f:
+                return [int(pid) for pid in f.read().split()]
+        except FileNotFoundError:
+            return []
+
+    # Waits a little for the signals to be delivered
+    def process_state(pid):
+        for _ in range(100):
+            with open("/proc/{}/stat".format(pid)) as f:
+                state = f.read().rsplit(")", 1)[1].split()[0]
+            if state == "T":
+                break
+            time.sleep(0.01)
+        return state
+
+    states = []
+    suspended = threading.Event()
+    terminated = threading.Event()
+
+    def suspend(signum, frame):
+        states.extend(process_state(pid) for pid in read_pids())
+        suspended.set()
+
+    def terminate(signum, frame):
+        terminated.set()
+
+    def send_signals():
+        while len(read_pids()) < 2:
+            time.sleep(0.01)
+        os.kill(os.getpid(), signal.SIGTSTP)
+        suspended.wait()
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    original_suspend = signal.signal(signal.SIGTSTP, suspend)
+    original_terminate = signal.signal(signal.SIGTERM, terminate)
+    try:
+        thread = threading.Thread(target=send_signals)
+        thread.start()
+        futures = git_tag.GitTagSource.run_concurrently(source, sleep, mirrors)
+        thread.join()
+        assert signal.getsignal(signal.SIGTSTP) is suspend
+        assert signal.getsignal(signal.SIGTERM) is terminate
+    finally:
+        signal.signal(signal.SIGTSTP, original_suspend)
+        signal.signal(signal.SIGTERM, original_terminate)
+
+    assert states == ["T", "T"]
+    assert terminated.is_set()
+    assert [future.result() for future in futures] == [-signal.SIGKILL] * 2